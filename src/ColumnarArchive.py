@@ -0,0 +1,200 @@
+import os
+import re
+import time
+import calendar
+import pandas as pd
+
+pyarrow = None  # Imported on first use, see load_pyarrow
+
+segment_pattern = re.compile(r"^segment_(\d+)_(\d+)\.arrow$")
+
+
+def load_pyarrow():
+    """
+    Import pyarrow (optional dependency) the first time it is needed
+    :return: the pyarrow module
+    """
+    global pyarrow
+    if pyarrow is None:
+        try:
+            import pyarrow.ipc  # binds the global pyarrow
+        except ImportError:
+            raise ImportError("The columnar archive needs pyarrow, install it with 'pip install pyarrow'")
+    return pyarrow
+
+
+def concat_positions(frames):
+    """
+    Concatenate position dataframes keeping current_country categorical if one of them is
+    :param frames: list of pandas.DataFrame
+    :return: pandas.DataFrame
+    """
+    frames = [frame for frame in frames if frame is not None]
+    if any(isinstance(frame["current_country"].dtype, pd.CategoricalDtype) for frame in frames):
+        categories = pd.api.types.union_categoricals(
+            [pd.Categorical(frame["current_country"]) for frame in frames]).categories
+        frames = [frame.assign(current_country=pd.Categorical(frame["current_country"], categories=categories))
+                  for frame in frames]
+    return pd.concat(frames, ignore_index=True)
+
+
+class ColumnarArchive:
+    """This class keeps the closed days of trip_data in Arrow IPC files (one segment per month and export, merged
+    by compact) with typed columns. The files are memory-mapped and converted to pandas column by column (no
+    decoding as with SQLite), only the newer rows need to be read from SQLite.
+    Usage:
+     archive = ColumnarArchive("folder")
+     archive.export(trip_data)  (archive the closed days)
+     archive.read()"""
+
+    def __init__(self, folder):
+        """
+        Initiation
+        :param folder: folder of the Arrow files, created if it does not exist
+        """
+        load_pyarrow()
+        self.folder = folder
+        os.makedirs(folder, exist_ok=True)
+        self.schema = pyarrow.schema([
+            ("timestamp", pyarrow.int64()),
+            ("latitude", pyarrow.float64()),
+            ("longitude", pyarrow.float64()),
+            ("altitude", pyarrow.float64()),
+            ("speed", pyarrow.float64()),
+            ("km", pyarrow.float64()),
+            ("current_country", pyarrow.dictionary(pyarrow.int16(), pyarrow.string())),
+            ("current_step", pyarrow.int64())])
+
+    def segments(self):
+        """
+        :return: list of (first timestamp, last timestamp, filepath) of the archived segments, ordered by time
+        """
+        segments = []
+        for filename in os.listdir(self.folder):
+            segment = segment_pattern.match(filename)
+            if segment:
+                segments.append((int(segment.group(1)), int(segment.group(2)), os.path.join(self.folder, filename)))
+        return sorted(segments)
+
+    @property
+    def last_timestamp(self):
+        """ Last archived timestamp (None if the archive is empty), the newer positions are in SQLite """
+        segments = self.segments()
+        return segments[-1][1] if segments else None
+
+    def _write_segment(self, positions):
+        table = pyarrow.Table.from_pandas(positions[self.schema.names], schema=self.schema, preserve_index=False)
+        filepath = os.path.join(self.folder, "segment_%d_%d.arrow" % (positions["timestamp"].iloc[0],
+                                                                       positions["timestamp"].iloc[-1]))
+        # Uncompressed, so that the file can be memory-mapped. Written atomically.
+        with pyarrow.OSFile(filepath + ".tmp", "wb") as sink:
+            with pyarrow.ipc.new_file(sink, self.schema) as writer:
+                writer.write_table(table)
+        os.replace(filepath + ".tmp", filepath)
+        return filepath
+
+    def export(self, trip_data, until_timestamp=None):
+        """
+        Archive the positions newer than the archive and older than until_timestamp
+        :param trip_data: OverviewDatabase
+        :param until_timestamp: first timestamp not archived (default: the beginning of the current UTC day,
+            so that only closed days are archived)
+        :return: number of archived positions
+        """
+        if until_timestamp is None:
+            until_timestamp = calendar.timegm(time.gmtime()[:3] + (0, 0, 0))
+        self.check(trip_data)
+        start_timestamp = None if self.last_timestamp is None else self.last_timestamp + 1
+        positions = trip_data.query_range(start_timestamp, until_timestamp - 1)
+        if positions is None or positions.empty:
+            return 0
+        # One segment per month, so that compact can merge them
+        for _, month_positions in positions.groupby(
+                pd.to_datetime(positions["timestamp"], unit="s").dt.strftime("%Y_%m"), sort=True):
+            self._write_segment(month_positions)
+        return len(positions)
+
+    def invalidate(self, timestamp):
+        """
+        Remove the segments of the month of a timestamp and of the following months, the next export archives them
+        again from SQLite
+        :param timestamp: oldest timestamp written after the export
+        :return: number of removed segments
+        """
+        month_start = calendar.timegm(time.gmtime(timestamp)[:2] + (1, 0, 0, 0))
+        removed = 0
+        for _, last_timestamp, filepath in self.segments():
+            if last_timestamp >= month_start:
+                os.remove(filepath)
+                removed += 1
+        return removed
+
+    def check(self, trip_data):
+        """
+        Compare the number of positions of each archived month with SQLite, and invalidate the archive from the
+        first month which differs (positions inserted or deleted at or before the last archived timestamp)
+        :param trip_data: OverviewDatabase
+        :return: number of removed segments
+        """
+        segments = self.segments()
+        if not segments:
+            return 0
+        archived = {}
+        for first_timestamp, _, filepath in segments:
+            month = time.strftime("%Y_%m", time.gmtime(first_timestamp))
+            archived[month] = archived.get(month, 0) + self._count_rows(filepath)
+        last_timestamp = segments[-1][1]
+        # One count on the timestamp index, the months are only counted if the totals differ
+        if trip_data.count_positions(last_timestamp) in (None, sum(archived.values())):
+            return 0
+        stored = trip_data.count_positions(last_timestamp, by_month=True) or {}
+        months = [month for month in set(archived) | set(stored) if archived.get(month) != stored.get(month)]
+        return self.invalidate(calendar.timegm(time.strptime(min(months), "%Y_%m")))
+
+    def compact(self):
+        """
+        Merge the segments of each closed month into one file
+        :return: number of merged segments
+        """
+        months = {}
+        for first_timestamp, _, filepath in self.segments():
+            months.setdefault(time.strftime("%Y_%m", time.gmtime(first_timestamp)), []).append(filepath)
+        merged = 0
+        for month, filepaths in months.items():
+            if len(filepaths) < 2 or month == time.strftime("%Y_%m", time.gmtime()):
+                continue
+            self._write_segment(self._read_files(filepaths))
+            for filepath in filepaths:
+                os.remove(filepath)
+            merged += len(filepaths)
+        return merged
+
+    @staticmethod
+    def _count_rows(filepath):
+        with pyarrow.memory_map(filepath, "r") as source:
+            reader = pyarrow.ipc.open_file(source)
+            return sum(reader.get_batch(i).num_rows for i in range(reader.num_record_batches))
+
+    def _read_files(self, filepaths, columns=None):
+        tables = []
+        for filepath in filepaths:
+            with pyarrow.memory_map(filepath, "r") as source:
+                tables.append(pyarrow.ipc.open_file(source).read_all())
+        if not tables:
+            return pd.DataFrame(columns=columns or self.schema.names)
+        table = pyarrow.concat_tables(tables) if len(tables) > 1 else tables[0]
+        del tables
+        if columns:
+            table = table.select(columns)
+        # The columns are copied to pandas (only the selected ones are read from the mapped files), each one is
+        # released from the table once converted instead of holding both
+        return table.to_pandas(split_blocks=True, self_destruct=True)
+
+    def read(self, columns=None):
+        """
+        Read the archived positions, from the memory-mapped files into a pandas.DataFrame (one copy of the read
+        columns)
+        :param columns: list of the columns to read (all by default)
+        :return: pandas.DataFrame ordered by timestamp, current_country is categorical
+        """
+        return self._read_files([filepath for _, _, filepath in self.segments()], columns)
@@ -0,0 +1,176 @@
+import io
+import os
+from collections import OrderedDict
+import pandas as pd
+
+default_data_folder = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "data")
+
+
+class CountryResolver:
+    """This class resolves the country of gps positions with the reverse_geocoder K-D tree.
+    The tree and the country names are loaded once at the first query, and the lookups are kept
+    in a bounded LRU cache keyed on quantised latitude/longitude cells.
+    Usage:
+     resolver = get_country_resolver()
+     resolver.resolve(49.06, 1.99) -> "France"
+     resolver.resolve_many([(49.06, 1.99), (52.22, 21.01)]) -> ["France", "Poland"]"""
+
+    def __init__(self, geocoder_filepath=None, country_info_filepath=None, cache_size=4096, cell_size=0.01):
+        """
+        Initiation, nothing is loaded until the first query
+        :param geocoder_filepath: reverse_geocoder csv source, if it does not exist the library
+            one is used (default: data/reverse_geocoder.csv)
+        :param country_info_filepath: csv of the country names indexed by ISO code (default: data/country_info.csv)
+        :param cache_size: maximal number of cells kept in the LRU cache
+        :param cell_size: size of the cache cells in degrees (0.01° is about 1 km)
+        """
+        self.geocoder_filepath = geocoder_filepath or os.path.join(default_data_folder, "reverse_geocoder.csv")
+        self.country_info_filepath = country_info_filepath or os.path.join(default_data_folder, "country_info.csv")
+        self.cell_size = cell_size
+        self.cache_size = cache_size
+        self.geocoder = None
+        self.country_names = None
+        self.cache = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def load(self):
+        """ Build the K-D tree and load the country names if it is not done yet """
+        if self.geocoder is None:
+            # Imported on first use, it loads scipy
+            import reverse_geocoder
+            stream = None
+            if os.path.exists(self.geocoder_filepath):
+                with open(self.geocoder_filepath, encoding='utf-8') as file:
+                    stream = io.StringIO(file.read())
+            self.geocoder = reverse_geocoder.RGeocoder(mode=1, verbose=False, stream=stream)
+        if self.country_names is None:
+            country_codes = pd.read_csv(self.country_info_filepath, index_col=0, keep_default_na=False,
+                                        on_bad_lines="skip")
+            self.country_names = country_codes["Country"].to_dict()
+
+    def country_name(self, country_code):
+        """
+        :param country_code: ISO country code
+        :return: the country name, or the code itself if the code is unknown
+        """
+        self.load()
+        return self.country_names.get(country_code, country_code)
+
+    def query(self, coordinates):
+        """
+        Batched K-D tree query without cache
+        :param coordinates: list of (latitude, longitude)
+        :return: list of the country names
+        """
+        if len(coordinates) == 0:
+            return []
+        self.load()
+        return [self.country_name(location["cc"]) for location in self.geocoder.query(list(coordinates))]
+
+    def assign(self, latitudes, longitudes, stride=60):
+        """
+        Country of every gps position of a trace (ordered by time).
+        One position every `stride` is geocoded in one batched K-D tree query, then only the intervals where the
+        country changes are bisected (one batched query per bisection round). It takes about
+        n / stride + crossings * log2(stride) geocoder lookups instead of n.
+        Note: a round trip in another country shorter than `stride` positions is not detected.
+        :param latitudes: array of latitudes
+        :param longitudes: array of longitudes
+        :param stride: number of positions between two candidate points
+        :return: list of the country names, same length as the input
+        """
+        positions = len(latitudes)
+        if positions == 0:
+            return []
+        countries = [None] * positions
+        candidates = list(range(0, positions, max(int(stride), 1)))
+        if candidates[-1] != positions - 1:
+            candidates.append(positions - 1)
+
+        def query_indices(indices):
+            for index, country in zip(indices, self.query([(latitudes[i], longitudes[i]) for i in indices])):
+                countries[index] = country
+
+        query_indices(candidates)
+        # Bisect the intervals that contains a border crossing
+        crossings = [(first, last) for first, last in zip(candidates[:-1], candidates[1:])
+                     if countries[first] != countries[last] and last - first > 1]
+        while crossings:
+            middles = [(first + last) // 2 for first, last in crossings]
+            query_indices(middles)
+            next_crossings = []
+            for (first, last), middle in zip(crossings, middles):
+                for interval in [(first, middle), (middle, last)]:
+                    if countries[interval[0]] != countries[interval[1]] and interval[1] - interval[0] > 1:
+                        next_crossings.append(interval)
+            crossings = next_crossings
+        # The positions between two known positions of the same country are in that country
+        return pd.Series(countries, dtype=object).ffill().tolist()
+
+    def cell(self, latitude, longitude):
+        """
+        :return: the cache cell of the gps position
+        """
+        return round(float(latitude) / self.cell_size), round(float(longitude) / self.cell_size)
+
+    def resolve(self, latitude, longitude):
+        """
+        Cached country lookup
+        :param latitude: gps latitude
+        :param longitude: gps longitude
+        :return: the country name
+        """
+        return self.resolve_many([(latitude, longitude)])[0]
+
+    def resolve_many(self, coordinates):
+        """
+        Cached country lookup of several positions, the cells that are not cached are queried in one batch
+        :param coordinates: list of (latitude, longitude)
+        :return: list of the country names
+        """
+        cells = [self.cell(latitude, longitude) for latitude, longitude in coordinates]
+        countries = {}
+        for cell in cells:
+            if cell in countries:
+                self.hits += 1
+            elif cell in self.cache:
+                self.cache.move_to_end(cell)
+                countries[cell] = self.cache[cell]
+                self.hits += 1
+            else:
+                countries[cell] = None
+        # Query the center of the missing cells in one batch
+        missing = [cell for cell, country in countries.items() if country is None]
+        self.misses += len(missing)
+        for cell, country in zip(missing, self.query([(cell[0] * self.cell_size, cell[1] * self.cell_size)
+                                                      for cell in missing])):
+            countries[cell] = country
+            self.cache[cell] = country
+            if len(self.cache) > self.cache_size:
+                self.cache.popitem(last=False)
+        return [countries[cell] for cell in cells]
+
+    def cache_info(self):
+        """
+        :return: dict of the cache hits, misses, maxsize and currsize
+        """
+        return {"hits": self.hits, "misses": self.misses, "maxsize": self.cache_size, "currsize": len(self.cache)}
+
+    def clear_cache(self):
+        """ Clear the LRU cache and its counters """
+        self.cache.clear()
+        self.hits = self.misses = 0
+
+
+country_resolver = None
+
+
+def get_country_resolver():
+    """
+    :return: the process-wide country resolver, created at the first call
+    """
+    global country_resolver
+    if country_resolver is None:
+        country_resolver = CountryResolver()
+    return country_resolver
@@ -0,0 +1,300 @@
+import os
+import json
+import gzip
+import zlib
+import logging
+import numpy as np
+from http import HTTPStatus
+from email.utils import formatdate, parsedate_to_datetime
+from urllib.parse import urlsplit, parse_qs
+from http.server import HTTPServer, BaseHTTPRequestHandler
+
+default_data_folder = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "data")
+# Columns of the positions sent to the clients
+live_columns = ["timestamp", "latitude", "longitude", "current_step"]
+
+
+def positions_to_features(positions, precision=5):
+    """
+    :param positions: pandas.DataFrame of timestamp, latitude, longitude and current_step ordered by timestamp
+    :param precision: decimals of the coordinates (5 is about 1 m)
+    :return: list of GeoJSON features, one LineString per step ([longitude, latitude] coordinates, a Point if the
+        step has a single position) with the step, first_timestamp and last_timestamp properties
+    """
+    if positions is None or positions.empty:
+        return []
+    steps = positions["current_step"].values
+    timestamps = positions["timestamp"].values
+    coordinates = np.round(positions[["longitude", "latitude"]].values.astype(float), precision).tolist()
+    bounds = np.flatnonzero(np.diff(steps)) + 1
+    features = []
+    for first, last in zip(np.r_[0, bounds], np.r_[bounds, len(positions)]):
+        geometry = {"type": "LineString", "coordinates": coordinates[first:last]} if last - first > 1 \
+            else {"type": "Point", "coordinates": coordinates[first]}
+        features.append({"type": "Feature", "geometry": geometry,
+                         "properties": {"step": int(steps[first]), "first_timestamp": int(timestamps[first]),
+                                        "last_timestamp": int(timestamps[last - 1])}})
+    return features
+
+
+class LiveMapServer:
+    """This class serves the trip from the overview database to the live map page (data/live_map.html), which loads
+    the steps once and then polls the new positions, instead of reloading the generated site:
+     - /summary: trip summary and the list of the steps (JSON)
+     - /steps/<n>: positions of one step (GeoJSON Feature)
+     - /trace?since=<timestamp>: positions after the timestamp (GeoJSON FeatureCollection, last_timestamp member to
+       poll the next ones), the first feature starts with the last position before so that the trace is continuous
+    The responses carry an ETag and a Last-Modified derived from the summary of the data they contain, so that an
+    unchanged response is a 304 without any query of the positions, and are gzip-compressed when the client accepts
+    it. The bodies are cached per version, the followers polling the same delta share one body.
+    The database is read from the thread of the server: use serve() rather than a threading server (the
+    connection of OverviewDatabase belongs to the thread that opened it), the writes go through another process
+    (generate_site.py --daemon or mqtt_ingest.py, with the WAL journal mode).
+    Usage:
+     trip_data = OverviewDatabase()
+     trip_data.connect_to_database(database_filepath)
+     LiveMapServer(trip_data, tiles_url="https://tile.openstreetmap.org/{z}/{x}/{y}.png").serve("0.0.0.0", 8090)"""
+
+    def __init__(self, trip_data, tiles_url="https://tile.openstreetmap.org/{z}/{x}/{y}.png", poll_interval=30,
+                 page_filepath=None, cache_size=64, min_gzip_size=256):
+        """
+        Initiation
+        :param trip_data: connected OverviewDatabase
+        :param tiles_url: tiles of the live map page
+        :param poll_interval: seconds between two polls of the new positions by the page
+        :param page_filepath: template of the live map page (default: data/live_map.html)
+        :param cache_size: maximal number of cached response bodies
+        :param min_gzip_size: smaller bodies are not compressed
+        """
+        self.trip_data = trip_data
+        self.cache_size = cache_size
+        self.min_gzip_size = min_gzip_size
+        self.cache = {}  # {path: (etag, last_modified, content_type, body, gzipped body or None)}
+        self.stats = {"requests": 0, "not_modified": 0, "cache_hits": 0, "bytes": 0}
+        with open(page_filepath or os.path.join(default_data_folder, "live_map.html"), "r") as file:
+            page = file.read()
+        self.page = page.replace("{{tiles_url}}", tiles_url).replace("{{poll_interval}}", str(int(poll_interval)))
+        self.page_etag = '"page-%08x"' % zlib.crc32(self.page.encode())
+        self.page_gzipped = gzip.compress(self.page.encode(), compresslevel=6)
+
+    def respond(self, path, request_headers=None):
+        """
+        Response to a GET request
+        :param path: path of the request, with its query string
+        :param request_headers: headers of the request (If-None-Match, If-Modified-Since and Accept-Encoding are
+            used)
+        :return: status (HTTPStatus), dict of the response headers, body (bytes)
+        """
+        request_headers = request_headers or {}
+        self.stats["requests"] += 1
+        url = urlsplit(path)
+        parts = [part for part in url.path.split("/") if part]
+        try:
+            if not parts or parts == ["index.html"]:
+                status, headers, body = self._page_response(request_headers)
+            elif parts == ["summary"]:
+                status, headers, body = self._summary_response(path, request_headers)
+            elif parts == ["trace"]:
+                since = parse_qs(url.query).get("since", ["0"])[0]
+                status, headers, body = self._trace_response(path, int(since), request_headers)
+            elif len(parts) == 2 and parts[0] == "steps":
+                status, headers, body = self._step_response(path, int(parts[1]), request_headers)
+            else:
+                status, headers, body = error_response(HTTPStatus.NOT_FOUND, "Unknown path " + url.path)
+        except ValueError as e:
+            status, headers, body = error_response(HTTPStatus.BAD_REQUEST, str(e))
+        if status == HTTPStatus.NOT_MODIFIED:
+            self.stats["not_modified"] += 1
+        self.stats["bytes"] += len(body)
+        return status, headers, body
+
+    def _page_response(self, request_headers):
+        if self.page_etag in request_headers.get("If-None-Match", ""):
+            return HTTPStatus.NOT_MODIFIED, {"ETag": self.page_etag}, b""
+        return self._encode(HTTPStatus.OK, self.page_etag, None, "text/html; charset=utf-8", self.page.encode(),
+                            self.page_gzipped, request_headers)
+
+    def _summary_response(self, path, request_headers):
+        summary = self.trip_data.get_trip_summary()
+        if summary is None:
+            return error_response(HTTPStatus.SERVICE_UNAVAILABLE, "The trip has no position")
+        etag = '"summary-%d-%d"' % (summary["positions"], summary["last_timestamp"])
+
+        def body():
+            steps = self.trip_data.get_step_summaries()
+            summary["steps"] = [{"step": int(step), "first_timestamp": int(row["first_timestamp"]),
+                                 "last_timestamp": int(row["last_timestamp"]),
+                                 "km": round(float(row["last_km"] - row["first_km"]), 2),
+                                 "positions": int(row["positions"]), "etag": step_etag(step, row)}
+                                for step, row in steps.iterrows()]
+            return summary
+        return self._cached_response(path, etag, summary["last_timestamp"], body, request_headers)
+
+    def _trace_response(self, path, since, request_headers):
+        summary = self.trip_data.get_trip_summary()
+        if summary is None:
+            return error_response(HTTPStatus.SERVICE_UNAVAILABLE, "The trip has no position")
+        etag = '"trace-%d-%d-%d"' % (since, summary["positions"], summary["last_timestamp"])
+
+        def body():
+            positions = self.trip_data.query_range(since + 1, columns=live_columns)
+            if positions is None:
+                return None
+            # Last position before the delta, the first feature continues the trace already drawn
+            success, previous = self.trip_data.execute_read_query(
+                "SELECT " + ", ".join(live_columns) + " FROM trip_data WHERE timestamp <= %d "
+                "ORDER BY timestamp DESC LIMIT 1" % since, quiet=True)
+            features = positions_to_features(positions)
+            if success and previous and features:
+                first = features[0]["geometry"]
+                point = [round(float(previous[0][2]), 5), round(float(previous[0][1]), 5)]
+                first["coordinates"] = [point] + (first["coordinates"] if first["type"] == "LineString"
+                                                  else [first["coordinates"]])
+                first["type"] = "LineString"
+            return {"type": "FeatureCollection", "features": features,
+                    "last_timestamp": int(positions["timestamp"].iloc[-1]) if not positions.empty else since}
+        return self._cached_response(path, etag, summary["last_timestamp"], body, request_headers)
+
+    def _step_response(self, path, step, request_headers):
+        steps = self.trip_data.get_step_summaries()
+        if step not in steps.index:
+            return error_response(HTTPStatus.NOT_FOUND, "The step %d has no position" % step)
+        row = steps.loc[step]
+
+        def body():
+            positions = self.trip_data.query_step(step, columns=live_columns)
+            if positions is None:
+                return None
+            features = positions_to_features(positions)
+            feature = features[0] if features else {"type": "Feature", "geometry": None, "properties": {}}
+            feature["properties"].update(km=round(float(row["last_km"] - row["first_km"]), 2),
+                                         positions=int(row["positions"]))
+            return feature
+        return self._cached_response(path, step_etag(step, row), int(row["last_timestamp"]), body, request_headers)
+
+    def _cached_response(self, path, etag, last_modified, body, request_headers):
+        """
+        Response of a versioned resource
+        :param path: path of the request (key of the cache)
+        :param etag: version of the resource, the body is only built if it changed
+        :param last_modified: timestamp of the last position of the resource
+        :param body: function building the JSON body (None if the database failed)
+        :param request_headers: headers of the request
+        :return: status, headers, body
+        """
+        headers = {"ETag": etag, "Last-Modified": formatdate(last_modified, usegmt=True), "Cache-Control": "no-cache"}
+        if not_modified(request_headers, etag, last_modified):
+            return HTTPStatus.NOT_MODIFIED, headers, b""
+        cached = self.cache.get(path)
+        if cached is not None and cached[0] == etag:
+            self.stats["cache_hits"] += 1
+            return self._encode(HTTPStatus.OK, *cached, request_headers)
+        content = body()
+        if content is None:
+            return error_response(HTTPStatus.SERVICE_UNAVAILABLE, "The database query failed")
+        cached = (etag, last_modified, "application/json",
+                  json.dumps(content, separators=(",", ":")).encode(), None)
+        if len(self.cache) >= self.cache_size:
+            # The oldest response is dropped
+            del self.cache[next(iter(self.cache))]
+        self.cache[path] = cached
+        return self._encode(HTTPStatus.OK, *cached, request_headers, path=path)
+
+    def _encode(self, status, etag, last_modified, content_type, body, gzipped, request_headers, path=None):
+        headers = {"ETag": etag, "Content-Type": content_type, "Cache-Control": "no-cache",
+                   "Vary": "Accept-Encoding"}
+        if last_modified is not None:
+            headers["Last-Modified"] = formatdate(last_modified, usegmt=True)
+        if len(body) >= self.min_gzip_size and "gzip" in request_headers.get("Accept-Encoding", ""):
+            if gzipped is None:
+                gzipped = gzip.compress(body, compresslevel=6)
+                if path in self.cache:
+                    # The compressed body is cached with the plain one
+                    self.cache[path] = self.cache[path][:4] + (gzipped,)
+            headers["Content-Encoding"] = "gzip"
+            body = gzipped
+        return status, headers, body
+
+    def invalidate(self):
+        """
+        Drop the cached bodies (ex: after a rewrite of past positions, which does not change the summary)
+        """
+        self.cache.clear()
+
+    def serve(self, host="0.0.0.0", port=8090):
+        """
+        Serve the requests until KeyboardInterrupt or SIGTERM (handled as KeyboardInterrupt by the caller)
+        :param host: address to listen on
+        :param port: port to listen on (0: any free port)
+        """
+        server = HTTPServer((host, port), LiveMapRequestHandler)
+        server.live_map = self
+        logging.info("Live map served on http://%s:%d/" % server.server_address[:2])
+        try:
+            server.serve_forever()
+        finally:
+            server.server_close()
+
+
+class LiveMapRequestHandler(BaseHTTPRequestHandler):
+    """ Request handler of LiveMapServer.serve """
+    # An idle client does not block the other requests for more than this number of seconds
+    timeout = 10
+
+    def do_GET(self):
+        self._respond(send_body=True)
+
+    def do_HEAD(self):
+        self._respond(send_body=False)
+
+    def _respond(self, send_body):
+        status, headers, body = self.server.live_map.respond(self.path, self.headers)
+        self.send_response(status)
+        for name, value in headers.items():
+            self.send_header(name, value)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        if send_body and body:
+            self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        logging.debug("Live map %s: %s" % (self.address_string(), format % args))
+
+
+def step_etag(step, row):
+    """
+    :param step: the step
+    :param row: summary of the step (see OverviewDatabase.get_step_summaries)
+    :return: ETag of the positions of the step
+    """
+    return '"step-%d-%d-%d"' % (step, row["positions"], row["last_timestamp"])
+
+
+def not_modified(request_headers, etag, last_modified):
+    """
+    :param request_headers: headers of the request
+    :param etag: ETag of the current version of the resource
+    :param last_modified: timestamp of the current version of the resource
+    :return: True if the version of the client is the current one (If-Modified-Since is only used without
+        If-None-Match)
+    """
+    if_none_match = request_headers.get("If-None-Match")
+    if if_none_match is not None:
+        return if_none_match.strip() == "*" or etag in [tag.strip() for tag in if_none_match.split(",")]
+    if_modified_since = request_headers.get("If-Modified-Since")
+    if if_modified_since is None:
+        return False
+    try:
+        return parsedate_to_datetime(if_modified_since).timestamp() >= last_modified
+    except (TypeError, ValueError):
+        return False
+
+
+def error_response(status, message):
+    """
+    :param status: HTTPStatus of the error
+    :param message: description of the error
+    :return: status, headers, JSON body of the error
+    """
+    return status, {"Content-Type": "application/json", "Cache-Control": "no-store"}, \
+        json.dumps({"error": message}).encode()
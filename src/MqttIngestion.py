@@ -0,0 +1,253 @@
+import time
+import asyncio
+import logging
+
+aiomqtt = None  # Imported on first use, see load_aiomqtt
+
+# Topics published by the vehicle, one message per measure: <topic_prefix><measure>
+gps_measures = ["latitude", "longitude", "altitude", "speed"]
+
+
+def load_aiomqtt():
+    """
+    Import aiomqtt (optional dependency) the first time it is needed
+    :return: the aiomqtt module
+    """
+    global aiomqtt
+    if aiomqtt is None:
+        try:
+            import aiomqtt
+        except ImportError:
+            raise ImportError("The MQTT ingestion needs aiomqtt, install it with 'pip install aiomqtt'")
+    return aiomqtt
+
+
+async def subscribe(host, port=1883, username=None, password=None, topic_prefix="gps_measure/", clock=time.time):
+    """
+    Messages of the gps_measure topics of an MQTT broker
+    :param host: host of the broker
+    :param port: port of the broker
+    :param username: user of the broker (anonymous if None)
+    :param password: password of the user
+    :param topic_prefix: prefix of the gps_measure topics
+    :param clock: time of the reception of the messages (the messages are not timestamped, as with Telegraf)
+    :return: async generator of (topic, payload, timestamp)
+    """
+    mqtt = load_aiomqtt()
+    async with mqtt.Client(host, port, username=username or None, password=password or None) as client:
+        await client.subscribe(topic_prefix + "#", qos=1)
+        async for message in client.messages:
+            yield message.topic.value, message.payload, clock()
+
+
+class InProcessBroker:
+    """In-process stand-in of an MQTT broker, for the tests and the benchmarks. The publishers wait when the
+    queue is full, as with the flow control of a broker.
+    Usage:
+     broker = InProcessBroker()
+     await broker.publish("gps_measure/latitude", b"48.85", timestamp)
+     await broker.close()  (the subscriber stops once the published messages are consumed)
+     await MqttIngestion(trip_data).run(broker.subscribe())"""
+
+    def __init__(self, maxsize=0):
+        """
+        Initiation
+        :param maxsize: maximal number of pending messages (unbounded if 0)
+        """
+        self.queue = asyncio.Queue(maxsize)
+
+    async def publish(self, topic, payload, timestamp=None):
+        """
+        :param topic: topic of the message
+        :param payload: payload of the message (bytes or str)
+        :param timestamp: time of the reception of the message (now if None)
+        """
+        await self.queue.put((topic, payload, time.time() if timestamp is None else timestamp))
+
+    async def close(self):
+        """ End the subscriptions once the published messages are consumed """
+        await self.queue.put(None)
+
+    async def subscribe(self, topic_prefix="gps_measure/"):
+        """
+        :param topic_prefix: prefix of the topics to receive
+        :return: async generator of (topic, payload, timestamp)
+        """
+        while True:
+            message = await self.queue.get()
+            if message is None:
+                return
+            if message[0].startswith(topic_prefix):
+                yield message
+
+
+class FixAssembler:
+    """This class assembles the fixes (one position per resampling period) from the separate messages of the
+    gps_measure topics, as the grouped InfluxDB query of retrieve_influxdb_data does: mean of each measure per period,
+    a missing measure takes its previous value. A period is closed once a message is join_window seconds past its end,
+    the messages of a closed period are late and dropped. The fixes are then deduplicated: same coordinates as the
+    previous fix, or parked (speed < 1) after a parked fix.
+    Usage:
+     assembler = FixAssembler(resampling=5, join_window=10)
+     fixes = assembler.add("latitude", 48.85, timestamp)  (list of (timestamp, latitude, longitude, altitude, speed))
+     fixes = assembler.flush()  (close all the periods)"""
+
+    def __init__(self, resampling=5, join_window=10, closed_until=None):
+        """
+        Initiation
+        :param resampling: duration of the periods in seconds (GROUP BY time of retrieve_influxdb_data)
+        :param join_window: seconds waited after the end of a period for its late messages
+        :param closed_until: the periods before this timestamp are closed (ex: last committed position + 1)
+        """
+        self.resampling = resampling
+        self.join_window = join_window
+        self.closed_until = closed_until
+        self.periods = {}  # {period start: {measure: [sum, count]}}
+        self.previous_values = {}
+        self.last_fix = None
+        self.late_messages = 0
+
+    def add(self, measure, value, timestamp):
+        """
+        Add the value of a measure
+        :param measure: one of gps_measures
+        :param value: value of the measure
+        :param timestamp: time of the message
+        :return: list of the fixes of the periods closed by this message
+        """
+        period = int(timestamp // self.resampling * self.resampling)
+        if self.closed_until is not None and period < self.closed_until:
+            self.late_messages += 1
+            return []
+        total = self.periods.setdefault(period, {}).setdefault(measure, [0.0, 0])
+        total[0] += value
+        total[1] += 1
+        return self.close(timestamp - self.join_window)
+
+    def close(self, until):
+        """
+        Close the periods ended before a time (ex: no message received for a while)
+        :param until: timestamp
+        :return: list of the fixes of the closed periods
+        """
+        fixes = []
+        for period in sorted(self.periods):
+            if period + self.resampling > until:
+                break
+            means = {measure: total[0] / total[1] for measure, total in self.periods.pop(period).items()}
+            self.previous_values.update(means)
+            self.closed_until = period + self.resampling
+            if len(self.previous_values) < len(gps_measures):
+                continue
+            fix = (period, *(self.previous_values[measure] for measure in gps_measures))
+            if self.last_fix is not None and (fix[1:3] == self.last_fix[1:3]
+                                              or (fix[4] < 1.0 and self.last_fix[4] < 1.0)):
+                continue
+            self.last_fix = fix
+            fixes.append(fix)
+        return fixes
+
+    def flush(self):
+        """
+        :return: list of the fixes of all the open periods
+        """
+        return self.close(float("inf"))
+
+
+class MqttIngestion:
+    """This class ingests the gps_measure messages into the overview database as they arrive: the fixes are
+    assembled (FixAssembler) and committed with commit_position, batched by the write-behind buffer of the database
+    (buffer_size and flush_interval of OverviewDatabase). The reception and the assembling are decoupled by a bounded
+    queue: when the database falls behind, the reception waits (backpressure on the broker).
+    Usage:
+     trip_data = OverviewDatabase(buffer_size=100, flush_interval=30)
+     ingestion = MqttIngestion(trip_data)
+     await ingestion.run(subscribe("localhost"))"""
+
+    def __init__(self, trip_data, resampling=5, join_window=10, queue_size=1000, tick_interval=1.0,
+                 topic_prefix="gps_measure/", clock=time.time):
+        """
+        Initiation
+        :param trip_data: connected OverviewDatabase, buffer_size > 0 to batch the writes
+        :param resampling: duration in seconds of the periods of the fixes (see FixAssembler)
+        :param join_window: seconds waited for the late messages of a period (see FixAssembler)
+        :param queue_size: maximal number of received messages waiting to be assembled
+        :param tick_interval: seconds without message after which the ended periods are closed and the buffer of the
+            database is flushed if due
+        :param topic_prefix: prefix of the gps_measure topics
+        :param clock: current time, to close the periods when no message is received
+        """
+        self.trip_data = trip_data
+        self.queue_size = queue_size
+        self.tick_interval = tick_interval
+        self.topic_prefix = topic_prefix
+        self.clock = clock
+        summary = trip_data.get_trip_summary()
+        # The positions already committed are not assembled again
+        closed_until = summary["last_timestamp"] + 1 if summary and summary["last_timestamp"] is not None else None
+        self.assembler = FixAssembler(resampling, join_window, closed_until)
+        self.current_step = trip_data.get_last_step()
+        self.stats = {"messages": 0, "invalid_messages": 0, "fixes": 0, "max_queue": 0}
+
+    async def run(self, messages):
+        """
+        Ingest until the messages end or the task is cancelled, the assembled fixes are then committed. The error of
+        the messages (ex: aiomqtt.MqttError when the connection is lost) is raised once they are committed.
+        :param messages: async iterator of (topic, payload, timestamp), ex: subscribe(...) or InProcessBroker
+        :return: stats: messages, invalid_messages, late_messages, fixes and max_queue
+        """
+        queue = asyncio.Queue(self.queue_size)
+        receiver = asyncio.create_task(self._receive(messages, queue))
+        try:
+            await self._consume(queue)
+            # Raises the error of the reception (ex: connection lost)
+            await receiver
+        finally:
+            receiver.cancel()
+            self._commit(self.assembler.flush())
+            self.trip_data.flush()
+            self.stats["late_messages"] = self.assembler.late_messages
+        return self.stats
+
+    async def _receive(self, messages, queue):
+        try:
+            async for message in messages:
+                # Waits when the queue is full
+                await queue.put(message)
+                self.stats["max_queue"] = max(self.stats["max_queue"], queue.qsize())
+        except asyncio.CancelledError:
+            raise
+        except Exception:
+            # The consumer stops once the received messages are assembled, run raises the error
+            await queue.put(None)
+            raise
+        await queue.put(None)
+
+    async def _consume(self, queue):
+        while True:
+            try:
+                message = await asyncio.wait_for(queue.get(), self.tick_interval)
+            except asyncio.TimeoutError:
+                self._commit(self.assembler.close(self.clock() - self.assembler.join_window))
+                self.trip_data.flush_if_due()
+                continue
+            if message is None:
+                return
+            topic, payload, timestamp = message
+            self.stats["messages"] += 1
+            measure = topic[len(self.topic_prefix):]
+            try:
+                value = float(payload.decode() if isinstance(payload, (bytes, bytearray)) else payload)
+            except ValueError:
+                value = None
+            if measure not in gps_measures or value is None:
+                self.stats["invalid_messages"] += 1
+                logging.warning("Invalid message on %s: %r" % (topic, payload))
+                continue
+            self._commit(self.assembler.add(measure, value, timestamp))
+
+    def _commit(self, fixes):
+        for timestamp, latitude, longitude, altitude, speed in fixes:
+            self.trip_data.commit_position(timestamp, latitude, longitude, altitude, speed,
+                                           current_step=self.current_step)
+        self.stats["fixes"] += len(fixes)
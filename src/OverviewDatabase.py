@@ -1,31 +1,306 @@
 import sqlite3
 from sqlite3 import Error
-from sqlalchemy import create_engine
+import numpy as np
 import pandas as pd
-import geojson
 import os
-import io
-import math
-import reverse_geocoder
+import re
+import time
+import calendar
+import itertools
+from geodesy import EARTH_RADIUS_KM, haversine, consecutive_distance, detect_stays, route_deviation
+from CountryResolver import get_country_resolver
+from ColumnarArchive import ColumnarArchive, concat_positions
+from instrumentation import span
 
 
 def distance(origin, destination):
     """
-    Haversine formula example in Python
-    Author: Wayne Dyck
-    https://gist.github.com/rochacbruno/2883505
+    Haversine distance in km between two gps positions
+    :param origin: [latitude, longitude]
+    :param destination: [latitude, longitude]
     """
     latitude1, longitude1 = origin
     latitude2, longitude2 = destination
-    radius = 6371  # earth radius in km
+    return float(haversine(latitude1, longitude1, latitude2, longitude2))
 
-    diff_latitude = math.radians(latitude2-latitude1)
-    diff_longitude = math.radians(longitude2-longitude1)
-    a = math.sin(diff_latitude/2) * math.sin(diff_latitude/2) + math.cos(math.radians(latitude1)) \
-        * math.cos(math.radians(latitude2)) * math.sin(diff_longitude/2) * math.sin(diff_longitude/2)
-    c = 2 * math.atan2(math.sqrt(a), math.sqrt(1-a))
-    d = radius * c
-    return d
+
+trip_data_columns = ["timestamp", "latitude", "longitude", "altitude", "speed", "km", "current_country", "current_step"]
+insert_trip_data_stmt = (
+    "INSERT INTO trip_data (timestamp, latitude, longitude, altitude, speed, km, current_country, current_step) "
+    "VALUES (?, ?, ?, ?, ?, ?, ?, ?)"
+)
+
+
+def create_trip_table_query(table_name="trip_data"):
+    """
+    :param table_name: name of the table, can be prefixed by a schema (ex: archive_2021.trip_data_2021_06)
+    :return: the query creating a trip_data table if it does not exist
+    """
+    return f"""
+        CREATE TABLE IF NOT EXISTS {table_name}(
+            timestamp INTEGER NOT NULL,
+            latitude NUMERIC (5, 2) NOT NULL CHECK (latitude>= -90.0 AND latitude<= 90.0),
+            longitude NUMERIC (5, 2) NOT NULL CHECK (longitude>= -180.0 AND longitude<= 180.0),
+            altitude NUMERIC(7, 2) NOT NULL,
+            speed NUMERIC(6, 2) NOT NULL,
+            km INTEGER NOT NULL CHECK (km>= 0.0),
+            current_country TEXT NOT NULL,
+            current_step INTEGER NOT NULL CHECK (current_step>= 0),
+            PRIMARY KEY(timestamp)
+        );
+        """
+
+
+# Compact storage: the positions are stored as fixed-point integers in trip_data_compact (SQLite stores an integer
+# on 1 to 8 bytes according to its value: 4 bytes for the micro-degrees, 2 bytes for the altitude and the speed)
+# and the country as the id of its name in country_dictionary. trip_data is a view decoding them.
+# Resolution: 0.11 m for the latitude and longitude, 0.5 m for the altitude (up to 16383 m), 0.01 km/h for the speed
+# (up to 327 km/h) and 10 m for the km
+compact_scales = {"latitude": 1000000, "longitude": 1000000, "altitude": 2, "speed": 100, "km": 100}
+create_compact_tables_queries = [
+    """
+    CREATE TABLE IF NOT EXISTS country_dictionary(
+        id INTEGER PRIMARY KEY,
+        name TEXT NOT NULL UNIQUE
+    );
+    """,
+    """
+    CREATE TABLE IF NOT EXISTS trip_data_compact(
+        timestamp INTEGER NOT NULL,
+        latitude INTEGER NOT NULL CHECK (latitude>= -90000000 AND latitude<= 90000000),
+        longitude INTEGER NOT NULL CHECK (longitude>= -180000000 AND longitude<= 180000000),
+        altitude INTEGER NOT NULL CHECK (altitude>= -32768 AND altitude<= 32767),
+        speed INTEGER NOT NULL CHECK (speed>= -32768 AND speed<= 32767),
+        km INTEGER NOT NULL CHECK (km>= 0),
+        country_id INTEGER NOT NULL REFERENCES country_dictionary(id),
+        current_step INTEGER NOT NULL CHECK (current_step>= 0),
+        PRIMARY KEY(timestamp)
+    );
+    """,
+    """
+    CREATE VIEW IF NOT EXISTS trip_data AS
+    SELECT timestamp, latitude / 1000000.0 AS latitude, longitude / 1000000.0 AS longitude, altitude / 2.0 AS altitude,
+           speed / 100.0 AS speed, km / 100.0 AS km, country_dictionary.name AS current_country, current_step
+    FROM trip_data_compact JOIN country_dictionary ON country_dictionary.id = trip_data_compact.country_id
+    """,
+]
+insert_compact_stmt = (
+    "INSERT INTO trip_data_compact (timestamp, latitude, longitude, altitude, speed, km, country_id, current_step) "
+    "VALUES (?, ?, ?, ?, ?, ?, ?, ?)"
+)
+# Conversion of an existing trip_data table (convert_to_compact), the countries are numbered by first appearance
+convert_to_compact_queries = [
+    "INSERT OR IGNORE INTO country_dictionary (name) "
+    "SELECT current_country FROM trip_data GROUP BY current_country ORDER BY MIN(timestamp)",
+    "INSERT INTO trip_data_compact SELECT timestamp, "
+    + ", ".join(f"CAST(ROUND({column} * {scale}) AS INTEGER)" for column, scale in compact_scales.items())
+    + ", country_dictionary.id, current_step "
+      "FROM trip_data JOIN country_dictionary ON country_dictionary.name = trip_data.current_country",
+    "DROP INDEX IF EXISTS trip_data_step_index",
+    "DROP TABLE trip_data",
+    "CREATE INDEX IF NOT EXISTS trip_data_step_index ON trip_data_compact(current_step, timestamp)",
+]
+
+
+# Monthly partitions (partitioned storage): tables trip_data_YYYY_MM, in the main database for the recent months
+# and in one archive database per year (<database>_archive_YYYY.db) for the archived ones
+partition_pattern = re.compile(r"^trip_data_(\d{4})_(\d{2})$")
+
+
+def partition_month(timestamp):
+    """
+    :param timestamp: unix timestamp
+    :return: the month (UTC) of the partition of the timestamp, ex: "2021_06"
+    """
+    return time.strftime("%Y_%m", time.gmtime(int(timestamp)))
+
+
+def partition_bounds(month):
+    """
+    :param month: month of the partition, ex: "2021_06"
+    :return: first timestamp of the month, first timestamp of the next month
+    """
+    year, month_number = int(month[:4]), int(month[5:])
+    next_year, next_month = (year + 1, 1) if month_number == 12 else (year, month_number + 1)
+    return calendar.timegm((year, month_number, 1, 0, 0, 0)), calendar.timegm((next_year, next_month, 1, 0, 0, 0))
+
+
+# Values of PRAGMA journal_mode and PRAGMA synchronous accepted by the journal_mode and synchronous options
+journal_modes = ["DELETE", "TRUNCATE", "PERSIST", "MEMORY", "WAL", "OFF"]
+synchronous_levels = ["OFF", "NORMAL", "FULL", "EXTRA"]
+
+# Trip summary, maintained on insert so that describe_trip and the legend do not read the positions
+create_summary_tables_queries = [
+    """
+    CREATE TABLE IF NOT EXISTS trip_summary(
+        id INTEGER PRIMARY KEY CHECK (id = 1),
+        first_timestamp INTEGER NOT NULL,
+        last_timestamp INTEGER NOT NULL,
+        total_km NUMERIC NOT NULL,
+        positions INTEGER NOT NULL
+    );
+    """,
+    """
+    CREATE TABLE IF NOT EXISTS trip_summary_countries(
+        country TEXT PRIMARY KEY,
+        first_timestamp INTEGER NOT NULL
+    );
+    """,
+    """
+    CREATE TABLE IF NOT EXISTS trip_summary_steps(
+        step INTEGER PRIMARY KEY,
+        first_timestamp INTEGER NOT NULL,
+        last_timestamp INTEGER NOT NULL,
+        first_km NUMERIC NOT NULL,
+        last_km NUMERIC NOT NULL,
+        positions INTEGER NOT NULL
+    );
+    """,
+]
+# The total km and the km of the steps are the ones of their last (first) position, even if the positions are
+# not inserted in order
+upsert_summary_stmt = """
+    INSERT INTO trip_summary (id, first_timestamp, last_timestamp, total_km, positions) VALUES (1, ?, ?, ?, ?)
+    ON CONFLICT(id) DO UPDATE SET
+        total_km = CASE WHEN excluded.last_timestamp > last_timestamp THEN excluded.total_km ELSE total_km END,
+        first_timestamp = MIN(first_timestamp, excluded.first_timestamp),
+        last_timestamp = MAX(last_timestamp, excluded.last_timestamp),
+        positions = positions + excluded.positions
+    """
+upsert_summary_country_stmt = """
+    INSERT INTO trip_summary_countries (country, first_timestamp) VALUES (?, ?)
+    ON CONFLICT(country) DO UPDATE SET first_timestamp = MIN(first_timestamp, excluded.first_timestamp)
+    """
+upsert_summary_step_stmt = """
+    INSERT INTO trip_summary_steps (step, first_timestamp, last_timestamp, first_km, last_km, positions)
+    VALUES (?, ?, ?, ?, ?, ?)
+    ON CONFLICT(step) DO UPDATE SET
+        first_km = CASE WHEN excluded.first_timestamp < first_timestamp THEN excluded.first_km ELSE first_km END,
+        last_km = CASE WHEN excluded.last_timestamp > last_timestamp THEN excluded.last_km ELSE last_km END,
+        first_timestamp = MIN(first_timestamp, excluded.first_timestamp),
+        last_timestamp = MAX(last_timestamp, excluded.last_timestamp),
+        positions = positions + excluded.positions
+    """
+# Same values computed from the positions (rebuild, or databases without summary)
+select_summary_query = """
+    SELECT * FROM (SELECT MIN(timestamp), MAX(timestamp),
+                          (SELECT km FROM trip_data ORDER BY timestamp DESC LIMIT 1), COUNT(*) AS positions
+                   FROM trip_data) WHERE positions > 0
+    """
+select_summary_countries_query = "SELECT current_country, MIN(timestamp) FROM trip_data GROUP BY current_country"
+select_summary_steps_query = """
+    SELECT steps.current_step, steps.first_timestamp, steps.last_timestamp, first.km, last.km, steps.positions
+    FROM (SELECT current_step, MIN(timestamp) AS first_timestamp, MAX(timestamp) AS last_timestamp,
+                 COUNT(*) AS positions
+          FROM trip_data GROUP BY current_step) AS steps
+    JOIN trip_data AS first ON first.timestamp = steps.first_timestamp
+    JOIN trip_data AS last ON last.timestamp = steps.last_timestamp
+    """
+fill_summary_queries = [
+    "INSERT INTO trip_summary (id, first_timestamp, last_timestamp, total_km, positions) SELECT 1, * FROM ("
+    + select_summary_query + ")",
+    "INSERT INTO trip_summary_countries (country, first_timestamp) " + select_summary_countries_query,
+    "INSERT INTO trip_summary_steps (step, first_timestamp, last_timestamp, first_km, last_km, positions) "
+    + select_summary_steps_query,
+]
+
+# Stays detected by update_sleeping_locations, and the detection state: the positions before the checkpoint are
+# processed, and the thresholds used (see geodesy.detect_stays)
+create_sleeping_locations_tables_queries = [
+    """
+    CREATE TABLE IF NOT EXISTS sleeping_locations(
+        arrival INTEGER NOT NULL,
+        departure INTEGER NOT NULL,
+        latitude NUMERIC NOT NULL,
+        longitude NUMERIC NOT NULL,
+        altitude NUMERIC NOT NULL,
+        positions INTEGER NOT NULL,
+        current_step INTEGER NOT NULL,
+        PRIMARY KEY(arrival)
+    );
+    """,
+    """
+    CREATE TABLE IF NOT EXISTS sleeping_locations_state(
+        id INTEGER PRIMARY KEY CHECK (id = 1),
+        checkpoint INTEGER NOT NULL,
+        radius NUMERIC NOT NULL,
+        min_dwell INTEGER NOT NULL,
+        max_speed NUMERIC NOT NULL
+    );
+    """,
+]
+sleeping_locations_columns = ["arrival", "departure", "latitude", "longitude", "altitude", "positions", "current_step"]
+# Default thresholds of the stay detection: 100 m, 4 hours, 1 km/h
+stay_detection_defaults = {"radius": 100.0, "min_dwell": 4 * 3600, "max_speed": 1.0}
+
+# Planned routes (GPX, KML) imported with import_route, the points of a segment are joined in the order of point
+create_planned_route_table_query = """
+    CREATE TABLE IF NOT EXISTS planned_route(
+        route TEXT NOT NULL,
+        point INTEGER NOT NULL,
+        segment INTEGER NOT NULL,
+        latitude NUMERIC NOT NULL,
+        longitude NUMERIC NOT NULL,
+        altitude NUMERIC,
+        PRIMARY KEY(route, point)
+    );
+    """
+planned_route_columns = ["route", "point", "segment", "latitude", "longitude", "altitude"]
+
+# R*Tree spatial index (SQLite rtree module): one box per block of spatial_block_seconds of positions (the bounds of
+# their latitude, longitude and timestamp), maintained by _insert_rows, and one box per sleeping location, maintained
+# by triggers. An R*Tree insertion costs more than the insertion of the position, hence the blocks. The boxes are
+# stored as 32-bit floats rounded outwards, the index gives candidates that are then filtered on the exact values.
+spatial_block_seconds = 300
+create_spatial_index_queries = [
+    "CREATE VIRTUAL TABLE IF NOT EXISTS trip_data_rtree USING rtree(id, min_latitude, max_latitude, min_longitude, "
+    "max_longitude, min_timestamp, max_timestamp)",
+    "CREATE VIRTUAL TABLE IF NOT EXISTS sleeping_locations_rtree USING rtree(id, min_latitude, max_latitude, "
+    "min_longitude, max_longitude, min_timestamp, max_timestamp)",
+] + [
+    f"CREATE TRIGGER IF NOT EXISTS sleeping_locations_rtree_{event.split()[0].lower()} AFTER {event} "
+    f"ON sleeping_locations BEGIN {action} END"
+    for event, action in [
+        ("INSERT", "INSERT OR REPLACE INTO sleeping_locations_rtree VALUES (NEW.arrival, NEW.latitude, NEW.latitude, "
+                   "NEW.longitude, NEW.longitude, NEW.arrival, NEW.departure);"),
+        ("UPDATE", "DELETE FROM sleeping_locations_rtree WHERE id = OLD.arrival; "
+                   "INSERT OR REPLACE INTO sleeping_locations_rtree VALUES (NEW.arrival, NEW.latitude, NEW.latitude, "
+                   "NEW.longitude, NEW.longitude, NEW.arrival, NEW.departure);"),
+        ("DELETE", "DELETE FROM sleeping_locations_rtree WHERE id = OLD.arrival;")]]
+
+
+def update_spatial_index_query(source="trip_data", scale=1):
+    """
+    :param source: table of the positions (trip_data_compact with the compact storage)
+    :param scale: scale of the stored coordinates (see compact_scales)
+    :return: the query (re)computing the boxes of the blocks of a time range (parameters: first and next timestamp)
+    """
+    coordinates = ", ".join(f"{function}({column}) / {float(scale)}" for column in ["latitude", "longitude"]
+                            for function in ["MIN", "MAX"])
+    return f"INSERT OR REPLACE INTO trip_data_rtree SELECT timestamp / {spatial_block_seconds}, {coordinates}, " \
+           f"MIN(timestamp), MAX(timestamp) FROM {source} WHERE timestamp >= ? AND timestamp < ? " \
+           f"GROUP BY timestamp / {spatial_block_seconds}"
+
+
+# Index of the existing rows (trip_data is a view with the compact storage)
+fill_spatial_index_queries = [
+    "DELETE FROM trip_data_rtree",
+    update_spatial_index_query().replace("WHERE timestamp >= ? AND timestamp < ? ", ""),
+    "DELETE FROM sleeping_locations_rtree",
+    "INSERT INTO sleeping_locations_rtree SELECT arrival, latitude, latitude, longitude, longitude, arrival, departure "
+    "FROM sleeping_locations",
+]
+
+# Schema migrations applied in order on connection, the version is stored in the database PRAGMA user_version
+schema_migrations = {
+    1: ["CREATE INDEX IF NOT EXISTS trip_data_step_index ON trip_data(current_step, timestamp)"],
+    2: create_summary_tables_queries + fill_summary_queries,
+    3: create_sleeping_locations_tables_queries,
+    4: [create_planned_route_table_query],
+    5: create_spatial_index_queries + fill_spatial_index_queries,
+}
+# Columns of the first versions of trip_data (before user_version was set), renamed before the migrations
+legacy_trip_columns = {"lat": "latitude", "lon": "longitude", "elev": "altitude"}
 
 
 class OverviewDatabase:
@@ -40,12 +315,66 @@ class OverviewDatabase:
     # Database instance
     database = None
     raw_data = None
+    raw_data_last_timestamp = None  # High-water mark of the cached raw_data
     kilometer_source = "GPS"  # Could be GPS (default) or ODO
+    # Write-behind buffer of commit_position (disabled if buffer_size is 0)
+    write_buffer = []
+    buffer_size = 0
+    # Monthly partitioned storage
+    partitioned = False
+    partitions = {}
+    # Fixed-point storage (trip_data_compact table and trip_data view)
+    compact = False
+    country_ids = {}  # country_dictionary cache, {name: id}
+    columnar_archive = None
+    summary_available = False  # The trip_summary tables exist and are maintained on insert
+    sleeping_locations_available = False  # The sleeping_locations tables exist
+    planned_route_available = False  # The planned_route table exists
+    spatial_indexes = set()  # Tables with a maintained R*Tree index (not trip_data with the partitioned storage)
 
-    def __init__(self, kilometer_source="GPS"):
-        """ Initiation """
+    def __init__(self, kilometer_source="GPS", buffer_size=0, flush_interval=None, flush_callback=None,
+                 journal_mode=None, synchronous=None, partitioned=None, archive_folder=None, compact=None):
+        """
+        Initiation
+        :param kilometer_source: GPS (default) or ODO
+        :param buffer_size: if > 0, commit_position queues the positions in memory and flushes them in one transaction
+            when the buffer reaches this number of rows
+        :param flush_interval: maximal age in seconds of the oldest buffered position before a flush
+            (checked on each commit_position or flush_if_due call)
+        :param flush_callback: called after each flush with (rows, latency in seconds, flush_stats)
+        :param journal_mode: SQLite journal mode set on connection: DELETE, TRUNCATE, PERSIST, MEMORY, WAL or OFF
+            (database default if None)
+        :param synchronous: SQLite synchronous level set on connection: OFF, NORMAL, FULL or EXTRA
+            (database default if None)
+        :param partitioned: store the positions in one table per month, trip_data is then a view of the partitions.
+            If None, the mode is detected from the existing database (not partitioned for a new database)
+        :param archive_folder: folder of the columnar archive (Arrow files of the closed days), the full loads of
+            query_raw_database read the archive and only the newer positions from SQLite
+        :param compact: store the positions as fixed-point integers and the countries in a dictionary table
+            (see compact_scales), trip_data is then a view decoding them. Only for a new database (see
+            convert_to_compact for an existing one), not with the partitioned storage. If None, the mode is detected
+            from the existing database
+        """
         self.raw_data = None
+        self.raw_data_last_timestamp = None
         self.kilometer_source = kilometer_source
+        self.write_buffer = []
+        self.write_buffer_since = None
+        self.buffer_size = buffer_size
+        self.flush_interval = flush_interval
+        self.flush_callback = flush_callback
+        self.flush_stats = {"flushes": 0, "rows": 0, "last_latency": 0.0, "max_latency": 0.0, "total_latency": 0.0}
+        self.journal_mode = journal_mode
+        self.synchronous = synchronous
+        self.partitioned = partitioned
+        self.partitions = {}
+        self.compact = compact
+        self.country_ids = {}
+        self.db_filepath = None
+        self.summary_available = False
+        self.sleeping_locations_available = False
+        self.spatial_indexes = set()
+        self.columnar_archive = ColumnarArchive(archive_folder) if archive_folder else None
 
     def __del__(self):
         # Close the database
@@ -59,31 +388,541 @@ class OverviewDatabase:
                 print("Creation not authorized -> aborting")
                 return
 
+        self.invalidate_raw_data()
         try:
             self.database = sqlite3.connect(db_filepath)
         except Error as e:
             print(e)
 
-        # Create the table is it does not exist
-        create_trip_table = """
-        CREATE TABLE IF NOT EXISTS trip_data(
-            timestamp INTEGER NOT NULL,
-            latitude NUMERIC (5, 2) NOT NULL CHECK (latitude>= -90.0 AND latitude<= 90.0),
-            longitude NUMERIC (5, 2) NOT NULL CHECK (longitude>= -180.0 AND longitude<= 180.0),
-            altitude NUMERIC(7, 2) NOT NULL,
-            speed NUMERIC(6, 2) NOT NULL,
-            km INTEGER NOT NULL CHECK (km>= 0.0),
-            current_country TEXT NOT NULL,
-            current_step INTEGER NOT NULL CHECK (current_step>= 0),
-            PRIMARY KEY(timestamp)
-        );
+        # Durability options
+        if self.journal_mode:
+            if str(self.journal_mode).upper() in journal_modes:
+                self.execute_query(query=f"PRAGMA journal_mode = {str(self.journal_mode).upper()}", mode="single")
+            else:
+                print(f"The journal mode '{self.journal_mode}' is not within {journal_modes}")
+        if self.synchronous:
+            if str(self.synchronous).upper() in synchronous_levels:
+                self.execute_query(query=f"PRAGMA synchronous = {str(self.synchronous).upper()}", mode="single")
+            else:
+                print(f"The synchronous level '{self.synchronous}' is not within {synchronous_levels}")
+
+        # Partitioned storage
+        self.db_filepath = db_filepath
+        if self.partitioned is None:
+            tables = self._table_names()
+            self.partitioned = "trip_data" not in tables and any(partition_pattern.match(table) for table in tables)
+        if self.partitioned:
+            self.load_partitions()
+            if create and "trip_summary" not in self._table_names():
+                self.rebuild_summary()
+            if create:
+                for query in create_sleeping_locations_tables_queries + [create_planned_route_table_query] \
+                        + create_spatial_index_queries[1:]:
+                    self.execute_query(query=query, mode="single")
+        else:
+            tables = self._table_names()
+            if "trip_data" in tables or "trip_data_compact" in tables:
+                # The storage of an existing database is kept
+                if self.compact and "trip_data" in tables:
+                    print("The positions are not stored compactly, see convert_to_compact")
+                self.compact = "trip_data_compact" in tables
+            else:
+                self.compact = bool(self.compact) and create
+            if self.compact:
+                for query in create_compact_tables_queries:
+                    self.execute_query(query=query, mode="single")
+                self._load_country_ids()
+            else:
+                # Create the table is it does not exist
+                create_trip_table = create_trip_table_query()
+                self.execute_query(query=create_trip_table, mode="single", create=create)
+            # Only upgrade the schema if the connection is allowed to create/modify the database
+            if create:
+                self.migrate_schema()
+        tables = self._table_names()
+        self.summary_available = "trip_summary" in tables
+        self.sleeping_locations_available = "sleeping_locations" in tables
+        self.planned_route_available = "planned_route" in tables
+        self.spatial_indexes = {table for table in ["trip_data", "sleeping_locations"] if f"{table}_rtree" in tables
+                                and not (self.partitioned and table == "trip_data")}
+
+    def migrate_schema(self):
+        """
+        Upgrade the schema of the database (indexes, tables) to the last version of schema_migrations
+        :return: the schema version of the database, None if the database is not initiated
+        """
+        if not self.database:
+            return None
+        try:
+            version = self.database.execute("PRAGMA user_version").fetchone()[0]
+        except Error as e:
+            print(f"The error '{e}' occurred")
+            return None
+        if version == 0 and not self.compact and not self._rename_legacy_columns():
+            return version
+        for migration_version in sorted(schema_migrations):
+            if migration_version <= version:
+                continue
+            for query in schema_migrations[migration_version]:
+                if self.compact:
+                    # The indexes of the positions are on the stored table
+                    query = query.replace(" ON trip_data(", " ON trip_data_compact(")
+                if not self.execute_query(query=query, mode="single"):
+                    print(f"Schema migration to version {migration_version} failed")
+                    return version
+            version = migration_version
+            self.execute_query(query=f"PRAGMA user_version = {version}", mode="single")
+        return version
+
+    def _rename_legacy_columns(self):
+        """
+        Rename the columns of a trip_data table created by the first versions (lat, lon, elev)
+        :return: False if a column could not be renamed
+        """
+        try:
+            columns = [row[1] for row in self.database.execute("PRAGMA table_info(trip_data)").fetchall()]
+        except Error as e:
+            print(f"The error '{e}' occurred")
+            return False
+        for legacy_column, column in legacy_trip_columns.items():
+            if legacy_column in columns and column not in columns:
+                if not self.execute_query(query=f"ALTER TABLE trip_data RENAME COLUMN {legacy_column} TO {column}",
+                                          mode="single"):
+                    print(f"The column {legacy_column} of trip_data could not be renamed to {column}")
+                    return False
+        return True
+
+    def _table_names(self, schema="main"):
+        """
+        :return: the names of the tables of a schema of the database
+        """
+        try:
+            return [row[0] for row in self.database.execute(
+                f"SELECT name FROM {schema}.sqlite_master WHERE type = 'table'").fetchall()]
+        except Error as e:
+            print(f"The error '{e}' occurred")
+            return []
+
+    def archive_filepath(self, year):
+        """
+        :param year: year of the archived partitions
+        :return: path of the archive database of this year
+        """
+        return os.path.splitext(self.db_filepath)[0] + f"_archive_{year}.db"
+
+    def _attach_archive(self, year):
+        """ Attach the archive database of a year (schema archive_YYYY) if it is not attached yet """
+        attached = [row[1] for row in self.database.execute("PRAGMA database_list").fetchall()]
+        if f"archive_{year}" not in attached:
+            self.database.execute("ATTACH DATABASE ? AS " + f"archive_{year}", (self.archive_filepath(year),))
+
+    def load_partitions(self):
+        """
+        Find the monthly partitions (main database and yearly archives) and create the temporary trip_data view
+        that unites them, so that the read methods work the same way as with the single table
+        """
+        self.partitions = {}
+        folder, stem = os.path.split(os.path.splitext(self.db_filepath)[0])
+        archive_pattern = re.compile("^" + re.escape(stem) + r"_archive_(\d{4})\.db$")
+        for filename in sorted(os.listdir(folder or ".")):
+            archive = archive_pattern.match(filename)
+            if archive:
+                self._attach_archive(archive.group(1))
+                for table in self._table_names(f"archive_{archive.group(1)}"):
+                    if partition_pattern.match(table):
+                        self.partitions[table[len("trip_data_"):]] = f"archive_{archive.group(1)}.{table}"
+        # The partitions of the main database take precedence (interrupted archiving)
+        for table in self._table_names():
+            if partition_pattern.match(table):
+                self.partitions[table[len("trip_data_"):]] = f"main.{table}"
+        self.partitions = dict(sorted(self.partitions.items()))
+        self._create_partition_view()
+
+    def _create_partition_view(self):
+        self.execute_query(query="DROP VIEW IF EXISTS temp.trip_data", mode="single")
+        self.execute_query(query="CREATE TEMP VIEW trip_data AS " + self._partition_source(), mode="single")
+
+    def _partition_source(self, start_timestamp=None, end_timestamp=None):
+        """
+        :return: a SQL select uniting the partitions that overlap the time range (bounds included)
+        """
+        selects = []
+        for month, table in self.partitions.items():
+            first_timestamp, next_timestamp = partition_bounds(month)
+            if (start_timestamp is None or start_timestamp < next_timestamp) \
+                    and (end_timestamp is None or end_timestamp >= first_timestamp):
+                selects.append("SELECT " + ", ".join(trip_data_columns) + " FROM " + table)
+        if not selects:
+            return "SELECT " + ", ".join("NULL AS " + column for column in trip_data_columns) + " WHERE 0"
+        return " UNION ALL ".join(selects)
+
+    def create_partition(self, month):
+        """
+        Create the partition of a month in the main database if it does not exist
+        :param month: ex: "2021_06"
+        """
+        if month in self.partitions:
+            return
+        self.execute_query(query=create_trip_table_query(f"main.trip_data_{month}"), mode="single")
+        self.execute_query(query=f"CREATE INDEX IF NOT EXISTS main.trip_data_{month}_step_index "
+                                 f"ON trip_data_{month}(current_step, timestamp)", mode="single")
+        self.partitions[month] = f"main.trip_data_{month}"
+        self.partitions = dict(sorted(self.partitions.items()))
+        self._create_partition_view()
+
+    def insert_positions(self, rows):
+        """
+        Insert positions, routed to their monthly partition with the partitioned storage, then update the sleeping
+        locations
+        :param rows: list of (timestamp, latitude, longitude, altitude, speed, km, current_country, current_step)
+        :return: success
+        """
+        # The stays are detected on write, the queries only read them. Checked before the insert, which can move
+        # the checkpoint back (see _rewind_sleeping_locations)
+        update_stays = self.database and len(rows) > 0 and self.sleeping_locations_available \
+            and self._may_change_stays(rows)
+        if not self.partitioned:
+            success = self._insert_rows("trip_data", rows)
+        else:
+            success = self._insert_partitions(rows)
+        if update_stays:
+            self.update_sleeping_locations()
+        return success
+
+    def _may_change_stays(self, rows):
+        """
+        :param rows: inserted positions
+        :return: False if the positions can not change the sleeping locations: moving positions newer than the stay
+            detection checkpoint end the static run before them, whose stay is already stored
+        """
+        state = self.database.execute("SELECT checkpoint, max_speed FROM sleeping_locations_state").fetchone()
+        return state is None or any(int(row[0]) < state[0] or float(row[4]) <= state[1] for row in rows)
+
+    def _insert_partitions(self, rows):
+        """ Insert positions in their monthly partitions, each month in its own transaction """
+        months = pd.to_datetime([int(row[0]) for row in rows], unit="s").strftime("%Y_%m")
+        success = True
+        for month in sorted(set(months)):
+            if month in self.partitions and not self.partitions[month].startswith("main."):
+                print(f"The partition {month} is archived, the positions are not committed")
+                success = False
+                continue
+            self.create_partition(month)
+            month_rows = [row for row, row_month in zip(rows, months) if row_month == month]
+            success &= self._insert_rows(f"trip_data_{month}", month_rows)
+        return success
+
+    def _insert_rows(self, table, rows):
+        """
+        Insert positions in a table and update the trip summary within the same transaction, the positions already
+        stored are skipped
+        :return: success, nothing is committed if an error occurred
+        """
+        if not self.database:
+            return False
+        if len(rows) == 0:
+            return True
+        try:
+            rows = self._new_rows(table, rows)
+            if len(rows) == 0:
+                return True
+            if self.compact and table == "trip_data":
+                encoded_rows, rows = self._encode_rows(rows)
+                self.database.executemany(insert_compact_stmt, encoded_rows)
+            else:
+                self.database.executemany(insert_trip_data_stmt.replace("INTO trip_data", f"INTO {table}"), rows)
+            if self.summary_available:
+                self._update_summary(rows)
+            if "trip_data" in self.spatial_indexes and table == "trip_data":
+                self._update_spatial_index(rows)
+            if self.sleeping_locations_available:
+                self._rewind_sleeping_locations(min(int(row[0]) for row in rows))
+            self.database.commit()
+        except Error as e:
+            self.database.rollback()
+            print(f"The error '{e}' occurred")
+            if self.compact:
+                # The countries added by the failed insert are rolled back
+                self._load_country_ids()
+            return False
+        return True
+
+    def _new_rows(self, table, rows):
+        """
+        Skip the positions already stored (overlapping windows, backfill run again) and the repeated timestamps of the
+        batch, the first one is kept: one duplicate does not roll back the whole insert and the summary only counts
+        the inserted positions
+        :return: list of the rows to insert, ordered by timestamp
+        """
+        new_rows = {}
+        for row in rows:
+            new_rows.setdefault(int(row[0]), row)
+        source = "trip_data_compact" if self.compact and table == "trip_data" else table
+        for (timestamp,) in self.database.execute(f"SELECT timestamp FROM {source} WHERE timestamp BETWEEN ? AND ?",
+                                                  (min(new_rows), max(new_rows))):
+            new_rows.pop(timestamp, None)
+        return [new_rows[timestamp] for timestamp in sorted(new_rows)]
+
+    def _update_spatial_index(self, rows):
+        """ Recompute the boxes of the blocks of the inserted rows, within the transaction of the insert """
+        timestamps = [int(row[0]) for row in rows]
+        first_block, last_block = min(timestamps) // spatial_block_seconds, max(timestamps) // spatial_block_seconds
+        query = update_spatial_index_query("trip_data_compact", compact_scales["latitude"]) if self.compact \
+            else update_spatial_index_query()
+        self.database.execute(query, (first_block * spatial_block_seconds, (last_block + 1) * spatial_block_seconds))
+
+    def _load_country_ids(self):
+        """ Read country_dictionary in the country_ids cache """
+        try:
+            self.country_ids = dict(self.database.execute("SELECT name, id FROM country_dictionary").fetchall())
+        except Error as e:
+            print(f"The error '{e}' occurred")
+            self.country_ids = {}
+
+    def _encode_rows(self, rows):
+        """
+        Fixed-point encoding of positions for trip_data_compact, the new countries are added to country_dictionary
+        (not committed)
+        :param rows: list of (timestamp, latitude, longitude, altitude, speed, km, current_country, current_step)
+        :return: list of the encoded rows, list of the rows with the values as they will be read (rounded)
+        """
+        if len(rows) == 0:
+            return [], []
+        columns = list(zip(*rows))
+        encoded = {"timestamp": np.asarray(columns[0], dtype=np.int64)}
+        for index, (column, scale) in enumerate(compact_scales.items(), start=1):
+            encoded[column] = np.rint(np.asarray(columns[index], dtype=np.float64) * scale).astype(np.int64)
+        countries = [str(country) for country in columns[6]]
+        for country in dict.fromkeys(countries):
+            if country not in self.country_ids:
+                self.country_ids[country] = self.database.execute(
+                    "INSERT INTO country_dictionary (name) VALUES (?)", (country,)).lastrowid
+        encoded["country_id"] = np.array([self.country_ids[country] for country in countries], dtype=np.int64)
+        encoded["current_step"] = np.asarray(columns[7], dtype=np.int64)
+        encoded_rows = list(zip(*(values.tolist() for values in encoded.values())))
+        decoded_rows = list(zip(encoded["timestamp"].tolist(),
+                                *((encoded[column] / scale).tolist() for column, scale in compact_scales.items()),
+                                countries, encoded["current_step"].tolist()))
+        return encoded_rows, decoded_rows
+
+    def _decode_positions(self, positions):
+        """
+        Decode positions read from trip_data_compact: the fixed-point columns to floats and country_id to the
+        categorical current_country
+        :param positions: pandas.DataFrame, modified
+        :return: the decoded pandas.DataFrame
+        """
+        for column, scale in compact_scales.items():
+            if column in positions:
+                positions[column] = positions[column] / scale
+        if "country_id" in positions:
+            country_ids = positions["country_id"].values.astype(np.int64)
+            if len(country_ids) and not set(np.unique(country_ids)) <= set(self.country_ids.values()):
+                # Countries added by another connection
+                self._load_country_ids()
+            names = sorted(self.country_ids, key=self.country_ids.get)
+            codes = np.full(max(self.country_ids.values(), default=0) + 1, -1)
+            codes[[self.country_ids[name] for name in names]] = np.arange(len(names))
+            positions["country_id"] = pd.Categorical.from_codes(codes[country_ids], categories=names)
+            positions = positions.rename(columns={"country_id": "current_country"})
+        return positions
+
+    def _update_summary(self, rows):
+        """
+        Add inserted positions to the trip summary (not committed)
+        :param rows: list of (timestamp, latitude, longitude, altitude, speed, km, current_country, current_step)
+        """
+        if len(rows) == 0:
+            return
+        # Plain python aggregation, most of the inserts are of a single position
+        positions = sorted((int(row[0]), float(row[5]), str(row[6]), int(row[7])) for row in rows)
+        self.database.execute(upsert_summary_stmt, (positions[0][0], positions[-1][0], positions[-1][1],
+                                                    len(positions)))
+        countries, steps = {}, {}
+        for timestamp, km, country, step in positions:
+            countries.setdefault(country, timestamp)
+            # first_timestamp, last_timestamp, first_km, last_km, positions
+            first_timestamp, _, first_km, _, step_positions = steps.get(step, [timestamp, 0, km, 0, 0])
+            steps[step] = [first_timestamp, timestamp, first_km, km, step_positions + 1]
+        self.database.executemany(upsert_summary_country_stmt, list(countries.items()))
+        self.database.executemany(upsert_summary_step_stmt, [(step, *step_summary)
+                                                             for step, step_summary in steps.items()])
+
+    def _rewind_sleeping_locations(self, timestamp):
+        """
+        Positions older than the stay detection checkpoint are inserted: move the checkpoint back to the last moving
+        position before them (the runs of static positions are not changed before it) and delete the stays after
+        it (not committed)
+        :param timestamp: first inserted timestamp
+        """
+        state = self.database.execute("SELECT checkpoint, max_speed FROM sleeping_locations_state").fetchone()
+        if state is None or timestamp >= state[0]:
+            return
+        moving_position = self.database.execute(
+            "SELECT timestamp FROM trip_data WHERE timestamp < ? AND speed > ? ORDER BY timestamp DESC LIMIT 1",
+            (timestamp, state[1])).fetchone()
+        checkpoint = moving_position[0] if moving_position else 0
+        self.database.execute("DELETE FROM sleeping_locations WHERE departure >= ?", (checkpoint,))
+        self.database.execute("UPDATE sleeping_locations_state SET checkpoint = ?", (checkpoint,))
+
+    def rebuild_summary(self):
+        """
+        Create the trip summary tables if needed and recompute them from all the positions
+        (databases created before the summary, or positions modified without commit_position/commit_dataframe)
+        :return: success
         """
-        self.execute_query(query=create_trip_table, mode="single", create=create)
+        if not self.database:
+            return False
+        self.flush()
+        try:
+            for query in create_summary_tables_queries:
+                self.database.execute(query)
+            for table in ["trip_summary", "trip_summary_countries", "trip_summary_steps"]:
+                self.database.execute(f"DELETE FROM {table}")
+            for query in fill_summary_queries:
+                self.database.execute(query)
+            self.database.commit()
+        except Error as e:
+            self.database.rollback()
+            print(f"The error '{e}' occurred")
+            return False
+        self.summary_available = True
+        return True
+
+    def rebuild_spatial_index(self):
+        """
+        Recompute the R*Tree index from all the positions and sleeping locations (positions modified without
+        commit_position/commit_dataframe)
+        :return: success
+        """
+        if not self.database or not self.spatial_indexes:
+            return False
+        self.flush()
+        try:
+            for table, queries in [("trip_data", fill_spatial_index_queries[:2]),
+                                   ("sleeping_locations", fill_spatial_index_queries[2:])]:
+                if table in self.spatial_indexes:
+                    for query in queries:
+                        self.database.execute(query)
+            self.database.commit()
+        except Error as e:
+            self.database.rollback()
+            print(f"The error '{e}' occurred")
+            return False
+        return True
+
+    def convert_to_compact(self, vacuum=True):
+        """
+        Migration tool: move the positions of the trip_data table to the compact storage (see compact_scales), the
+        trip summary is then recomputed from the rounded positions
+        :param vacuum: vacuum the database once converted, to release the space of the former table
+        :return: success
+        """
+        if not self.database or self.partitioned or "trip_data" not in self._table_names():
+            print("There is no trip_data table to convert")
+            return False
+        self.flush()
+        try:
+            self.database.execute("BEGIN")
+            # Dictionary and table, the positions, then the trip_data view
+            for query in create_compact_tables_queries[:2] + convert_to_compact_queries \
+                    + create_compact_tables_queries[2:]:
+                self.database.execute(query)
+            if "trip_data" in self.spatial_indexes:
+                # Boxes of the rounded positions
+                for query in fill_spatial_index_queries[:2]:
+                    self.database.execute(query)
+            self.database.commit()
+        except Error as e:
+            self.database.rollback()
+            print(f"The error '{e}' occurred")
+            return False
+        self.compact = True
+        self._load_country_ids()
+        self.invalidate_raw_data()
+        if self.summary_available:
+            self.rebuild_summary()
+        if vacuum:
+            self.execute_query(query="VACUUM", mode="single")
+        return True
+
+    def split_into_partitions(self):
+        """
+        Migration tool: move the positions of the single trip_data table into monthly partitions
+        :return: success
+        """
+        if not self.database or "trip_data" not in self._table_names():
+            print("There is no trip_data table to split")
+            return False
+        self.flush()
+        success, months = self.execute_read_query(
+            "SELECT DISTINCT strftime('%Y_%m', timestamp, 'unixepoch') FROM trip_data")
+        if not success:
+            return False
+        try:
+            # One transaction: the positions are either in trip_data or in the partitions
+            self.database.execute("BEGIN")
+            for (month,) in months:
+                first_timestamp, next_timestamp = partition_bounds(month)
+                self.database.execute(create_trip_table_query(f"main.trip_data_{month}"))
+                self.database.execute(f"CREATE INDEX IF NOT EXISTS main.trip_data_{month}_step_index "
+                                      f"ON trip_data_{month}(current_step, timestamp)")
+                self.database.execute(f"INSERT OR IGNORE INTO main.trip_data_{month} SELECT "
+                                      + ", ".join(trip_data_columns) + " FROM main.trip_data "
+                                      f"WHERE timestamp >= {first_timestamp} AND timestamp < {next_timestamp}")
+            self.database.execute("DROP TABLE main.trip_data")
+            # The spatial index is not maintained with the partitioned storage
+            self.database.execute("DROP TABLE IF EXISTS main.trip_data_rtree")
+            self.database.commit()
+        except Error as e:
+            self.database.rollback()
+            print(f"The error '{e}' occurred")
+            return False
+        self.partitioned = True
+        self.partitions = {}
+        self.spatial_indexes.discard("trip_data")
+        self.load_partitions()
+        self.invalidate_raw_data()
+        return True
+
+    def archive_partition(self, month, compact=True):
+        """
+        Move the partition of a past month to the archive database of its year, the current month is not locked
+        :param month: ex: "2021_06"
+        :param compact: vacuum the archive database once the partition is moved
+        :return: success
+        """
+        if not self.partitions.get(month, "").startswith("main."):
+            print(f"The partition {month} is not in the main database")
+            return False
+        if month == max(self.partitions):
+            print(f"The partition {month} is the current one, it can not be archived")
+            return False
+        self.flush()
+        year = month[:4]
+        self._attach_archive(year)
+        table = f"archive_{year}.trip_data_{month}"
+        self.execute_query(query=create_trip_table_query(table), mode="single")
+        self.execute_query(query=f"CREATE INDEX IF NOT EXISTS archive_{year}.trip_data_{month}_step_index "
+                                 f"ON trip_data_{month}(current_step, timestamp)", mode="single")
+        if not self.execute_query(query=f"INSERT OR IGNORE INTO {table} SELECT * FROM main.trip_data_{month}",
+                                  mode="single"):
+            return False
+        self.execute_query(query="DROP VIEW IF EXISTS temp.trip_data", mode="single")
+        self.execute_query(query=f"DROP TABLE main.trip_data_{month}", mode="single")
+        self.partitions[month] = table
+        self._create_partition_view()
+        if compact:
+            self.execute_query(query=f"VACUUM archive_{year}", mode="single")
+        return True
 
     def close_database(self):
-        """ Closes the database """
+        """ Flushes the buffered positions and closes the database """
+        if self.write_buffer:
+            self.flush()
         if self.database:
             self.database.close()
+        self.invalidate_raw_data()
 
     def execute_query(self, query, mode, create=False, data=None):
         """
@@ -114,10 +953,11 @@ class OverviewDatabase:
                 print(f"The error '{e}' occurred")
         return success
 
-    def execute_read_query(self, query):
+    def execute_read_query(self, query, quiet=False):
         """
         Read the database with a SQL query
         :param query: SQL query
+        :param quiet: do not print the result (frequent reads, ex: the summaries polled by the live map)
         :return: success, result : False if the database is not initiated or an error occurred
         """
         success = False
@@ -128,12 +968,13 @@ class OverviewDatabase:
                 cursor.execute(query)
                 result = cursor.fetchall()
                 success = True
-                print(f"Query '{query}' executed successfully and resulted '{result}'")
+                if not quiet:
+                    print(f"Query '{query}' executed successfully and resulted '{result}'")
             except Error as e:
                 print(f"The error '{e}' occurred")
         return success, result
 
-    def commit_dataframe(self, df: pd.DataFrame):
+    def commit_dataframe(self, df: pd.DataFrame, continue_km=False):
         """
         Commit position
         :param timestamp:
@@ -143,47 +984,29 @@ class OverviewDatabase:
         :param speed: speed of the vehicle
         :param km: kilometer traveled
         :param current_step: current step
+        :param continue_km: the km of the dataframe are relative to its first position (ex: a range retrieved from
+            InfluxDB), they are shifted to continue from the last position, as in commit_position
         :return:
         """
-        self.query_raw_database()
-
-        """compute km"""
-        # If the kilometer source is with the GPS delta positions
-        # TODO adapt to multiple rows
-        #if self.kilometer_source == "GPS" and not self.raw_data.empty:
-        #    if km != 0:
-        #        print("The parameter kilometer_source is GPS thus the variable km=", km, " is not considered")
-        #    km = round(self.raw_data["km"].iloc[-1] +
-        #               distance(self.raw_data[["latitude", "lon"]].iloc[-1].values, [latitude, lon]), 2)
-
         """which country is the vehicle"""
-        countries = []
-        rg = reverse_geocoder.RGeocoder(stream=io.StringIO(open('/home/rudloff/sources/CapsuleScripts/servers/trip-overview/data/reverse_geocoder.csv', encoding='utf-8').read()))
-        country_codes = pd.read_csv('/home/rudloff/sources/CapsuleScripts/servers/trip-overview/data/country_info.csv', index_col=0, error_bad_lines=False)
-        # Execute on gps coords every 6 hours TODO can be optimized
-        tmp_series = df["timestamp"].resample('6H').first().dropna() 
-        for timestamp in tmp_series:
-            tmp_latitude = df["latitude"].loc[df["timestamp"] == timestamp].values[0]
-            tmp_longitude = df["longitude"].loc[df["timestamp"] == timestamp].values[0]
-            countries.append(country_codes.loc[rg.query([(tmp_latitude, tmp_longitude)])[0]["cc"]]["Country"])
-        tmp_df = tmp_series.to_frame()
-        tmp_df["current_country"] = countries
-        tmp_df.drop(["timestamp"], axis=1, inplace=True)
-        df.set_index("timestamp")
-        df = pd.concat([df, tmp_df], axis=1)
-        df.fillna(method="bfill", inplace=True)
-        df.fillna(method="ffill", inplace=True)
-
-        insert_stmt = (
-            "INSERT INTO trip_data (timestamp, latitude, longitude, altitude, speed, km, current_country, current_step) "
-            "VALUES (?, ?, ?, ?, ?, ?, ?, ?)"
-        )
+        df = df.sort_values("timestamp")
+        """compute km"""
+        last_position = self._last_position() if continue_km and not df.empty else None
+        if last_position is not None:
+            first_position = df.iloc[0]
+            df = df.assign(km=df["km"] - first_position["km"] + last_position[2] + distance(
+                last_position[:2], [first_position["latitude"], first_position["longitude"]]))
+        with span("country_resolution", rows=len(df)):
+            df["current_country"] = get_country_resolver().assign(df["latitude"].values, df["longitude"].values)
 
         # Reorder the dataframe just in case
-        df = df[["timestamp", "latitude", "longitude", "altitude", "speed", "km", "current_country", "current_step"]]
+        df = df[trip_data_columns]
 
-        if not self.execute_query(query=insert_stmt, mode="multiple", data=df.values):
-            print("failed to be committed")
+        with span("sqlite_commit", rows=len(df)):
+            if not self.insert_positions(df.values):
+                print("failed to be committed")
+        if not df.empty:
+            self.invalidate_raw_data(older_than=df["timestamp"].min())
 
     def commit_position(self, timestamp, latitude, longitude, altitude, speed=-1, km=0, current_step=0):
         """
@@ -197,28 +1020,113 @@ class OverviewDatabase:
         :param current_step: current step
         :return:
         """
-        self.query_raw_database()
-
         """compute km"""
         # If the kilometer source is with the GPS delta positions
-        if self.kilometer_source == "GPS" and not self.raw_data.empty:
+        last_position = self._last_position()
+        if self.kilometer_source == "GPS" and last_position is not None:
             if km != 0:
                 print("The parameter kilometer_source is GPS thus the variable km=", km, " is not considered")
-            km = round(self.raw_data["km"].iloc[-1] +
-                       distance(self.raw_data[["latitude", "longitude"]].iloc[-1].values, [latitude, longitude]), 2)
+            km = round(last_position[2] + distance(last_position[:2], [latitude, longitude]), 2)
 
         """which country is the vehicle"""
-        rg = reverse_geocoder.RGeocoder(stream=io.StringIO(open('data/reverse_geocoder.csv', encoding='utf-8').read()))
-        country_codes = pd.read_csv('data/country_info.csv', index_col=0, error_bad_lines=False)
-        current_country = country_codes.loc[rg.query([(latitude, longitude)])[0]["cc"]]["Country"]
-
-        insert_stmt = (
-            "INSERT INTO trip_data (timestamp, latitude, longitude, altitude, speed, km, current_country, current_step) "
-            "VALUES (?, ?, ?, ?, ?, ?, ?, ?)"
-        )
-        if not self.execute_query(query=insert_stmt, mode="single",
-                              data=(timestamp, latitude, longitude, altitude, speed, km, current_country, current_step)):
-            print(f"Values '{timestamp, latitude, longitude, altitude, speed, km, current_country, current_step}' failed to be committed")
+        current_country = get_country_resolver().resolve(latitude, longitude)
+
+        values = (timestamp, latitude, longitude, altitude, speed, km, current_country, current_step)
+        if self.buffer_size > 0:
+            # Write-behind: the position is committed with the next flush
+            if not self.write_buffer:
+                self.write_buffer_since = time.time()
+            self.write_buffer.append(values)
+            self.flush_if_due()
+            return
+        if not self.insert_positions([values]):
+            print(f"Values '{values}' failed to be committed")
+        self.invalidate_raw_data(older_than=timestamp)
+
+    def _last_position(self):
+        """
+        :return: (latitude, longitude, km) of the last position, buffered or committed, None if there is none
+        """
+        if self.write_buffer:
+            return self.write_buffer[-1][1], self.write_buffer[-1][2], self.write_buffer[-1][5]
+        # One row through the timestamp index, the partitioned storage only reads its last partition
+        source = list(self.partitions.values())[-1] if self.partitioned and self.partitions else "trip_data"
+        success, result = self.execute_read_query(
+            f"SELECT latitude, longitude, km FROM {source} ORDER BY timestamp DESC LIMIT 1", quiet=True)
+        if not success or len(result) == 0:
+            return None
+        return result[0]
+
+    def flush_if_due(self):
+        """
+        Flush the buffered positions if the buffer is full or if the oldest one is older than flush_interval
+        :return: True if a flush happened
+        """
+        if not self.write_buffer:
+            return False
+        if len(self.write_buffer) >= self.buffer_size or (
+                self.flush_interval is not None and time.time() - self.write_buffer_since >= self.flush_interval):
+            return self.flush()
+        return False
+
+    def flush(self):
+        """
+        Commit the buffered positions with executemany in one transaction
+        :return: True if all the buffered positions are committed
+        """
+        if not self.write_buffer:
+            return True
+        rows, self.write_buffer, self.write_buffer_since = self.write_buffer, [], None
+        start_time = time.time()
+        success = self.insert_positions(rows)
+        if not success and self.database:
+            # Do not commit a partial batch, retry the positions one by one to only lose the failing ones
+            self.database.rollback()
+            for values in rows:
+                if not self.insert_positions([values]):
+                    print(f"Values '{values}' failed to be committed")
+        latency = time.time() - start_time
+        self.invalidate_raw_data(older_than=min(values[0] for values in rows))
+
+        self.flush_stats["flushes"] += 1
+        self.flush_stats["rows"] += len(rows)
+        self.flush_stats["last_latency"] = latency
+        self.flush_stats["max_latency"] = max(self.flush_stats["max_latency"], latency)
+        self.flush_stats["total_latency"] += latency
+        if self.flush_callback:
+            self.flush_callback(len(rows), latency, self.flush_stats)
+        return success
+
+    def get_trip_summary(self):
+        """
+        Summary of the trip, read from the trip_summary tables (computed from the positions if the database has none)
+        :return: dict of first_timestamp, last_timestamp, total_km, positions and countries ({country: timestamp of
+            the first position in the country}, ordered by entry), None if there is no position
+        """
+        self.flush()
+        if self.summary_available:
+            summary_query = ("SELECT first_timestamp, last_timestamp, total_km, positions FROM trip_summary "
+                             "WHERE id = 1")
+            countries_query = "SELECT country, first_timestamp FROM trip_summary_countries"
+        else:
+            summary_query, countries_query = select_summary_query, select_summary_countries_query
+        success, result = self.execute_read_query(summary_query, quiet=True)
+        if not success or len(result) == 0:
+            return None
+        summary = dict(zip(["first_timestamp", "last_timestamp", "total_km", "positions"], result[0]))
+        success, countries = self.execute_read_query(countries_query, quiet=True)
+        summary["countries"] = dict(sorted(countries or [], key=lambda country: country[1]))
+        return summary
+
+    def get_step_summaries(self):
+        """
+        :return: pandas.DataFrame of first_timestamp, last_timestamp, first_km, last_km and positions, indexed by step
+        """
+        self.flush()
+        query = "SELECT * FROM trip_summary_steps" if self.summary_available else select_summary_steps_query
+        columns = ["step", "first_timestamp", "last_timestamp", "first_km", "last_km", "positions"]
+        success, result = self.execute_read_query(query, quiet=True)
+        return pd.DataFrame(result or [], columns=columns).set_index("step").sort_index()
 
     def describe_trip(self):
         """
@@ -230,20 +1138,12 @@ class OverviewDatabase:
             for instance: (10, 2, 1405.14, "The current trip lasted 10 days, 2 country traveled to for a total of 1405.14 km")
         """
         total_duration = country_traveled = total_km_traveled = 0
-        self.query_raw_database()
-
-        """Compute the total duration"""
-        data_copy = self.raw_data.copy()
-        data_copy['date'] = data_copy["timestamp"].apply(
-            lambda x: pd.to_datetime(x, unit="s").date())
-        total_duration = (data_copy['date'].iloc[-1] - data_copy['date'].iloc[0]).days
-
-        """Compute the total km traveled"""
-        total_km_traveled = data_copy["km"].iloc[-1]
-
-        """Compute the number of country traveled"""
-        for i in range(1, len(data_copy[["latitude", "longitude"]])):
-            country_traveled = len(data_copy.drop_duplicates(subset=["current_country"])["current_country"])
+        summary = self.get_trip_summary()
+        if summary is not None:
+            # Number of UTC days between the first and the last positions
+            total_duration = summary["last_timestamp"] // 86400 - summary["first_timestamp"] // 86400
+            country_traveled = len(summary["countries"])
+            total_km_traveled = summary["total_km"]
 
         return (total_duration, country_traveled, total_km_traveled,
                 f"The current trip lasted {total_duration} days,"
@@ -253,25 +1153,149 @@ class OverviewDatabase:
         """
         :return: The last step. It will return 0 if the trip has not began
         """
-        # Retrieve raw position
-        self.query_raw_database()
-        # Copy current step raw data
-        # TODO avoid copying the entire dataframe
-        steps = self.raw_data.copy()
-
+        self.flush()
         last_step = 0
-        if len(steps) > 0:
+        success, result = self.execute_read_query(
+            "SELECT current_step FROM trip_data ORDER BY timestamp DESC LIMIT 1", quiet=True)
+        if success and len(result) > 0:
             # Get the last step
-            last_step = steps["current_step"].iloc[-1]
+            last_step = result[0][0]
         return last_step
 
+    def query_range(self, start_timestamp=None, end_timestamp=None, columns=None):
+        """
+        Query the positions within a time range, the filtering is done by the database
+        :param start_timestamp: first timestamp included (unbounded if None)
+        :param end_timestamp: last timestamp included (unbounded if None)
+        :param columns: list of the columns to retrieve (all by default)
+        :return: pandas.DataFrame of the positions ordered by timestamp, None if the query failed
+        """
+        conditions, parameters = [], []
+        if start_timestamp is not None:
+            conditions.append("timestamp >= ?")
+            parameters.append(int(start_timestamp))
+        if end_timestamp is not None:
+            conditions.append("timestamp <= ?")
+            parameters.append(int(end_timestamp))
+        source = None
+        if self.partitioned:
+            # Only read the partitions that overlap the time range
+            source = "(" + self._partition_source(start_timestamp, end_timestamp) + ")"
+        return self._query_positions(conditions, parameters, columns, source)
+
+    def query_step(self, step, columns=None):
+        """
+        Query the positions of one step (uses the current_step index)
+        :param step: the step
+        :param columns: list of the columns to retrieve (all by default)
+        :return: pandas.DataFrame of the positions ordered by timestamp, None if the query failed
+        """
+        return self._query_positions(["current_step = ?"], [int(step)], columns)
+
+    def query_steps(self, first_step, last_step, columns=None):
+        """
+        Query the positions of a range of steps (uses the current_step index)
+        :param first_step: first step included
+        :param last_step: last step included
+        :param columns: list of the columns to retrieve (all by default)
+        :return: pandas.DataFrame of the positions ordered by timestamp, None if the query failed
+        """
+        return self._query_positions(["current_step >= ?", "current_step <= ?"],
+                                     [int(first_step), int(last_step)], columns)
+
+    def _query_positions(self, conditions, parameters, columns=None, source=None, join=None):
+        self.flush()
+        if not self.database:
+            print("The database is not initiated")
+            return None
+        columns = columns or trip_data_columns
+        unknown_columns = [column for column in columns if column not in trip_data_columns]
+        if unknown_columns:
+            print(f"The columns '{unknown_columns}' are not in trip_data")
+            return None
+        if self.compact and source is None:
+            # The stored integers are decoded with numpy, faster than reading the trip_data view
+            source = "trip_data_compact"
+            columns = ["country_id" if column == "current_country" else column for column in columns]
+        query = "SELECT " + ", ".join(columns) + " FROM " + (source or "trip_data") + (" " + join if join else "")
+        if conditions:
+            query += " WHERE " + " AND ".join(conditions)
+        query += " ORDER BY timestamp"
+        try:
+            if source != "trip_data_compact":
+                return pd.read_sql_query(query, self.database, params=parameters)
+            # All the stored columns are integers: one int64 array instead of the per-value conversions of pandas
+            values = np.fromiter(itertools.chain.from_iterable(self.database.execute(query, parameters)),
+                                 dtype=np.int64).reshape(-1, len(columns))
+        except (Error, pd.io.sql.DatabaseError) as e:
+            print(f"The error '{e}' occurred")
+            return None
+        return self._decode_positions(pd.DataFrame(values, columns=columns))
+
     def query_raw_database(self):
         """
         Query the raw database and store it into a Pandas Dataframe
+        The dataframe is cached: only the rows newer than the last cached timestamp are read from the database
         :return: nothing but the object now store the raw_data
         """
+        self.flush()
         if self.database:
-            self.raw_data = pd.read_sql_query('''SELECT * from trip_data''', self.database)
+            if (self.raw_data is None or self.raw_data_last_timestamp is None) and self.columnar_archive is not None:
+                # The months with positions written at or before the last archived timestamp are read from SQLite
+                self.columnar_archive.check(self)
+                if self.columnar_archive.last_timestamp is not None:
+                    # Archive of the closed days (Arrow files), the newer positions are read below
+                    self.raw_data = self.columnar_archive.read()
+                    self.raw_data_last_timestamp = self.columnar_archive.last_timestamp
+            if self.raw_data is None or self.raw_data_last_timestamp is None:
+                self.raw_data = self._query_positions([], [])
+            else:
+                new_rows = self._query_positions(["timestamp > ?"], [int(self.raw_data_last_timestamp)])
+                if new_rows is not None and not new_rows.empty:
+                    self.raw_data = concat_positions([self.raw_data, new_rows])
+            if self.raw_data is not None and not self.raw_data.empty:
+                self.raw_data_last_timestamp = self.raw_data["timestamp"].iloc[-1]
+
+    def count_positions(self, until_timestamp, by_month=False):
+        """
+        Count the positions at or before a timestamp
+        :param until_timestamp: last counted timestamp
+        :param by_month: count the positions of each month
+        :return: number of positions, or dict month (YYYY_MM): number of positions if by_month, None if an error occurred
+        """
+        if not self.database:
+            return None
+        self.flush()
+        try:
+            if by_month:
+                return dict(self.database.execute(
+                    "SELECT strftime('%Y_%m', timestamp, 'unixepoch') AS month, COUNT(*) FROM trip_data "
+                    "WHERE timestamp <= ? GROUP BY month", (int(until_timestamp),)).fetchall())
+            return self.database.execute("SELECT COUNT(*) FROM trip_data WHERE timestamp <= ?",
+                                         (int(until_timestamp),)).fetchone()[0]
+        except Error as e:
+            print(f"The error '{e}' occurred")
+            return None
+
+    def refresh_raw_data(self):
+        """
+        Force a complete reload of the cached raw data from the database
+        :return: nothing but the object now store the raw_data
+        """
+        self.invalidate_raw_data()
+        self.query_raw_database()
+
+    def invalidate_raw_data(self, older_than=None):
+        """
+        Invalidate the cached raw data, the next query will reload the entire table
+        :param older_than: only invalidate if a row at or before this timestamp has been written
+            (rows newer than the high-water mark are fetched incrementally anyway)
+        """
+        if older_than is not None and self.raw_data_last_timestamp is not None \
+                and older_than > self.raw_data_last_timestamp:
+            return
+        self.raw_data = None
+        self.raw_data_last_timestamp = None
 
     def get_road_trip_gps_trace(self, speed_resampling=5, max_time_sampling=60):
         """
@@ -283,30 +1307,22 @@ class OverviewDatabase:
         """
         # Retrieve raw position
         self.query_raw_database()
-        # Copy current step raw data
-        # TODO avoid copying the entire dataframe
-        gps_trace = self.raw_data.copy()
-        # Change timestamp to datetime
-        gps_trace['date'] = pd.to_datetime(gps_trace['timestamp'], unit='s')
+        positions = self.raw_data
         # Resample by time and interpolat linearly TODO technical debt resample by time
         # gps_trace.resample(str(max_time_sampling)+"S", on="timestamp").mean()
-        # Remove the current index (the default one)
-        # Remove trace static traces
-        #gps_trace.drop(gps_trace[gps_trace.speed < 10.0].index, inplace=True) # TODO This is not needed anymore
-        gps_trace.reset_index(drop=True, inplace=True)
-        # Interpolate the correct columns
-        gps_trace[["latitude", "longitude", "altitude", "speed", "km"]] = gps_trace[["latitude", "longitude", "altitude", "speed", "km"]].interpolate(
-            method='linear')
-        # Fill forward current_country and current_step
-        gps_trace["current_country"].fillna(method='ffill', inplace=True)
-        gps_trace["current_step"].fillna(method='ffill', inplace=True)
-        # Reset the current_step type
-        gps_trace["current_step"] = gps_trace["current_step"].astype('int64')
-        # Set current_step as index
-        gps_trace = gps_trace.set_index(['current_step'])
+        interpolated = positions[["latitude", "longitude", "altitude", "speed", "km"]].interpolate(method='linear')
+        # Built from the columns of the cached raw data, which is neither copied nor modified. current_country and
+        # current_step are filled forward, current_step is the index.
+        gps_trace = pd.DataFrame({
+            "timestamp": positions["timestamp"].values,
+            **{column: interpolated[column].values for column in interpolated.columns},
+            "current_country": positions["current_country"].ffill().values,
+            "date": pd.to_datetime(positions["timestamp"], unit='s').values},
+            index=pd.Index(positions["current_step"].ffill().astype('int64').values, name="current_step"))
         return gps_trace
 
     def wrap_to_geojson(x):
+        import geojson
         line = geojson.LineString((x["latitude"], x["longitude"]))
         properties = {'times': x["timestamp"],
                       'icon': 'circle',
@@ -344,15 +1360,286 @@ class OverviewDatabase:
         # Filter the static position
         sleeping_df = sleeping_df[sleeping_df.speed <= static_position_threshold]
         # Get the dates
-        sleeping_df['date'] = sleeping_df["timestamp"].apply(lambda x: pd.to_datetime(x, unit="s").date())
+        sleeping_df['date'] = pd.to_datetime(sleeping_df["timestamp"], unit="s").dt.date
         # Filter the last position of the day
         sleeping_df = sleeping_df.drop_duplicates(subset=["date"], keep='last')
 
         # Compute distance to each other
-        sleeping_df["dist_from_last"] = 0.0
-        for i in range(1, len(sleeping_df[["latitude", "longitude"]])):
-            sleeping_df["dist_from_last"].iloc[i] = distance(sleeping_df[["latitude", "longitude"]].iloc[i - 1].values,
-                                                             sleeping_df[["latitude", "longitude"]].iloc[i].values)
+        sleeping_df["dist_from_last"] = consecutive_distance(sleeping_df["latitude"].values,
+                                                             sleeping_df["longitude"].values)
         # Filter positions that distance is sufficient
         sleeping_df = sleeping_df[sleeping_df.dist_from_last >= min_distance]
         return sleeping_df[["timestamp", "latitude", "longitude", "altitude"]].copy()
+
+    @staticmethod
+    def _detect_sleeping_locations(positions, radius, min_dwell, max_speed):
+        """
+        :param positions: pandas.DataFrame of positions ordered by timestamp
+        :return: pandas.DataFrame of the stays (sleeping_locations_columns), first timestamp of the last run of
+            positions (None if there is no position)
+        """
+        firsts, lasts, last_run = detect_stays(positions["timestamp"].values, positions["latitude"].values,
+                                               positions["longitude"].values, positions["speed"].values,
+                                               radius, min_dwell, max_speed)
+        # Mean position of each stay
+        counts = lasts - firsts + 1
+        runs = np.repeat(np.arange(len(firsts)), counts)
+        indices = np.arange(len(runs)) - np.repeat(np.cumsum(counts) - counts, counts) + np.repeat(firsts, counts)
+        means = {column: np.bincount(runs, weights=positions[column].values[indices].astype(np.float64),
+                                     minlength=len(firsts)) / np.maximum(counts, 1)
+                 for column in ["latitude", "longitude", "altitude"]}
+        stays = pd.DataFrame({"arrival": positions["timestamp"].values[firsts].astype(np.int64),
+                              "departure": positions["timestamp"].values[lasts].astype(np.int64),
+                              "latitude": means["latitude"],
+                              "longitude": means["longitude"],
+                              "altitude": means["altitude"],
+                              "positions": counts,
+                              "current_step": positions["current_step"].values[lasts].astype(np.int64)})
+        last_run_timestamp = int(positions["timestamp"].iloc[last_run]) if len(positions) else None
+        return stays, last_run_timestamp
+
+    def update_sleeping_locations(self, full=False, radius=None, min_dwell=None, max_speed=None):
+        """
+        Detect the stays (dwell time + radius, see geodesy.detect_stays) in the positions newer than the checkpoint
+        and store them in the sleeping_locations table. The last run of positions is processed again at the next
+        update, so a stay that is not over is extended.
+        :param full: detect the stays over the full history (to apply new thresholds)
+        :param radius: maximal extent of a stay in meters (default: the stored one or 100)
+        :param min_dwell: minimal duration of a stay in seconds (default: the stored one or 4 hours)
+        :param max_speed: maximal speed of a static position (default: the stored one or 1)
+        :return: number of stays added or updated, None if the database has no sleeping_locations table
+        """
+        if not self.database or not self.sleeping_locations_available:
+            return None
+        self.flush()
+        state = self.database.execute(
+            "SELECT checkpoint, radius, min_dwell, max_speed FROM sleeping_locations_state").fetchone()
+        thresholds = dict(stay_detection_defaults) if state is None else dict(zip(stay_detection_defaults, state[1:]))
+        for name, value in [("radius", radius), ("min_dwell", min_dwell), ("max_speed", max_speed)]:
+            if value is not None:
+                thresholds[name] = value
+        checkpoint = None if full or state is None else state[0]
+
+        positions = self.query_range(checkpoint, columns=["timestamp", "latitude", "longitude", "altitude", "speed",
+                                                          "current_step"])
+        if positions is None:
+            return 0
+        stays, last_run_timestamp = self._detect_sleeping_locations(positions, **thresholds)
+        try:
+            if checkpoint is None:
+                self.database.execute("DELETE FROM sleeping_locations")
+            else:
+                # The stay of the last run was detected from part of its positions
+                self.database.execute("DELETE FROM sleeping_locations WHERE arrival >= ?", (checkpoint,))
+            self.database.executemany(
+                "INSERT OR REPLACE INTO sleeping_locations (" + ", ".join(sleeping_locations_columns) + ") VALUES ("
+                + ", ".join("?" * len(sleeping_locations_columns)) + ")",
+                [(int(stay.arrival), int(stay.departure), float(stay.latitude), float(stay.longitude),
+                  float(stay.altitude), int(stay.positions), int(stay.current_step))
+                 for stay in stays.itertuples(index=False)])
+            if last_run_timestamp is not None or checkpoint is None:
+                self.database.execute(
+                    "INSERT OR REPLACE INTO sleeping_locations_state (id, checkpoint, radius, min_dwell, max_speed) "
+                    "VALUES (1, ?, ?, ?, ?)", (last_run_timestamp or 0, thresholds["radius"],
+                                               thresholds["min_dwell"], thresholds["max_speed"]))
+            self.database.commit()
+        except Error as e:
+            self.database.rollback()
+            print(f"The error '{e}' occurred")
+            return None
+        return len(stays)
+
+    def query_sleeping_locations(self):
+        """
+        Read the sleeping locations, updated by each insert (detected over the full history if the database has no
+        sleeping_locations table)
+        :return: pandas.DataFrame of arrival, departure, latitude, longitude, altitude, positions and current_step
+            ordered by arrival
+        """
+        if not self.database or not self.sleeping_locations_available:
+            positions = self.query_range(columns=["timestamp", "latitude", "longitude", "altitude", "speed",
+                                                  "current_step"])
+            if positions is None:
+                return None
+            return self._detect_sleeping_locations(positions, **stay_detection_defaults)[0]
+        try:
+            return pd.read_sql_query("SELECT " + ", ".join(sleeping_locations_columns)
+                                     + " FROM sleeping_locations ORDER BY arrival", self.database)
+        except (Error, pd.io.sql.DatabaseError) as e:
+            print(f"The error '{e}' occurred")
+            return None
+
+    def query_bbox(self, min_latitude, min_longitude, max_latitude, max_longitude, time_range=None,
+                   table="trip_data", columns=None):
+        """
+        Positions (or sleeping locations) within a bounding box, ex: the viewport of a map. The candidates are read
+        with the R*Tree index (logarithmic), without it (partitioned storage) the time range is read and filtered.
+        :param min_latitude: south edge
+        :param min_longitude: west edge, greater than max_longitude if the box crosses the antimeridian
+        :param max_latitude: north edge
+        :param max_longitude: east edge
+        :param time_range: (first timestamp, last timestamp) included, None for an unbounded side. A sleeping location
+            is selected if its stay overlaps the range
+        :param table: "trip_data" or "sleeping_locations"
+        :param columns: list of the columns to retrieve (all by default)
+        :return: pandas.DataFrame ordered by timestamp (arrival), None if the query failed
+        """
+        if table not in ("trip_data", "sleeping_locations"):
+            print(f"The table '{table}' has no spatial index")
+            return None
+        if min_longitude > max_longitude:
+            # Both sides of the antimeridian
+            boxes = [self.query_bbox(min_latitude, min_longitude, max_latitude, 180.0, time_range, table, columns),
+                     self.query_bbox(min_latitude, -180.0, max_latitude, max_longitude, time_range, table, columns)]
+            if boxes[0] is None or boxes[1] is None:
+                return None
+            return pd.concat(boxes).sort_values("timestamp" if table == "trip_data" else "arrival") \
+                .reset_index(drop=True)
+
+        first_timestamp, last_timestamp = time_range or (None, None)
+        first_time, last_time = ("timestamp", "timestamp") if table == "trip_data" else ("arrival", "departure")
+        conditions, parameters = [], []
+        join = None
+        if table in self.spatial_indexes:
+            # Boxes of the index (blocks of positions or sleeping locations) overlapping the range
+            conditions += ["max_latitude >= ?", "min_latitude <= ?", "max_longitude >= ?", "min_longitude <= ?"]
+            parameters += [float(min_latitude), float(max_latitude), float(min_longitude), float(max_longitude)]
+            if first_timestamp is not None:
+                conditions.append("max_timestamp >= ?")
+                parameters.append(int(first_timestamp))
+            if last_timestamp is not None:
+                conditions.append("min_timestamp <= ?")
+                parameters.append(int(last_timestamp))
+            join = "JOIN trip_data_rtree ON timestamp >= id * {0} AND timestamp < id * {0} + {0}".format(
+                spatial_block_seconds) if table == "trip_data" else "JOIN sleeping_locations_rtree ON id = arrival"
+        if first_timestamp is not None:
+            conditions.append(f"{last_time} >= ?")
+            parameters.append(int(first_timestamp))
+        if last_timestamp is not None:
+            conditions.append(f"{first_time} <= ?")
+            parameters.append(int(last_timestamp))
+
+        # The exact coordinates are filtered once read
+        requested_columns = columns
+        if table == "trip_data":
+            columns = list(dict.fromkeys((columns or trip_data_columns) + ["latitude", "longitude"]))
+            source = None
+            if self.partitioned:
+                source = "(" + self._partition_source(first_timestamp, last_timestamp) + ")"
+            result = self._query_positions(conditions, parameters, columns, source, join)
+        else:
+            if not self.database or not self.sleeping_locations_available:
+                print("The database has no sleeping_locations table")
+                return None
+            columns = list(dict.fromkeys((columns or sleeping_locations_columns) + ["latitude", "longitude"]))
+            try:
+                result = pd.read_sql_query("SELECT " + ", ".join(columns) + " FROM sleeping_locations "
+                                           + (join or "") + (" WHERE " + " AND ".join(conditions) if conditions else "")
+                                           + " ORDER BY arrival", self.database, params=parameters)
+            except (Error, pd.io.sql.DatabaseError) as e:
+                print(f"The error '{e}' occurred")
+                return None
+        if result is None:
+            return None
+        result = result[result["latitude"].between(min_latitude, max_latitude)
+                        & result["longitude"].between(min_longitude, max_longitude)].reset_index(drop=True)
+        return result[requested_columns] if requested_columns else result
+
+    def query_nearby(self, latitude, longitude, radius_km, time_range=None, table="trip_data", columns=None):
+        """
+        Positions (or sleeping locations) within a distance of a point, ex: "have we been within 5 km of here before".
+        The bounding box of the circle is read with query_bbox, then filtered on the great-circle distance.
+        :param latitude: latitude of the center
+        :param longitude: longitude of the center
+        :param radius_km: radius in km
+        :param time_range: see query_bbox
+        :param table: "trip_data" or "sleeping_locations"
+        :param columns: list of the columns to retrieve (all by default)
+        :return: pandas.DataFrame ordered by timestamp (arrival) with a distance column in km, None if the query failed
+        """
+        angle = radius_km / EARTH_RADIUS_KM
+        min_latitude, max_latitude = latitude - np.degrees(angle), latitude + np.degrees(angle)
+        # Largest longitude difference within the circle, every longitude if it contains a pole
+        cos_latitude = np.cos(np.radians(latitude))
+        if min_latitude <= -90.0 or max_latitude >= 90.0 or np.sin(angle) >= cos_latitude:
+            min_longitude, max_longitude = -180.0, 180.0
+        else:
+            delta = np.degrees(np.arcsin(np.sin(angle) / cos_latitude))
+            min_longitude = (longitude - delta + 180.0) % 360.0 - 180.0
+            max_longitude = (longitude + delta + 180.0) % 360.0 - 180.0
+        requested_columns = columns
+        if columns:
+            columns = list(dict.fromkeys(columns + ["latitude", "longitude"]))
+        result = self.query_bbox(max(min_latitude, -90.0), min_longitude, min(max_latitude, 90.0), max_longitude,
+                                 time_range, table, columns)
+        if result is None:
+            return None
+        result["distance"] = haversine(latitude, longitude, result["latitude"].values, result["longitude"].values)
+        result = result[result["distance"] <= radius_km].reset_index(drop=True)
+        return result[requested_columns + ["distance"]] if requested_columns else result
+
+    def import_route(self, route, points, batch_size=10000):
+        """
+        Store a planned route, it replaces the route of the same name. The points are inserted by batches (constant
+        memory with a streamed route) in one transaction.
+        :param route: name of the route
+        :param points: iterable of (segment, latitude, longitude, altitude), ex: routes.read_route(filepath)
+        :param batch_size: number of points per insert
+        :return: number of points stored, None if failed
+        """
+        if not self.database or not self.planned_route_available:
+            return None
+        stored = 0
+        try:
+            self.database.execute("DELETE FROM planned_route WHERE route = ?", (route,))
+            points = ((route, point, *values) for point, values in enumerate(points))
+            batch = list(itertools.islice(points, batch_size))
+            while batch:
+                self.database.executemany("INSERT INTO planned_route (" + ", ".join(planned_route_columns)
+                                          + ") VALUES (" + ", ".join("?" * len(planned_route_columns)) + ")", batch)
+                stored += len(batch)
+                batch = list(itertools.islice(points, batch_size))
+            self.database.commit()
+        except (Error, ValueError, SyntaxError) as e:  # Including the errors of a streamed route (ParseError)
+            self.database.rollback()
+            print(f"The error '{e}' occurred")
+            return None
+        return stored
+
+    def query_planned_route(self, route=None):
+        """
+        :param route: name of the route, all the routes if None
+        :return: pandas.DataFrame of route, point, segment, latitude, longitude and altitude ordered by route and
+            point, None if the database has no planned route
+        """
+        if not self.database or not self.planned_route_available:
+            return None
+        try:
+            return pd.read_sql_query("SELECT " + ", ".join(planned_route_columns) + " FROM planned_route"
+                                     + (" WHERE route = ?" if route is not None else "") + " ORDER BY route, point",
+                                     self.database, params=(route,) if route is not None else None)
+        except (Error, pd.io.sql.DatabaseError) as e:
+            print(f"The error '{e}' occurred")
+            return None
+
+    def get_route_deviation(self, route=None, positions=None):
+        """
+        Distance of the positions to the planned route (see geodesy.route_deviation)
+        :param route: name of the route, all the routes if None
+        :param positions: DataFrame with latitude and longitude columns (default: all the positions)
+        :return: the positions with a deviation column in meters, None if there is no planned route or no position
+        """
+        planned_route = self.query_planned_route(route)
+        if planned_route is None or planned_route.empty:
+            return None
+        if positions is None:
+            positions = self.query_range(columns=["timestamp", "latitude", "longitude"])
+            if positions is None:
+                return None
+        # The segments of different routes are not joined
+        segments = planned_route.groupby(["route", "segment"], sort=False).ngroup().values
+        positions = positions.copy()
+        positions["deviation"] = route_deviation(planned_route["latitude"].values, planned_route["longitude"].values,
+                                                 positions["latitude"].values, positions["longitude"].values,
+                                                 route_segments=segments)
+        return positions
@@ -0,0 +1,287 @@
+import os
+import time
+import signal
+import logging
+import itertools
+import threading
+import collections
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta
+from OverviewDatabase import OverviewDatabase
+from methods import retrieve_influxdb_data, stream_influxdb_positions, create_site
+from instrumentation import get_instrumentation, span
+from site_update import read_last_update, write_last_update
+
+
+class TripOverviewService:
+    """This class runs the pipeline of generate_site.py: the ingestion of the new positions from InfluxDB and the
+    rendering of the site. In the resident mode (run) the ingestion is repeated every ingest_interval and the rendering
+    every render_interval, the database connection, its cached trace and the country resolver stay warm between the
+    cycles. The cycles run one after the other, a cycle is never started while another one runs.
+    A range longer than the backfill chunk (ex: after weeks without power) is backfilled by chunks (backfill).
+    Usage:
+     service = TripOverviewService(conf, DataFrameClient(...))
+     service.run()  (until SIGTERM or SIGINT)"""
+
+    def __init__(self, conf, influxdb_client, trip_data=None):
+        """
+        Initiation, connects to the database
+        :param conf: configuration of generate_site.py (see data/default_config.yaml)
+        :param influxdb_client: DataFrameClient (or any object with the same query method)
+        :param trip_data: OverviewDatabase, connected to conf["database_filepath"] if None
+        """
+        self.conf = conf
+        self.influxdb_client = influxdb_client
+        daemon_conf = conf.get("daemon") or {}
+        self.ingest_interval = float(daemon_conf.get("ingest_interval", 60))
+        self.render_interval = float(daemon_conf.get("render_interval", 43200))
+        backfill_conf = conf.get("backfill") or {}
+        self.backfill_chunk = timedelta(hours=float(backfill_conf.get("chunk_hours", 24)))
+        self.backfill_workers = int(backfill_conf.get("workers", 4))
+        self.checkpoint_filepath = backfill_conf.get("checkpoint_filepath",
+                                                     "/etc/capsule/trip_overview/backfill_checkpoint.txt")
+        self.last_update_filepath = conf.get("last_update_filepath", "/etc/capsule/trip_overview/last_site_update.txt")
+        self.stopping = threading.Event()
+        self.cycles = {"ingest": 0, "render": 0, "failed": 0}
+        if trip_data is None:
+            logging.info("connect to database located in " + conf["database_filepath"])
+            trip_data = OverviewDatabase(archive_folder=conf.get("columnar_archive_path"),
+                                         compact=conf.get("compact_storage") or None)
+            trip_data.connect_to_database(conf["database_filepath"], True)
+        self.trip_data = trip_data
+
+    def last_update(self):
+        """
+        :return: UTC datetime of the last rendering of the site, None if the site was never rendered
+        """
+        return read_last_update(self.last_update_filepath)
+
+    def ingest(self, start=None, end=None):
+        """
+        Retrieve the positions of a time range from InfluxDB and commit the new ones, by chunks (backfill) if the
+        range is longer than the backfill chunk
+        :param start: beginning of the range (UTC), default: last committed position (or one day ago)
+        :param end: end of the range (UTC), default: now
+        :return: number of committed positions
+        """
+        end = end or datetime.utcnow()
+        if start is None:
+            summary = self.trip_data.get_trip_summary()
+            start = datetime.utcfromtimestamp(summary["last_timestamp"]) \
+                if summary and summary["last_timestamp"] is not None else end - timedelta(days=1)
+        if end - start > self.backfill_chunk:
+            return self.backfill(start, end)["positions"]
+        # Each window of the query is committed as it arrives, the range is never held in memory at once
+        committed = 0
+        positions = stream_influxdb_positions([start.isoformat(), end.isoformat()], self.influxdb_client, "5s")
+        while True:
+            with span("influxdb_retrieval") as record:
+                df = next(positions, None)
+                record["rows"] = len(df) if df is not None else 0
+            if df is None:
+                return committed
+            committed += self.commit_new_positions(df)
+
+    def retrieve(self, start, end):
+        """
+        Retrieve the positions of a time range from InfluxDB (called by the threads of the backfill)
+        :param start: beginning of the range (UTC)
+        :param end: end of the range (UTC)
+        :return: DataFrame of the positions, see retrieve_influxdb_data
+        """
+        with span("influxdb_retrieval") as record:
+            df = retrieve_influxdb_data([start.isoformat(), end.isoformat()], self.influxdb_client, "5s")
+            record["rows"] = len(df)
+        return df
+
+    def commit_new_positions(self, df):
+        """
+        Commit the positions newer than the last committed one
+        :param df: DataFrame of the positions, see retrieve_influxdb_data
+        :return: number of committed positions
+        """
+        summary = self.trip_data.get_trip_summary()
+        last_timestamp = summary["last_timestamp"] if summary and summary["last_timestamp"] is not None else None
+        # The first position of the range can already be committed
+        if last_timestamp is not None:
+            df = df[df["timestamp"] > last_timestamp]
+            # retrieve_influxdb_data keeps the first parked position of each range, it is not new if the vehicle
+            # was already parked at the last committed position
+            last_position = self.trip_data.query_range(last_timestamp, last_timestamp, columns=["speed"])
+            if last_position is not None and not last_position.empty and last_position["speed"].iloc[-1] < 1.0:
+                df = df[(df["speed"] >= 1.0).cummax()]
+        if df.empty:
+            return 0
+        # The km of each retrieval start from 0, they continue from the last committed position
+        self.trip_data.commit_dataframe(df, continue_km=True)
+        return len(df)
+
+    def backfill(self, start, end):
+        """
+        Ingest a long time range by chunks of backfill_chunk: the chunks are retrieved concurrently by a bounded
+        pool of threads (at most workers chunks in memory) and committed in order. The end of each committed chunk
+        is stored in the checkpoint file, an interrupted backfill of the same range resumes from there. The backfill
+        stops after the running chunk when stop is called.
+        :param start: beginning of the range (UTC)
+        :param end: end of the range (UTC)
+        :return: stats: chunks, positions, seconds, positions_per_second and resumed_from (checkpoint, None if the
+            backfill started from the beginning of the range)
+        """
+        checkpoint = self.read_checkpoint()
+        resumed_from = checkpoint if checkpoint is not None and start < checkpoint < end else None
+        if resumed_from is not None:
+            logging.info("Resume the backfill from the checkpoint " + resumed_from.isoformat())
+            start = resumed_from
+        boundaries = [start + i * self.backfill_chunk for i in range(int((end - start) / self.backfill_chunk) + 1)]
+        chunks = list(zip(boundaries, boundaries[1:] + [end]))
+        if chunks[-1][0] >= end:
+            chunks.pop()
+        stats = {"chunks": 0, "positions": 0, "seconds": 0.0, "positions_per_second": 0.0,
+                 "resumed_from": resumed_from.isoformat() if resumed_from is not None else None}
+        start_time = time.perf_counter()
+        with span("backfill") as record, ThreadPoolExecutor(max(self.backfill_workers, 1),
+                                                            thread_name_prefix="backfill") as executor:
+            remaining = iter(chunks)
+            pending = collections.deque((chunk, executor.submit(self.retrieve, *chunk))
+                                        for chunk in itertools.islice(remaining, max(self.backfill_workers, 1)))
+            try:
+                while pending and not self.stopping.is_set():
+                    # The oldest chunk first, whatever the order the retrievals finish in, so that the km of each
+                    # chunk continue from the previous one (see commit_new_positions)
+                    (chunk_start, chunk_end), future = pending.popleft()
+                    df = future.result()
+                    # The next chunk is retrieved while this one is committed
+                    for chunk in itertools.islice(remaining, 1):
+                        pending.append((chunk, executor.submit(self.retrieve, *chunk)))
+                    stats["positions"] += self.commit_new_positions(df)
+                    self.trip_data.flush()
+                    self.write_checkpoint(chunk_end)
+                    stats["chunks"] += 1
+                    stats["seconds"] = round(time.perf_counter() - start_time, 3)
+                    stats["positions_per_second"] = round(stats["positions"] / stats["seconds"], 1) \
+                        if stats["seconds"] > 0 else 0.0
+                    logging.info("Backfill %d/%d chunks (up to %s): %d positions, %.1f positions/s"
+                                 % (stats["chunks"], len(chunks), chunk_end.isoformat(), stats["positions"],
+                                    stats["positions_per_second"]))
+            finally:
+                for _, future in pending:
+                    future.cancel()
+            record["rows"] = stats["positions"]
+        if stats["chunks"] == len(chunks) and os.path.exists(self.checkpoint_filepath):
+            os.remove(self.checkpoint_filepath)
+        return stats
+
+    def read_checkpoint(self):
+        """
+        :return: end (UTC datetime) of the last chunk committed by an interrupted backfill, None if there is none
+        """
+        if not os.path.exists(self.checkpoint_filepath):
+            return None
+        with open(self.checkpoint_filepath, "r") as f:
+            return datetime.fromisoformat(f.readline().strip("\n"))
+
+    def write_checkpoint(self, chunk_end):
+        """
+        Store the end of the last committed chunk (replaced atomically)
+        :param chunk_end: UTC datetime
+        """
+        with open(self.checkpoint_filepath + ".tmp", "w") as f:
+            f.write(chunk_end.isoformat())
+        os.replace(self.checkpoint_filepath + ".tmp", self.checkpoint_filepath)
+
+    def render(self, now=None):
+        """
+        Archive the closed days (columnar archive), render the site and store the date of the rendering
+        :param now: UTC date of the rendering (default: now), name of the snapshot of the site
+        """
+        now = now or datetime.utcnow()
+        if self.trip_data.columnar_archive is not None:
+            # Archive the closed days, they are then read from the Arrow files instead of SQLite
+            archived = self.trip_data.columnar_archive.export(self.trip_data)
+            self.trip_data.columnar_archive.compact()
+            logging.info("%d positions added to the columnar archive" % archived)
+
+        logging.info("Generate Trip overview at " + self.conf["folium_site_output_path"])
+        create_site(self.trip_data, self.conf["folium_site_output_path"], now.strftime("%Y_%m_%d"),
+                    self.conf["map_generation"]["url"],
+                    extra_tile_variants=self.conf["map_generation"].get("extra_tiles"))
+
+        # Store last update of site
+        write_last_update(self.last_update_filepath, now)
+
+    def run_cycle(self, name, function, *args):
+        """
+        Run one cycle with a fresh instrumentation and write its metrics, the errors are logged
+        :param name: name of the cycle, ex: "ingest"
+        :param function: function of the cycle
+        :return: success
+        """
+        instrumentation = get_instrumentation()
+        instrumentation.enable()  # The spans of the previous cycle are removed
+        start_time = time.perf_counter()
+        try:
+            function(*args)
+        except Exception:
+            self.cycles["failed"] += 1
+            logging.exception("The %s cycle failed" % name)
+            return False
+        finally:
+            self.write_metrics()
+        self.cycles[name] = self.cycles.get(name, 0) + 1
+        logging.info("%s cycle done in %.3f s" % (name, time.perf_counter() - start_time))
+        return True
+
+    def write_metrics(self):
+        """ Write the metrics of the stages of the last cycle (metrics section of the configuration) """
+        instrumentation = get_instrumentation()
+        metrics_conf = self.conf.get("metrics") or {}
+        if metrics_conf.get("json_path"):
+            instrumentation.write_json(metrics_conf["json_path"])
+        if metrics_conf.get("prometheus_path"):
+            instrumentation.write_prometheus(metrics_conf["prometheus_path"])
+
+    def stop(self, signum=None, frame=None):
+        """ Stop the resident mode once the running cycle is done (handler of SIGTERM and SIGINT) """
+        if signum is not None:
+            logging.info("Signal %d received, stopping after the running cycle" % signum)
+        self.stopping.set()
+
+    def run(self, max_cycles=None):
+        """
+        Resident mode: ingest every ingest_interval (never if 0) and render every render_interval until stop is called.
+        The site is rendered at start if the last rendering is older than render_interval. A late cycle is run once,
+        the missed ones are skipped.
+        :param max_cycles: stop after this number of cycles (ingestions and renderings), for the tests
+        """
+        handlers = {}
+        if threading.current_thread() is threading.main_thread():
+            handlers = {signum: signal.signal(signum, self.stop) for signum in (signal.SIGTERM, signal.SIGINT)}
+        last_update = self.last_update()
+        since_render = (datetime.utcnow() - last_update).total_seconds() if last_update else self.render_interval
+        # No ingestion if its interval is 0 (positions written by another process, ex: mqtt_ingest.py)
+        next_ingest = time.monotonic() if self.ingest_interval > 0 else float("inf")
+        next_render = time.monotonic() + max(self.render_interval - since_render, 0.0)
+        cycles = 0
+        logging.info("Resident mode: ingestion every %.0f s, rendering every %.0f s"
+                     % (self.ingest_interval, self.render_interval))
+        while not self.stopping.is_set() and (max_cycles is None or cycles < max_cycles):
+            if time.monotonic() >= next_ingest:
+                self.run_cycle("ingest", self.ingest)
+                next_ingest = max(next_ingest + self.ingest_interval, time.monotonic())
+                cycles += 1
+            elif time.monotonic() >= next_render:
+                self.run_cycle("render", self.render)
+                next_render = max(next_render + self.render_interval, time.monotonic())
+                cycles += 1
+            else:
+                # Sleep until the next cycle, interrupted by stop
+                self.stopping.wait(min(next_ingest, next_render) - time.monotonic())
+        for signum, handler in handlers.items():
+            signal.signal(signum, handler)
+        self.close()
+
+    def close(self):
+        """ Flush and close the database """
+        self.trip_data.close_database()
+        logging.info("Service stopped after %d ingestions and %d renderings (%d failed cycles)"
+                     % (self.cycles["ingest"], self.cycles["render"], self.cycles["failed"]))
@@ -0,0 +1,291 @@
+#!/usr/bin/python3
+# Benchmark suite of the trip overview pipeline on a deterministic synthetic trip, the results are written as JSON
+# so that runs can be compared for regressions
+# Usage: python3 benchmark.py [--days 30] [--output results.json] [--compare previous_results.json]
+
+import io
+import os
+import sys
+import json
+import time
+import shutil
+import argparse
+import statistics
+import subprocess
+import platform
+import resource
+import tempfile
+import contextlib
+import numpy as np
+import pandas as pd
+from datetime import datetime
+from OverviewDatabase import OverviewDatabase
+from geodesy import haversine
+from LiveMapServer import LiveMapServer
+from TripOverviewService import TripOverviewService
+from methods import retrieve_influxdb_data, create_site
+from site_update import write_last_update
+from synthetic_trip import generate_trip, SyntheticDataFrameClient
+
+benchmark_names = ["startup", "commit_dataframe", "commit_position", "query_raw_database", "describe_trip",
+                   "get_road_trip_gps_trace", "get_sleeping_locations", "update_sleeping_locations", "query_bbox",
+                   "query_bbox_scan", "query_nearby", "query_nearby_scan",
+                   "compact_commit_dataframe", "compact_query_raw_database", "retrieve_influxdb_data", "backfill",
+                   "live_initial_load", "live_delta", "create_site"]
+# Modules that the no-op run of generate_site.py (site already updated) must not import
+heavy_modules = ["numpy", "pandas", "scipy", "reverse_geocoder", "folium", "branca", "influxdb", "geojson",
+                 "pyarrow", "sqlalchemy"]
+startup_budget = 1.0  # seconds, cold start of the no-op run of generate_site.py
+
+
+def measure_startup(runs=5):
+    """
+    Time the cold start of the no-op run of generate_site.py (the site was updated less than 12h ago)
+    :param runs: number of runs, the median is kept
+    :return: dict of seconds (median), min_seconds, runs and heavy_modules (the heavy modules imported)
+    """
+    folder = tempfile.mkdtemp()
+    try:
+        write_last_update(os.path.join(folder, "last_site_update.txt"), datetime.utcnow())
+        with open(os.path.join(folder, "config.yaml"), "w") as file:
+            json.dump({"debug": False, "log_filepath": os.path.join(folder, "trip_overview.log"),
+                       "last_update_filepath": os.path.join(folder, "last_site_update.txt")}, file)
+        command = [sys.executable, os.path.join(os.path.dirname(os.path.abspath(__file__)), "generate_site.py"),
+                   "--config", os.path.join(folder, "config.yaml")]
+        durations = []
+        for _ in range(runs):
+            start_time = time.perf_counter()
+            subprocess.run(command, check=True, stdout=subprocess.DEVNULL)
+            durations.append(time.perf_counter() - start_time)
+        # One more run listing the imported modules
+        import_times = subprocess.run(command[:1] + ["-X", "importtime"] + command[1:], check=True,
+                                      stdout=subprocess.DEVNULL, stderr=subprocess.PIPE, text=True).stderr
+        modules = {line.split("|")[-1].strip().split(".")[0] for line in import_times.splitlines()
+                   if line.startswith("import time:")}
+    finally:
+        shutil.rmtree(folder, ignore_errors=True)
+    return {"seconds": round(statistics.median(durations), 4), "min_seconds": round(min(durations), 4),
+            "runs": runs, "heavy_modules": [module for module in heavy_modules if module in modules]}
+
+
+def run_benchmarks(days=30, interval=5, seed=0, committed_positions=1000, influxdb_days=1, workers=None,
+                   benchmarks=None, work_folder=None, spatial_queries=20):
+    """
+    Time the pipeline stages on a synthetic trip
+    :param days: duration of the synthetic trip (see synthetic_trip.generate_trip)
+    :param interval: seconds between two positions
+    :param seed: seed of the synthetic trip
+    :param committed_positions: number of positions committed one by one with commit_position (the last ones),
+        the others are committed with commit_dataframe
+    :param influxdb_days: number of days retrieved from the InfluxDB stand-in
+    :param workers: see create_site
+    :param benchmarks: names of the benchmarks to run (all of benchmark_names by default), the positions are
+        committed unless only startup is run
+    :param work_folder: folder of the database and the site (temporary folder removed at the end by default)
+    :param spatial_queries: number of queries of the query_bbox and query_nearby benchmarks (and of their scans)
+    :return: dict of parameters, environment and results ({name: {"seconds", "rows", "rows_per_second"}}, with
+        the database size in bytes ("database_bytes") for commit_dataframe and compact_commit_dataframe and the
+        transferred bytes ("bytes") for the live map). The rows of the spatial queries are the number of queries
+    """
+    benchmarks = benchmarks or benchmark_names
+    results = {}
+    if "startup" in benchmarks:
+        results["startup"] = measure_startup()
+    positions = generate_trip(days=days, interval=interval, seed=seed)
+    committed_positions = min(committed_positions, len(positions))
+
+    def timed(name, function, rows):
+        start_time = time.perf_counter()
+        # commit_position prints the ignored km of each position
+        with contextlib.redirect_stdout(io.StringIO()):
+            value = function()
+        seconds = time.perf_counter() - start_time
+        if name in benchmarks:
+            results[name] = {"seconds": round(seconds, 4), "rows": int(rows),
+                             "rows_per_second": round(rows / seconds, 1) if seconds > 0 else None}
+        return value
+
+    temporary_folder = work_folder is None
+    work_folder = tempfile.mkdtemp() if temporary_folder else work_folder
+    try:
+        # The trip is only committed if a benchmark needs it
+        if any(name != "startup" for name in benchmarks):
+            trip_data = OverviewDatabase()
+            trip_data.connect_to_database(os.path.join(work_folder, "benchmark.db"), True)
+            timed("commit_dataframe", lambda: trip_data.commit_dataframe(
+                positions.iloc[:len(positions) - committed_positions].copy()), len(positions) - committed_positions)
+            timed("commit_position", lambda: [trip_data.commit_position(*row) for row in positions[
+                ["timestamp", "latitude", "longitude", "altitude", "speed", "km", "current_step"]].iloc[
+                len(positions) - committed_positions:].values.tolist()], committed_positions)
+
+            if "commit_dataframe" in benchmarks:
+                results["commit_dataframe"]["database_bytes"] = os.path.getsize(
+                    os.path.join(work_folder, "benchmark.db"))
+            if "query_raw_database" in benchmarks:
+                trip_data.invalidate_raw_data()
+                timed("query_raw_database", trip_data.query_raw_database, len(positions))
+            if "describe_trip" in benchmarks:
+                timed("describe_trip", trip_data.describe_trip, len(positions))
+            if "get_road_trip_gps_trace" in benchmarks:
+                timed("get_road_trip_gps_trace", trip_data.get_road_trip_gps_trace, len(positions))
+            if "get_sleeping_locations" in benchmarks:
+                timed("get_sleeping_locations", trip_data.get_sleeping_locations, len(positions))
+            if "update_sleeping_locations" in benchmarks:
+                timed("update_sleeping_locations", lambda: trip_data.update_sleeping_locations(full=True),
+                      len(positions))
+
+            # Spatial queries around moving positions of the trip (a stop is one position in a real database, not
+            # thousands as in the synthetic trip): viewports of 0.1 degree and 5 km around, with the R*Tree index and
+            # with a scan of the whole trip loaded in pandas
+            centers = positions.loc[positions["speed"] >= 1.0, ["latitude", "longitude"]].sample(
+                spatial_queries, random_state=seed).values
+            if "query_bbox" in benchmarks:
+                timed("query_bbox", lambda: [trip_data.query_bbox(latitude - 0.05, longitude - 0.05, latitude + 0.05,
+                                                                  longitude + 0.05) for latitude, longitude in centers],
+                      spatial_queries)
+            if "query_nearby" in benchmarks:
+                timed("query_nearby", lambda: [trip_data.query_nearby(latitude, longitude, 5.0)
+                                               for latitude, longitude in centers], spatial_queries)
+            if "query_bbox_scan" in benchmarks or "query_nearby_scan" in benchmarks:
+                def scan(condition):
+                    trip_data.invalidate_raw_data()
+                    trip_data.query_raw_database()
+                    raw_data = trip_data.raw_data
+                    return [raw_data[condition(raw_data, latitude, longitude)] for latitude, longitude in centers]
+                timed("query_bbox_scan", lambda: scan(
+                    lambda raw_data, latitude, longitude: raw_data["latitude"].between(latitude - 0.05, latitude + 0.05)
+                    & raw_data["longitude"].between(longitude - 0.05, longitude + 0.05)), spatial_queries)
+                timed("query_nearby_scan", lambda: scan(
+                    lambda raw_data, latitude, longitude: haversine(latitude, longitude, raw_data["latitude"].values,
+                                                                    raw_data["longitude"].values) <= 5.0),
+                      spatial_queries)
+
+            # Same positions in the compact storage (fixed-point integers and country dictionary)
+            if "compact_commit_dataframe" in benchmarks or "compact_query_raw_database" in benchmarks:
+                compact_data = OverviewDatabase(compact=True)
+                compact_data.connect_to_database(os.path.join(work_folder, "benchmark_compact.db"), True)
+                timed("compact_commit_dataframe", lambda: compact_data.commit_dataframe(positions.copy()),
+                      len(positions))
+                if "compact_commit_dataframe" in benchmarks:
+                    results["compact_commit_dataframe"]["database_bytes"] = os.path.getsize(
+                        os.path.join(work_folder, "benchmark_compact.db"))
+                compact_data.invalidate_raw_data()
+                timed("compact_query_raw_database", compact_data.query_raw_database, len(positions))
+                compact_data.close_database()
+
+            if "retrieve_influxdb_data" in benchmarks:
+                client = SyntheticDataFrameClient(positions)
+                end = int(positions["timestamp"].iloc[-1])
+                start = max(end - influxdb_days * 86400, int(positions["timestamp"].iloc[0]))
+                timed("retrieve_influxdb_data", lambda: retrieve_influxdb_data(
+                    [datetime.utcfromtimestamp(start).isoformat(), datetime.utcfromtimestamp(end).isoformat()],
+                    client, "%ds" % interval),
+                      np.count_nonzero(positions["timestamp"].between(start, end)))
+
+            if "backfill" in benchmarks:
+                # Whole trip retrieved by chunks of one day into an empty database
+                service = TripOverviewService({"database_filepath": os.path.join(work_folder, "backfill.db"),
+                                               "backfill": {"chunk_hours": 24, "workers": 4, "checkpoint_filepath":
+                                                            os.path.join(work_folder, "backfill_checkpoint.txt")}},
+                                              SyntheticDataFrameClient(positions))
+                timed("backfill", lambda: service.backfill(
+                    datetime.utcfromtimestamp(int(positions["timestamp"].iloc[0])),
+                    datetime.utcfromtimestamp(int(positions["timestamp"].iloc[-1]) + 1)), len(positions))
+                service.close()
+
+            if "live_initial_load" in benchmarks or "live_delta" in benchmarks:
+                # Follower of the live map: first visit (summary and all the steps, gzip), then a poll of the last
+                # hour of positions
+                server = LiveMapServer(trip_data)
+                headers = {"Accept-Encoding": "gzip"}
+
+                def initial_load():
+                    server.respond("/summary", headers)
+                    return [server.respond("/steps/%d" % step, headers)
+                            for step in trip_data.get_step_summaries().index]
+                responses = timed("live_initial_load", initial_load, len(positions))
+                if "live_initial_load" in benchmarks:
+                    results["live_initial_load"]["bytes"] = sum(len(response[2]) for response in responses)
+                since = int(positions["timestamp"].iloc[-1]) - 3600
+                response = timed("live_delta", lambda: server.respond("/trace?since=%d" % since, headers),
+                                 np.count_nonzero(positions["timestamp"] > since))
+                if "live_delta" in benchmarks:
+                    results["live_delta"]["bytes"] = len(response[2])
+
+            if "create_site" in benchmarks:
+                site_folder = os.path.join(work_folder, "site") + "/"
+                os.makedirs(site_folder + "saves", exist_ok=True)
+                timed("create_site", lambda: create_site(trip_data, site_folder, "benchmark",
+                                                         "http://localhost/{z}/{x}/{y}.png", workers=workers),
+                      len(positions))
+            trip_data.close_database()
+    finally:
+        if temporary_folder:
+            shutil.rmtree(work_folder, ignore_errors=True)
+
+    return {
+        "created": datetime.now().isoformat(),
+        "parameters": {"days": days, "interval": interval, "seed": seed, "positions": len(positions),
+                       "committed_positions": committed_positions, "influxdb_days": influxdb_days,
+                       "spatial_queries": spatial_queries},
+        "environment": {"python": platform.python_version(), "platform": platform.platform(),
+                        "numpy": np.__version__, "pandas": pd.__version__,
+                        "peak_rss_mb": round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 1)},
+        "results": results}
+
+
+def compare_results(previous, current, tolerance=0.2):
+    """
+    :param previous: output of run_benchmarks (reference run)
+    :param current: output of run_benchmarks
+    :param tolerance: relative slowdown allowed
+    :return: list of (name, previous seconds, current seconds) of the benchmarks slower than the tolerance
+    """
+    regressions = []
+    for name, result in current["results"].items():
+        reference = previous.get("results", {}).get(name)
+        if reference and result["seconds"] > reference["seconds"] * (1 + tolerance):
+            regressions.append((name, reference["seconds"], result["seconds"]))
+    return regressions
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark the trip overview pipeline on a synthetic trip")
+    parser.add_argument("--days", type=int, default=30, help="duration of the synthetic trip (365 for ~6M positions)")
+    parser.add_argument("--interval", type=int, default=5, help="seconds between two positions")
+    parser.add_argument("--seed", type=int, default=0, help="seed of the synthetic trip")
+    parser.add_argument("--committed-positions", type=int, default=1000,
+                        help="number of positions committed one by one with commit_position")
+    parser.add_argument("--influxdb-days", type=int, default=1, help="number of days retrieved from InfluxDB")
+    parser.add_argument("--workers", type=int, help="number of processes rendering the maps")
+    parser.add_argument("--only", nargs="+", choices=benchmark_names, help="benchmarks to run")
+    parser.add_argument("--output", help="JSON file of the results (printed if not set)")
+    parser.add_argument("--compare", help="JSON results of a previous run, exit with 1 if a benchmark is slower")
+    parser.add_argument("--tolerance", type=float, default=0.2, help="relative slowdown allowed by --compare")
+    parser.add_argument("--startup-budget", type=float, default=startup_budget,
+                        help="maximal cold start in seconds of the no-op run of generate_site.py, exit with 1 if "
+                             "it is slower or if it imports a heavy module")
+    args = parser.parse_args()
+
+    report = run_benchmarks(args.days, args.interval, args.seed, args.committed_positions, args.influxdb_days,
+                            args.workers, args.only)
+    if args.output:
+        with open(args.output, "w") as file:
+            json.dump(report, file, indent=2)
+    else:
+        print(json.dumps(report, indent=2))
+
+    failed = False
+    startup = report["results"].get("startup")
+    if startup and (startup["seconds"] > args.startup_budget or startup["heavy_modules"]):
+        print("Startup over budget: %.3f s (budget %.3f s), heavy modules imported: %s"
+              % (startup["seconds"], args.startup_budget, ", ".join(startup["heavy_modules"]) or "none"),
+              file=sys.stderr)
+        failed = True
+    if args.compare:
+        with open(args.compare, "r") as file:
+            regressions = compare_results(json.load(file), report, args.tolerance)
+        for name, previous_seconds, seconds in regressions:
+            print("Regression of %s: %.3f s -> %.3f s" % (name, previous_seconds, seconds), file=sys.stderr)
+        failed |= bool(regressions)
+    sys.exit(1 if failed else 0)
@@ -0,0 +1,28 @@
+#!/usr/bin/python3
+# Migration tool: convert the trip_data table of an existing database to the compact storage
+# (fixed-point integers and country dictionary, see OverviewDatabase.compact_scales)
+# Usage: python3 compact_database.py <database_filepath> [--no-vacuum]
+
+import os
+import sys
+import argparse
+from OverviewDatabase import OverviewDatabase
+
+
+parser = argparse.ArgumentParser(description="Convert the trip database to the compact storage")
+parser.add_argument("database_filepath", help="path of the trip database")
+parser.add_argument("--no-vacuum", action="store_true", help="do not vacuum the database once converted")
+args = parser.parse_args()
+
+trip_data = OverviewDatabase()
+trip_data.connect_to_database(args.database_filepath)
+if trip_data.database is None:
+    sys.exit("Database %s does not exist" % args.database_filepath)
+
+size = os.path.getsize(args.database_filepath)
+if not trip_data.compact and not trip_data.convert_to_compact(vacuum=not args.no_vacuum):
+    sys.exit("Failed to convert the database to the compact storage")
+print("Database size: %d -> %d bytes" % (size, os.path.getsize(args.database_filepath)))
+
+trip_data.close_database()
+sys.exit(0)
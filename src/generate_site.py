@@ -2,22 +2,30 @@
 # This script will retrieve the raw data from the influx data from the last update,
 # store the data in a custom sql database and generate the site
 
-import io
+# Only the light modules are imported before the update check, the pipeline modules (pandas, folium, influxdb, ...)
+# are imported once an update is needed
 import os
 import yaml
 import sys
-import time
 import logging
-import datetime
-from methods import *
-from influxdb import DataFrameClient
-from OverviewDatabase import OverviewDatabase
+import argparse
+from datetime import datetime, timedelta
+from site_update import read_last_update
 
 
 # ----------------------------------------------------------------------------------------------------------------------
 # Read script parameters
 # ----------------------------------------------------------------------------------------------------------------------
-path_to_conf = os.path.join("/etc/capsule/trip_overview/config.yaml")
+parser = argparse.ArgumentParser(description="Retrieve the new gps positions and generate the trip overview site")
+parser.add_argument("--config", default="/etc/capsule/trip_overview/config.yaml", help="path of the configuration")
+parser.add_argument("--daemon", action="store_true",
+                    help="keep running: ingest the new positions and render the site periodically (daemon section of "
+                         "the configuration) until SIGTERM")
+parser.add_argument("--profile", metavar="FOLDER",
+                    help="profile this run (cProfile and tracemalloc, slower) and dump the results in FOLDER")
+args = parser.parse_args()
+
+path_to_conf = args.config
 # If the default configuration is not install, then configure w/ the default one
 if not os.path.exists(path_to_conf):
     sys.exit("Configuration file %s does not exists. Please reinstall the app" % path_to_conf)
@@ -28,21 +36,17 @@ with open(path_to_conf, "r") as file:
 # ----------------------------------------------------------------------------------------------------------------------
 # Initiate variables
 # ----------------------------------------------------------------------------------------------------------------------
-connected = False
+last_update_filepath = conf.get("last_update_filepath", "/etc/capsule/trip_overview/last_site_update.txt")
 logging.basicConfig(
-    filename="/var/log/capsule/trip_overview.log",
+    filename=conf.get("log_filepath", "/var/log/capsule/trip_overview.log"),
     filemode="a",
     level=logging.DEBUG if conf["debug"] else logging.INFO,
     format="%(asctime)s %(levelname)s:%(message)s",
     datefmt='%m/%d/%Y %I:%M:%S %p')
 
-# Influxbd client
-influxdb_client =  DataFrameClient(conf["influxdb"]["url"], conf["influxdb"]["port"], conf["influxdb"]["user"], conf["influxdb"]["pass"], conf["influxdb"]["database"])
-
-# Overview database
-logging.info("connect to database located in " + conf["database_filepath"])
-trip_data = OverviewDatabase()
-trip_data.connect_to_database(conf["database_filepath"], True)
+if args.profile:
+    from instrumentation import get_instrumentation
+    get_instrumentation().start_profiling(args.profile)
 
 
 # ----------------------------------------------------------------------------------------------------------------------
@@ -50,30 +54,42 @@ trip_data.connect_to_database(conf["database_filepath"], True)
 # ----------------------------------------------------------------------------------------------------------------------
 try:
     # Check when the site was updated, if first time then use yesterday’s date
-    now = datetime.now()
-    last_update = datetime(now.year, now.month, now.day-1, now.hour, now.minute, now.second)
-    if os.path.exists("/etc/capsule/trip_overview/last_site_update.txt"):
-        with open("/etc/capsule/trip_overview/last_site_update.txt", "r") as f:
-            isoformat_date = f.readline().strip("\n")
-            last_update = datetime.fromisoformat(isoformat_date)
-            logging.info("last update of the site was " + isoformat_date)
-    
+    now = datetime.utcnow()
+    last_update = now - timedelta(days=1)
+    stored_update = read_last_update(last_update_filepath)
+    if stored_update is not None:
+        last_update = stored_update
+        logging.info("last update of the site was " + last_update.isoformat() + " (UTC)")
+
+    if args.daemon:
+        from influxdb import DataFrameClient
+        from TripOverviewService import TripOverviewService
+
+        # Resident mode, until SIGTERM: the database and the caches stay warm between the cycles
+        influxdb_client = DataFrameClient(conf["influxdb"]["url"], conf["influxdb"]["port"], conf["influxdb"]["user"],
+                                          conf["influxdb"]["pass"], conf["influxdb"]["database"])
+        TripOverviewService(conf, influxdb_client).run()
     # Check if the last time the trip overview is generated is older than 12h (or 60*60*12=43200s) at least
-    if (now - last_update).seconds > 43200:
-        # Get the datas from influxdb with some grouping policies
-        df = retrieve_influxdb_data(
-            [last_update.isoformat(), now.isoformat()],
-            influxdb_client, "5s")
-        
-        # Save the digests data in a different database
-        trip_data.commit_dataframe(df)
-
-        logging.info("Generate Trip overview at "+conf["folium_site_output_path"])
-        create_site(trip_data, conf["folium_site_output_path"], now.strftime("%Y_%m_%d"), conf["map_generation"]["url"])
-
-        # Store last update of site
-        with open("/etc/capsule/trip_overview/last_site_update.txt", "w+") as f:
-            f.write(str(now.isoformat()))
+    elif (now - last_update).total_seconds() > 43200:
+        from influxdb import DataFrameClient
+        from TripOverviewService import TripOverviewService
+        from instrumentation import get_instrumentation
+
+        # Stage instrumentation (log and metrics files)
+        get_instrumentation().enable()
+
+        # Influxbd client
+        influxdb_client = DataFrameClient(conf["influxdb"]["url"], conf["influxdb"]["port"], conf["influxdb"]["user"],
+                                          conf["influxdb"]["pass"], conf["influxdb"]["database"])
+
+        # Get the datas from influxdb, save them in the overview database and generate the site
+        service = TripOverviewService(conf, influxdb_client)
+        service.ingest(last_update, now)
+        service.render(now)
+        service.close()
+
+        # Write the metrics of the stages
+        service.write_metrics()
     else:
         print("Trip overview already updated")
         logging.info("Trip overview already updated")
@@ -81,5 +97,9 @@ except KeyboardInterrupt:
     logging.info("Trip overview generation aborted by user")
     pass
 
+if args.profile:
+    for profile_filepath in get_instrumentation().stop_profiling():
+        logging.info("Profile dumped in " + profile_filepath)
+
 logging.info("Stop script")
 sys.exit(0)
@@ -0,0 +1,308 @@
+import numpy as np
+
+EARTH_RADIUS_KM = 6371.0  # mean earth radius in km
+
+
+def haversine(latitude1, longitude1, latitude2, longitude2, radius=EARTH_RADIUS_KM):
+    """
+    Vectorized haversine formula, works on scalars or numpy arrays (broadcasted element-wise)
+    The formulation (atan2) is the same as the former scalar `math` implementations, results match them
+    within 1e-9 km (float64 rounding only) for the same earth radius.
+    :param latitude1: decimal latitude(s) of the origin(s)
+    :param longitude1: decimal longitude(s) of the origin(s)
+    :param latitude2: decimal latitude(s) of the destination(s)
+    :param longitude2: decimal longitude(s) of the destination(s)
+    :param radius: earth radius in km (6371 by default)
+    :return: distance(s) in km
+    """
+    latitude1 = np.radians(np.asarray(latitude1, dtype=np.float64))
+    longitude1 = np.radians(np.asarray(longitude1, dtype=np.float64))
+    latitude2 = np.radians(np.asarray(latitude2, dtype=np.float64))
+    longitude2 = np.radians(np.asarray(longitude2, dtype=np.float64))
+
+    a = np.sin((latitude2 - latitude1) / 2) ** 2 + np.cos(latitude1) * np.cos(latitude2) \
+        * np.sin((longitude2 - longitude1) / 2) ** 2
+    c = 2 * np.arctan2(np.sqrt(a), np.sqrt(1 - a))
+    return radius * c
+
+
+def pairwise_distance(latitudes_a, longitudes_a, latitudes_b, longitudes_b, radius=EARTH_RADIUS_KM):
+    """
+    Distance matrix between two sets of gps positions
+    :param latitudes_a: array of n latitudes
+    :param longitudes_a: array of n longitudes
+    :param latitudes_b: array of m latitudes
+    :param longitudes_b: array of m longitudes
+    :param radius: earth radius in km
+    :return: numpy array (n, m) of distances in km
+    """
+    latitudes_a = np.asarray(latitudes_a, dtype=np.float64)[:, np.newaxis]
+    longitudes_a = np.asarray(longitudes_a, dtype=np.float64)[:, np.newaxis]
+    return haversine(latitudes_a, longitudes_a,
+                     np.asarray(latitudes_b, dtype=np.float64)[np.newaxis, :],
+                     np.asarray(longitudes_b, dtype=np.float64)[np.newaxis, :], radius)
+
+
+def consecutive_distance(latitudes, longitudes, radius=EARTH_RADIUS_KM):
+    """
+    Distance between each gps position and the previous one
+    :param latitudes: array of latitudes
+    :param longitudes: array of longitudes
+    :param radius: earth radius in km
+    :return: numpy array of distances in km, same length as the input, the first value is 0
+    """
+    latitudes = np.asarray(latitudes, dtype=np.float64)
+    longitudes = np.asarray(longitudes, dtype=np.float64)
+    result = np.zeros(len(latitudes), dtype=np.float64)
+    if len(latitudes) > 1:
+        result[1:] = haversine(latitudes[:-1], longitudes[:-1], latitudes[1:], longitudes[1:], radius)
+    return result
+
+
+def cumulative_distance(latitudes, longitudes, start=0.0, radius=EARTH_RADIUS_KM):
+    """
+    Cumulative distance traveled along the gps positions
+    :param latitudes: array of latitudes
+    :param longitudes: array of longitudes
+    :param start: distance already traveled before the first position in km
+    :param radius: earth radius in km
+    :return: numpy array of cumulative distances in km, the first value is `start`
+    """
+    return start + np.cumsum(consecutive_distance(latitudes, longitudes, radius))
+
+
+def zoom_tolerance(zoom, latitude=0.0, pixels=1.0):
+    """
+    Ground size of web mercator pixels, to use as simplification tolerance for a map zoom level
+    :param zoom: map zoom level (0 to 18)
+    :param latitude: latitude where the resolution is computed
+    :param pixels: number of pixels
+    :return: tolerance in meters
+    """
+    return pixels * 156543.03392 * np.cos(np.radians(latitude)) / 2 ** zoom
+
+
+def simplify_polyline(latitudes, longitudes, tolerance, radius=EARTH_RADIUS_KM):
+    """
+    Douglas-Peucker simplification of a gps polyline, the distances to each segment are computed on all the
+    positions at once (equirectangular projection around the mean latitude, fine for a trip step)
+    :param latitudes: array of latitudes
+    :param longitudes: array of longitudes
+    :param tolerance: maximal distance in meters between the simplified and the original polyline
+    :param radius: earth radius in km
+    :return: numpy boolean mask of the positions to keep (the first and last ones are always kept)
+    """
+    latitudes = np.asarray(latitudes, dtype=np.float64)
+    longitudes = np.asarray(longitudes, dtype=np.float64)
+    keep = np.ones(len(latitudes), dtype=bool)
+    if len(latitudes) <= 2:
+        return keep
+    keep[1:-1] = False
+    y = np.radians(latitudes) * radius * 1000
+    x = np.radians(longitudes) * radius * 1000 * np.cos(np.radians(np.mean(latitudes)))
+
+    segments = [(0, len(latitudes) - 1)]
+    while segments:
+        first, last = segments.pop()
+        if last - first < 2:
+            continue
+        dx, dy = x[last] - x[first], y[last] - y[first]
+        px, py = x[first + 1:last] - x[first], y[first + 1:last] - y[first]
+        norm = np.hypot(dx, dy)
+        if norm == 0:
+            distances = np.hypot(px, py)
+        else:
+            distances = np.abs(dx * py - dy * px) / norm
+        farthest = int(np.argmax(distances))
+        if distances[farthest] > tolerance:
+            middle = first + 1 + farthest
+            keep[middle] = True
+            segments.append((first, middle))
+            segments.append((middle, last))
+    return keep
+
+
+def detect_stays(timestamps, latitudes, longitudes, speeds, radius, min_dwell, max_speed):
+    """
+    Stay points detection: the positions are grouped in runs of consecutive static positions (speed <= max_speed)
+    each one within `radius` of the previous one, a run is a stay if it lasts at least `min_dwell` and all its
+    positions are within `radius` of its first one. A logging gap while the vehicle is parked is part of the stay.
+    :param timestamps: array of timestamps, ordered
+    :param latitudes: array of latitudes
+    :param longitudes: array of longitudes
+    :param speeds: array of speeds
+    :param radius: maximal extent of a stay in meters
+    :param min_dwell: minimal duration of a stay in seconds
+    :param max_speed: maximal speed of a static position
+    :return: first indices of the stays, last indices of the stays, first index of the last run (the detection
+        can restart from there when positions are added)
+    """
+    timestamps = np.asarray(timestamps)
+    latitudes = np.asarray(latitudes, dtype=np.float64)
+    longitudes = np.asarray(longitudes, dtype=np.float64)
+    static = np.asarray(speeds, dtype=np.float64) <= max_speed
+    if len(timestamps) == 0:
+        return np.array([], dtype=np.int64), np.array([], dtype=np.int64), 0
+
+    breaks = np.ones(len(timestamps), dtype=bool)
+    breaks[1:] = ~static[:-1] | ~static[1:] | (consecutive_distance(latitudes, longitudes)[1:] * 1000 > radius)
+    firsts = np.flatnonzero(breaks)
+    lasts = np.append(firsts[1:] - 1, len(timestamps) - 1)
+    # Extent of each run: distance of its positions to its first one
+    runs = np.cumsum(breaks) - 1
+    extents = np.maximum.reduceat(
+        haversine(latitudes, longitudes, latitudes[firsts][runs], longitudes[firsts][runs]) * 1000, firsts)
+    stays = static[firsts] & (timestamps[lasts] - timestamps[firsts] >= min_dwell) & (extents <= radius)
+    return firsts[stays], lasts[stays], int(firsts[-1])
+
+
+def to_cartesian(latitudes, longitudes, radius=EARTH_RADIUS_KM):
+    """
+    Earth-centered cartesian coordinates of gps positions on a sphere
+    :param latitudes: array of latitudes
+    :param longitudes: array of longitudes
+    :param radius: earth radius in km
+    :return: numpy array (n, 3) of coordinates in meters
+    """
+    latitudes = np.radians(np.asarray(latitudes, dtype=np.float64))
+    longitudes = np.radians(np.asarray(longitudes, dtype=np.float64))
+    return radius * 1000 * np.column_stack([np.cos(latitudes) * np.cos(longitudes),
+                                            np.cos(latitudes) * np.sin(longitudes), np.sin(latitudes)])
+
+
+def segment_distance(points, starts, ends):
+    """
+    Distance of points to segments, row by row (cartesian coordinates)
+    :param points: array (n, 3)
+    :param starts: array (n, 3) of the first ends of the segments
+    :param ends: array (n, 3) of the last ends of the segments
+    :return: numpy array of n distances
+    """
+    directions = ends - starts
+    lengths = np.einsum("ij,ij->i", directions, directions)
+    projections = np.einsum("ij,ij->i", points - starts, directions)
+    ratios = np.clip(np.divide(projections, lengths, out=np.zeros_like(projections), where=lengths > 0), 0.0, 1.0)
+    return np.linalg.norm(points - starts - ratios[:, np.newaxis] * directions, axis=1)
+
+
+def _cell_keys(cells):
+    # One int64 per cell, 21 bits per axis (cells of 10 m or more)
+    cells = cells + 2 ** 20
+    return (cells[..., 0] << 42) | (cells[..., 1] << 21) | cells[..., 2]
+
+
+def route_deviation(route_latitudes, route_longitudes, latitudes, longitudes, route_segments=None, cell_size=250.0,
+                    max_pairs=2000000, radius=EARTH_RADIUS_KM):
+    """
+    Distance of gps positions to a route (polyline), with a grid index of the route instead of the n·m distances:
+    the route is cut in pieces no longer than cell_size, indexed by the cell of their middle, and each position is
+    compared to the pieces of the 27 cells around it. This is exact for the positions closer than half a cell to the
+    route, the others are searched again with cells 8 times larger.
+    :param route_latitudes: array of latitudes of the route
+    :param route_longitudes: array of longitudes of the route
+    :param latitudes: array of latitudes of the positions
+    :param longitudes: array of longitudes of the positions
+    :param route_segments: array of the segment of each route point (ex: GPX track segments), the consecutive points
+        of different segments are not joined. One segment if None
+    :param cell_size: size of the cells of the index in meters (10 m or more)
+    :param max_pairs: maximal number of position-piece distances computed at once (memory bound)
+    :param radius: earth radius in km
+    :return: numpy array of distances in meters (straight line, within 1 m of the great-circle distance up to 70 km)
+    """
+    points = to_cartesian(latitudes, longitudes, radius)
+    distances = np.full(len(points), np.inf)
+    route = to_cartesian(route_latitudes, route_longitudes, radius)
+    if len(points) == 0 or len(route) == 0:
+        return distances
+
+    # Segments between the consecutive points of a route segment, a single point is a segment of length 0
+    joined = np.ones(len(route) - 1, dtype=bool) if route_segments is None \
+        else np.asarray(route_segments)[1:] == np.asarray(route_segments)[:-1]
+    starts = np.vstack([route[:-1][joined], route])
+    ends = np.vstack([route[1:][joined], route])
+    # Pieces no longer than cell_size, their ends are on the sphere (a long chord is far below it)
+    pieces = np.maximum(np.ceil(np.linalg.norm(ends - starts, axis=1) / cell_size).astype(np.int64), 1)
+    segment_index = np.repeat(np.arange(len(starts)), pieces)
+    piece_index = np.arange(len(segment_index)) - np.repeat(np.cumsum(pieces) - pieces, pieces)
+    directions = (ends - starts)[segment_index] / pieces[segment_index][:, np.newaxis]
+    piece_starts = starts[segment_index] + piece_index[:, np.newaxis] * directions
+    piece_ends = piece_starts + directions
+    for nodes in (piece_starts, piece_ends):
+        norms = np.linalg.norm(nodes, axis=1)[:, np.newaxis]
+        np.divide(nodes * radius * 1000, norms, out=nodes, where=norms > 0)
+
+    offsets = np.array(np.meshgrid([-1, 0, 1], [-1, 0, 1], [-1, 0, 1], indexing="ij")).reshape(3, -1).T
+    unresolved = np.arange(len(points))
+    cell = float(cell_size)
+    while len(unresolved):
+        piece_keys = _cell_keys(np.floor((piece_starts + piece_ends) / 2 / cell).astype(np.int64))
+        order = np.argsort(piece_keys, kind="stable")
+        piece_keys = piece_keys[order]
+        # Range of pieces of the 27 cells around each position
+        neighbour_keys = _cell_keys(np.floor(points[unresolved] / cell).astype(np.int64)[:, np.newaxis, :] + offsets)
+        firsts = np.searchsorted(piece_keys, neighbour_keys, side="left")
+        counts = np.searchsorted(piece_keys, neighbour_keys, side="right") - firsts
+        pairs = counts.sum(axis=1)
+        # Positions processed by batches of at most max_pairs distances
+        cumulative_pairs = np.cumsum(counts.sum(axis=1))
+        batch_start = 0
+        while batch_start < len(unresolved):
+            done_pairs = cumulative_pairs[batch_start - 1] if batch_start else 0
+            batch_end = max(int(np.searchsorted(cumulative_pairs, done_pairs + max_pairs, side="right")),
+                            batch_start + 1)
+            batch_counts = counts[batch_start:batch_end].ravel()
+            position_index = np.repeat(np.repeat(np.arange(batch_start, batch_end), len(offsets)), batch_counts)
+            pieces_index = order[np.repeat(firsts[batch_start:batch_end].ravel(), batch_counts)
+                                 + np.arange(batch_counts.sum())
+                                 - np.repeat(np.cumsum(batch_counts) - batch_counts, batch_counts)]
+            nearest = np.full(batch_end - batch_start, np.inf)
+            np.minimum.at(nearest, position_index - batch_start, segment_distance(
+                points[unresolved[position_index]], piece_starts[pieces_index], piece_ends[pieces_index]))
+            distances[unresolved[batch_start:batch_end]] = nearest
+            batch_start = batch_end
+        # A piece closer than half a cell has its middle in one of the 27 cells
+        unresolved = unresolved[distances[unresolved] > cell / 2]
+        cell *= 8
+    return distances
+
+
+def encode_polyline(latitudes, longitudes, precision=5):
+    """
+    Encoded polyline of gps positions (Google format): the differences between consecutive positions, in units of
+    10^-precision degree, written as 5-bit chunks of printable characters. About 4 characters per position of a
+    simplified trace instead of about 20 for the JSON coordinates
+    :param latitudes: array of latitudes
+    :param longitudes: array of longitudes
+    :param precision: number of decimals kept (5 is about 1 m)
+    :return: encoded string
+    """
+    values = np.round(np.column_stack([np.asarray(latitudes, dtype=np.float64),
+                                       np.asarray(longitudes, dtype=np.float64)]) * 10 ** precision).astype(np.int64)
+    deltas = np.diff(values, axis=0, prepend=np.zeros((1, 2), dtype=np.int64)).ravel()
+    zigzag = (deltas << 1) ^ (deltas >> 63)
+    # Chunks of 5 bits, least significant first, all the chunks of a value but its last have the 0x20 bit
+    shifts = np.arange(0, 64, 5)
+    chunks = (zigzag[:, np.newaxis] >> shifts) & 0x1f
+    counts = 1 + np.count_nonzero((zigzag[:, np.newaxis] >> shifts[1:]) > 0, axis=1)
+    written = np.arange(len(shifts)) < counts[:, np.newaxis]
+    chunks |= np.where(np.arange(len(shifts)) < counts[:, np.newaxis] - 1, 0x20, 0)
+    return (chunks[written] + 63).astype(np.uint8).tobytes().decode("ascii")
+
+
+def decode_polyline(encoded, precision=5):
+    """
+    :param encoded: output of encode_polyline
+    :param precision: number of decimals of the encoding
+    :return: numpy arrays of the latitudes and the longitudes
+    """
+    values = []
+    value = shift = 0
+    for byte in encoded.encode("ascii"):
+        byte -= 63
+        value |= (byte & 0x1f) << shift
+        shift += 5
+        if byte < 0x20:
+            values.append(~(value >> 1) if value & 1 else value >> 1)
+            value = shift = 0
+    positions = np.cumsum(np.array(values, dtype=np.int64).reshape(-1, 2), axis=0) / 10 ** precision
+    return positions[:, 0], positions[:, 1]
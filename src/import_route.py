@@ -0,0 +1,36 @@
+#!/usr/bin/python3
+# Import a planned route (GPX or KML) in the trip database, it is drawn on the site as the "Itinéraire prévu" layer.
+# The file is streamed, a route of the same name is replaced
+# Usage: python3 import_route.py <database_filepath> <route.gpx|route.kml> [--name NAME]
+
+import os
+import sys
+import argparse
+from OverviewDatabase import OverviewDatabase
+from routes import read_route
+
+
+parser = argparse.ArgumentParser(description="Import a planned route (GPX or KML) in the trip database")
+parser.add_argument("database_filepath", help="path of the trip database")
+parser.add_argument("route_filepath", help="path of the GPX or KML file")
+parser.add_argument("--name", help="name of the route (default: name of the file)")
+args = parser.parse_args()
+
+trip_data = OverviewDatabase()
+trip_data.connect_to_database(args.database_filepath, True)
+if trip_data.database is None:
+    sys.exit("Database %s can not be opened" % args.database_filepath)
+
+name = args.name or os.path.splitext(os.path.basename(args.route_filepath))[0]
+points = trip_data.import_route(name, read_route(args.route_filepath))
+if not points:
+    sys.exit("No point imported from %s" % args.route_filepath)
+print("%d points imported in the route %s" % (points, name))
+
+deviation = trip_data.get_route_deviation(name)
+if deviation is not None and not deviation.empty:
+    print("Deviation of the trip from the route: %.0f m on average, %.0f m at most"
+          % (deviation["deviation"].mean(), deviation["deviation"].max()))
+
+trip_data.close_database()
+sys.exit(0)
@@ -0,0 +1,194 @@
+import os
+import time
+import json
+import logging
+import pstats
+import cProfile
+import resource
+import tracemalloc
+import contextlib
+from datetime import datetime
+
+# Metrics written in the Prometheus text format, per stage
+prometheus_metrics = [("seconds", "trip_overview_stage_seconds", "Wall time of the stage in seconds"),
+                      ("rows", "trip_overview_stage_rows", "Number of rows processed by the stage"),
+                      ("peak_rss_bytes", "trip_overview_stage_peak_rss_bytes",
+                       "Peak resident set size of the process (and its children) at the end of the stage"),
+                      ("bytes_written", "trip_overview_stage_bytes_written", "Bytes written by the stage")]
+
+
+def peak_rss_bytes():
+    """
+    :return: peak resident set size of the process and of its terminated children (map rendering processes)
+    """
+    return max(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+               resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss) * 1024
+
+
+def written_bytes():
+    """
+    :return: bytes written by the process so far (Linux /proc/self/io), 0 if it is not available
+    """
+    try:
+        with open("/proc/self/io", "r") as file:
+            for line in file:
+                if line.startswith("wchar:"):
+                    return int(line.split()[1])
+    except OSError:
+        pass
+    return 0
+
+
+class Instrumentation:
+    """This class records the stages (spans) of a run: wall time, rows processed, peak RSS and bytes written.
+    The spans are only recorded when it is enabled, otherwise span() does nothing.
+    Usage:
+     instrumentation = get_instrumentation()
+     instrumentation.enable()
+     with span("sqlite_commit", rows=len(df)) as record:
+        ...
+        record["bytes_written"] += bytes written by other processes
+     instrumentation.write_json("metrics.json")"""
+
+    def __init__(self):
+        """ Initiation, disabled """
+        self.enabled = False
+        self.spans = []
+        self.profiler = None
+        self.profile_folder = None
+
+    def enable(self):
+        """ Record the spans (the previous ones are removed) """
+        self.enabled = True
+        self.spans = []
+
+    def disable(self):
+        """ Stop recording the spans """
+        self.enabled = False
+
+    @contextlib.contextmanager
+    def span(self, name, rows=0):
+        """
+        Record a stage
+        :param name: name of the stage, ex: "sqlite_commit"
+        :param rows: number of rows processed (can also be set on the yielded record)
+        :return: context manager yielding the record (dict) of the span
+        """
+        record = {"name": name, "rows": int(rows), "bytes_written": 0}
+        if not self.enabled:
+            yield record
+            return
+        start_time = time.perf_counter()
+        start_written = written_bytes()
+        try:
+            yield record
+        finally:
+            record["seconds"] = round(time.perf_counter() - start_time, 6)
+            record["bytes_written"] += written_bytes() - start_written
+            record["peak_rss_bytes"] = peak_rss_bytes()
+            record["rows"] = int(record["rows"])
+            self.spans.append(record)
+            logging.info("Stage %s: %.3f s, %d rows, peak RSS %.1f MB, %.1f kB written", name, record["seconds"],
+                         record["rows"], record["peak_rss_bytes"] / 2 ** 20, record["bytes_written"] / 1024)
+
+    def totals(self):
+        """
+        :return: dict of the spans aggregated by name (sum of seconds, rows and bytes written, max of the peak RSS),
+            in the order of their first record
+        """
+        totals = {}
+        for record in self.spans:
+            total = totals.setdefault(record["name"], {"seconds": 0.0, "rows": 0, "peak_rss_bytes": 0,
+                                                       "bytes_written": 0, "count": 0})
+            total["seconds"] += record["seconds"]
+            total["rows"] += record["rows"]
+            total["bytes_written"] += record["bytes_written"]
+            total["peak_rss_bytes"] = max(total["peak_rss_bytes"], record["peak_rss_bytes"])
+            total["count"] += 1
+        return totals
+
+    def write_json(self, filepath):
+        """
+        Write the spans and their totals in a JSON file
+        :param filepath: path of the file, replaced atomically
+        """
+        self._write(filepath, json.dumps({"created": datetime.now().isoformat(), "spans": self.spans,
+                                          "totals": self.totals()}, indent=2))
+
+    def write_prometheus(self, filepath):
+        """
+        Write the totals of the spans in the Prometheus text format (ex: for the node_exporter textfile collector)
+        :param filepath: path of the file, replaced atomically
+        """
+        totals = self.totals()
+        lines = []
+        for key, metric, description in prometheus_metrics:
+            lines.append(f"# HELP {metric} {description}")
+            lines.append(f"# TYPE {metric} gauge")
+            for name, total in totals.items():
+                lines.append(f'{metric}{{stage="{name}"}} {total[key]}')
+        lines.append("# HELP trip_overview_last_run_timestamp_seconds End of the last instrumented run")
+        lines.append("# TYPE trip_overview_last_run_timestamp_seconds gauge")
+        lines.append(f"trip_overview_last_run_timestamp_seconds {time.time():.0f}")
+        self._write(filepath, "\n".join(lines) + "\n")
+
+    @staticmethod
+    def _write(filepath, content):
+        with open(filepath + ".tmp", "w") as file:
+            file.write(content)
+        os.replace(filepath + ".tmp", filepath)
+
+    def start_profiling(self, folder):
+        """
+        Start cProfile and tracemalloc, for one run (it slows the run down)
+        :param folder: folder of the dumps, created if it does not exist
+        """
+        os.makedirs(folder, exist_ok=True)
+        self.profile_folder = folder
+        tracemalloc.start()
+        self.profiler = cProfile.Profile()
+        self.profiler.enable()
+
+    def stop_profiling(self, top=50):
+        """
+        Stop the profiling and dump: <folder>/profile_<date>.prof (cProfile, open with pstats or snakeviz),
+        <folder>/profile_<date>.txt (the `top` functions by cumulative time and the `top` allocation sites)
+        and <folder>/profile_<date>.tracemalloc (tracemalloc snapshot)
+        :param top: number of lines of the text report
+        :return: list of the dumped files, empty if the profiling was not started
+        """
+        if self.profiler is None:
+            return []
+        self.profiler.disable()
+        snapshot = tracemalloc.take_snapshot()
+        tracemalloc.stop()
+        prefix = os.path.join(self.profile_folder, "profile_" + datetime.now().strftime("%Y_%m_%d_%H%M%S"))
+        self.profiler.dump_stats(prefix + ".prof")
+        snapshot.dump(prefix + ".tracemalloc")
+        with open(prefix + ".txt", "w") as file:
+            pstats.Stats(self.profiler, stream=file).sort_stats("cumulative").print_stats(top)
+            file.write("Top %d allocation sites\n" % top)
+            for statistic in snapshot.statistics("lineno")[:top]:
+                file.write(str(statistic) + "\n")
+        self.profiler = None
+        return [prefix + ".prof", prefix + ".txt", prefix + ".tracemalloc"]
+
+
+instrumentation = None
+
+
+def get_instrumentation():
+    """
+    :return: the process-wide instrumentation, created (disabled) at the first call
+    """
+    global instrumentation
+    if instrumentation is None:
+        instrumentation = Instrumentation()
+    return instrumentation
+
+
+def span(name, rows=0):
+    """
+    Record a stage with the process-wide instrumentation, see Instrumentation.span
+    """
+    return get_instrumentation().span(name, rows)
@@ -0,0 +1,51 @@
+#!/usr/bin/python3
+# Serve the live map of the trip (data/live_map.html) and its delta endpoints from the trip database: followers load
+# the steps once and then only the new positions. The database is only read, the positions are written by
+# generate_site.py --daemon or mqtt_ingest.py
+# Usage: python3 live_server.py [--config /etc/capsule/trip_overview/config.yaml] [--port 8090]
+
+import sys
+import signal
+import logging
+import argparse
+import yaml
+from OverviewDatabase import OverviewDatabase
+from LiveMapServer import LiveMapServer
+
+
+parser = argparse.ArgumentParser(description="Serve the live map of the trip")
+parser.add_argument("--config", default="/etc/capsule/trip_overview/config.yaml", help="path of the configuration")
+parser.add_argument("--host", help="address to listen on (live_server.host of the configuration by default)")
+parser.add_argument("--port", type=int, help="port to listen on (live_server.port of the configuration by default)")
+args = parser.parse_args()
+
+with open(args.config, "r") as file:
+    conf = yaml.load(file, Loader=yaml.FullLoader)
+live_conf = conf.get("live_server") or {}
+logging.basicConfig(
+    filename=conf.get("log_filepath", "/var/log/capsule/trip_overview.log"),
+    filemode="a",
+    level=logging.DEBUG if conf["debug"] else logging.INFO,
+    format="%(asctime)s %(levelname)s:%(message)s",
+    datefmt='%m/%d/%Y %I:%M:%S %p')
+
+trip_data = OverviewDatabase()
+trip_data.connect_to_database(conf["database_filepath"])
+if trip_data.database is None:
+    sys.exit("Database %s can not be opened" % conf["database_filepath"])
+
+
+def stop(signum, frame):
+    raise KeyboardInterrupt
+
+
+signal.signal(signal.SIGTERM, stop)
+server = LiveMapServer(trip_data, tiles_url=live_conf.get("tiles_url") or conf["map_generation"]["url"],
+                       poll_interval=live_conf.get("poll_interval", 30))
+try:
+    server.serve(args.host or live_conf.get("host", "0.0.0.0"), args.port or live_conf.get("port", 8090))
+except KeyboardInterrupt:
+    pass
+logging.info("Live map server stopped: %s" % server.stats)
+trip_data.close_database()
+sys.exit(0)
@@ -1,15 +1,26 @@
-from influxdb import DataFrameClient
 from datetime import datetime, timedelta
-from typing import List
+from typing import List, Callable, TYPE_CHECKING
+import time
+import logging
+import resource
 import pandas as pd
 import numpy as np
-from math import sin, cos, sqrt, atan2, radians
 
 from OverviewDatabase import OverviewDatabase
-import folium
-import folium.plugins
-import base64
-import branca
+from geodesy import haversine, cumulative_distance, simplify_polyline, zoom_tolerance, encode_polyline, \
+    decode_polyline
+from instrumentation import span
+import os
+import re
+import gzip
+import json
+import hashlib
+import concurrent.futures
+import geojson
+
+if TYPE_CHECKING:
+    # Only for the annotations, influxdb is imported by the caller that creates the client
+    from influxdb import DataFrameClient
 
 def dist_from_gps(coord_a, coord_b):
     """
@@ -18,73 +29,134 @@ def dist_from_gps(coord_a, coord_b):
     param: decimal gps coord_b [lat, lon]
     result: distance between two gps coords
     """
-    R = 6373.0 # approximate radius of earth in km
+    return float(haversine(coord_a[0], coord_a[1], coord_b[0], coord_b[1], radius=6373.0))
+
+gps_topic_prefix = "gps_measure/"
+
+
+def join_influxdb_topics(result) -> pd.DataFrame:
+    """
+    Join the series of a query grouped by topic on their timestamp
+    param: result of DataFrameClient.query, dict keyed by ("mqtt_consumer", (("topic", "gps_measure/..."),))
+    result: DataFrame indexed by time with one column per gps_measure topic (latitude, longitude, ...)
+    """
+    columns = {}
+    for key, frame in (result or {}).items():
+        tags = dict(key[1]) if isinstance(key, tuple) else {}
+        topic = tags.get("topic", "")
+        if topic.startswith(gps_topic_prefix) and not frame.empty:
+            columns[topic[len(gps_topic_prefix):]] = frame["mean"]
+    if not columns:
+        return pd.DataFrame(columns=["latitude", "longitude", "altitude", "speed"],
+                            index=pd.DatetimeIndex([], tz="UTC"), dtype=float)
+    # Only keep the timestamps where all the topics are known
+    return pd.concat(columns, axis=1, join="inner").dropna(axis=0)
 
-    lat1 = radians(coord_a[0])
-    lon1 = radians(coord_a[1])
-    lat2 = radians(coord_b[0])
-    lon2 = radians(coord_b[1])
 
-    dlon = lon2 - lon1
-    dlat = lat2 - lat1
+def stream_influxdb_data(start: datetime, end: datetime, influxdb_client: "DataFrameClient", resampling_time: str,
+                         window: timedelta = timedelta(hours=6)):
+    """
+    Retrieve all the gps_measure topics with one grouped query per time window
+    param: start, end: time range (UTC)
+    param: influxdb_client: DataFrameClient (or any object with the same query method)
+    param: resampling_time: InfluxQL GROUP BY time interval, ex: "5s"
+    param: window: duration of each query, the windows are aligned on multiples of this duration. The response of a
+        query is held in memory at once (DataFrameClient collects the chunks of a chunked response), the window
+        bounds it
+    result: generator of DataFrame (see join_influxdb_topics), one per window
+    """
+    window_start = pd.Timestamp(start)
+    end = pd.Timestamp(end)
+    while window_start < end:
+        window_end = min(window_start.floor(window) + window, end)
+        result = influxdb_client.query(
+            "SELECT MEAN(\"value\") FROM \"autogen\".\"mqtt_consumer\" WHERE \"topic\" =~ /^gps_measure\\//"
+            " AND time >= '" + window_start.isoformat() + "Z' AND time < '" + window_end.isoformat() + "Z'"
+            " GROUP BY time(" + resampling_time + "), \"topic\" fill(previous)")
+        yield join_influxdb_topics(result)
+        window_start = window_end
 
-    a = sin(dlat / 2)**2 + cos(lat1) * cos(lat2) * sin(dlon / 2)**2
-    c = 2 * atan2(sqrt(a), sqrt(1 - a))
 
-    return R * c
+influxdb_position_columns = ["latitude", "longitude", "altitude", "speed", "km", "current_step", "timestamp"]
 
-def retrieve_influxdb_data(timestamps,  influxdb_client: DataFrameClient, resampling_time: str) -> pd.DataFrame():
-    start = (datetime.fromisoformat(timestamps[0]) + timedelta(seconds=-5)).isoformat()
-    end = (datetime.fromisoformat(timestamps[-1]) + timedelta(seconds=5)).isoformat()
-    # Query the lat and lon values inside of the first and last + margin timestamps
-    def query(topic: str):    
-        result = influxdb_client.query("SELECT MEAN(\"value\") FROM \"autogen\".\"mqtt_consumer\" WHERE (\"topic\"\
-            = '"+topic+"') AND time >= '"+start+"Z' AND time <= '"+end+"Z' GROUP BY time("+resampling_time+") fill(previous)")
-        res_pd = pd.DataFrame()
-        if result:
-            res_pd = result["mqtt_consumer"]
 
-        # Drop NaN
-        res_pd.dropna(axis=0, inplace=True)
-        return res_pd
-    latitude = query("gps_measure/latitude")
-    longitude = query("gps_measure/longitude")
-    altitude = query("gps_measure/altitude")
-    speed = query("gps_measure/speed")
+def stream_influxdb_positions(timestamps, influxdb_client: "DataFrameClient", resampling_time: str,
+                              window: timedelta = timedelta(hours=6)):
+    """
+    Positions of a time range, one DataFrame per window of the query, so that a long range is processed (ex:
+    committed) window by window with only one window in memory. The cleaning carries over the windows: positions
+    with the coordinates of the previous one are removed, only the first parked position (speed < 1) is kept and
+    the km continue from the previous window
+    param: timestamps: [start, ..., end] isoformat (UTC), bounds included
+    param: influxdb_client, resampling_time, window: see stream_influxdb_data
+    result: generator of DataFrame of influxdb_position_columns indexed by time, the empty windows are skipped
+    """
+    start = datetime.fromisoformat(timestamps[0]) + timedelta(seconds=-5)
+    end = datetime.fromisoformat(timestamps[-1]) + timedelta(seconds=5)
+    previous = None  # latitude, longitude and km of the last position of the previous windows
+    parked = False  # a parked position is already kept
+    # Query the gps values inside of the first and last + margin timestamps
+    for results in stream_influxdb_data(start, end, influxdb_client, resampling_time, window):
+        results = results[~results.index.duplicated(keep="first")]
+
+        # Clean the values to one specific DataFrame
+        results = results.reindex(columns=["latitude", "longitude", "altitude", "speed"]).dropna(axis=0)
 
+        # Remove duplicates (if the vehicle hasn't moved)
+        results = results.drop_duplicates(subset=["latitude", "longitude"], keep="last")
+        if previous is not None:
+            results = results[(results["latitude"] != previous[0]) | (results["longitude"] != previous[1])]
 
-    # Clean the values to one specific DataFrame
-    results = pd.DataFrame()
-    results = latitude.copy()
-    results.rename(columns={"index": "index", "mean": "latitude"}, inplace=True) # rename for latitude
-    results["longitude"] = longitude["mean"]
-    results["altitude"] = altitude["mean"]
-    results["speed"] = speed["mean"]
-    results["km"] = 0 # Fill the km of 0
+        # Remove data when the vehicle hasn't moved based on its speed, all but the first
+        parked_index = results.index[results["speed"] < 1.0]
+        results = results.drop(parked_index if parked else parked_index[1:])
+        parked = parked or len(parked_index) > 0
+        if results.empty:
+            continue
 
-    # Remove duplicates (if the vehicle hasn't moved)
-    results.drop_duplicates(subset=['latitude', 'longitude'], keep='last', inplace=True)
+        # This is computed from the last and current gps position
+        latitudes, longitudes = results["latitude"].values, results["longitude"].values
+        if previous is None:
+            km = cumulative_distance(latitudes, longitudes, radius=6373.0)
+        else:
+            km = cumulative_distance(np.r_[previous[0], latitudes], np.r_[previous[1], longitudes], start=previous[2],
+                                     radius=6373.0)[1:]
+        results["km"] = km
+        previous = latitudes[-1], longitudes[-1], km[-1]
 
-    # Remove data when the vehicle hasn't moved based on its speed
-    results.drop(results[results["speed"] < 1.0].index[1:], inplace=True) # Remove all but the first
+        results["current_step"] = 0  # TODO for now the current step will always be 0
+        results["timestamp"] = results.index.view(np.int64) // 10 ** 9  # Reset index to get timestamp as a column
 
-    # This is computed from the last and current gps position
-    for i in range(1, len(results["longitude"])):
-        results["km"].iloc[i] = results["km"].iloc[i-1] + dist_from_gps(
-            [results["latitude"].iloc[i-1], results["longitude"].iloc[i-1]],
-            [results["latitude"].iloc[i], results["longitude"].iloc[i]]) # TODO Call from df can be optimized
-    results.columns = ["latitude", "longitude", "altitude", "speed", "km"] # Sort correctly the columns
+        # Filter out only on timestamps
+        mask = (results.index >= timestamps[0]) & (results.index <= timestamps[-1])
+        if mask.any():
+            yield results.loc[mask, influxdb_position_columns]
 
-    # Filter out only on timestamps
-    mask = (results.index >= timestamps[0]) & (results.index <= timestamps[-1])
 
-    results['current_step'] = [0]*len(results.index) # TODO for now the current step will always be 0
-    results['timestamp'] = results.index # Reset index to get timestamp as a column
-    results["timestamp"] = results["timestamp"].apply(lambda x: int(datetime.fromisoformat(str(x)).timestamp()))
+def retrieve_influxdb_data(timestamps,  influxdb_client: "DataFrameClient", resampling_time: str,
+                           window: timedelta = timedelta(hours=6), stats: dict = None) -> pd.DataFrame():
+    """
+    Positions of a time range, at once (see stream_influxdb_positions to process them window by window)
+    param: timestamps, influxdb_client, resampling_time, window: see stream_influxdb_positions
+    param: stats: filled with the rows, seconds, rows_per_second and peak_memory_kb of the retrieval
+    result: DataFrame of influxdb_position_columns indexed by time
+    """
+    start_time = time.time()
+    frames = list(stream_influxdb_positions(timestamps, influxdb_client, resampling_time, window))
+    results = pd.concat(frames) if frames else pd.DataFrame(columns=influxdb_position_columns,
+                                                            index=pd.DatetimeIndex([], tz="UTC"))
 
-    results.astype({"km": int}) # set km as int
+    # Report the retrieval performance
+    duration = time.time() - start_time
+    retrieval_stats = {"rows": len(results.index), "seconds": round(duration, 3),
+                       "rows_per_second": round(len(results.index) / duration, 1) if duration > 0 else 0.0,
+                       "peak_memory_kb": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss}
+    logging.info("InfluxDB retrieval: {rows} rows in {seconds}s ({rows_per_second} rows/s),"
+                 " peak memory {peak_memory_kb} kB".format(**retrieval_stats))
+    if stats is not None:
+        stats.update(retrieval_stats)
 
-    return results.loc[mask]
+    return results
 
 
 legend_html = """
@@ -179,83 +251,441 @@ legend_html = """
 </style>
 {{% endmacro %}}"""
 
-def create_site(trip_data: OverviewDatabase, site_folder: str, date, url):
-    gps_trace = trip_data.get_road_trip_gps_trace()
-    center_of_map = gps_trace[["latitude", "longitude"]].iloc[-1].tolist() # Last updated GPS position
-    whole_trip_trace = gps_trace[["latitude", "longitude"]]
-    
-    # Maps
-    offline_map = [folium.Map(center_of_map, tiles=url, attr="Capsule map"), "offline"]
-    online_map = [folium.Map(center_of_map, tiles="OpenStreetMap", attr="Capsule map"), "online"]
-
-    for map_data in [offline_map, online_map]:
-        map = map_data[0]
-
-        # Markers group
-        sleep_position_group = folium.FeatureGroup(name="Campements")
-        kw = {"prefix": "fa", "color": "blue", "icon": "bed"}
-        html = '<h1>{date}</h1><p>Etape {step}</p><p>Distance parcourue {km} km</p><p>Coordonnée GPS: {lat}, {lon}</p>'
-        icon = folium.Icon(**kw)
-
-        # TODO Handle case where the sub step trace length is not > 1
-        for current_step_trace_idx in range(gps_trace.index.values[-1] + 1):
-            current_step_trace = gps_trace.loc[current_step_trace_idx]
-            if len(current_step_trace) > 1:
-                distance_traveled_in_step = current_step_trace["km"].iloc[-1] - current_step_trace["km"].iloc[0]
-                date = current_step_trace["date"].iloc[0].day
-                """gif = "test.gif" # TODO
-                tooltip_html = '<h1>{date}</h1><p>Etape {step}</p><p>Distance parcourue {distance} km</p><img src={gif}>'\
-                    .format(date=distance_traveled_in_step,
-                            step=current_step_trace_idx,
-                            distance=distance_traveled_in_step,
-                            gif=gif)"""
-                folium.plugins.AntPath(
-                    locations=current_step_trace[["latitude", "longitude"]],
-                    dash_array=[10, 15],
-                    delay=800,
-                    weight=6,
-                    color="#F6FFF3",
-                    pulse_color="#000000",
-                    paused=False,
-                    reverse=False,
-                    #tooltip=tooltip_html TODO
-                ).add_to(map)
-            current_sleep_location = current_step_trace[["latitude", "longitude"]].iloc[-1].values
-            
-            folium.Marker(list(current_sleep_location),
-            icon=icon, tooltip=html.format(
-                date=datetime.strftime(current_step_trace["date"].iloc[-1], "%d %B %Y"),
-                step=current_step_trace_idx+1,
-                km=round(current_step_trace["km"].iloc[-1], 1),
-                lat=current_sleep_location[0], 
-                lon=current_sleep_location[1])).add_to(sleep_position_group)
-
-        # Add markers to map
-        sleep_position_group.add_to(map)
-        folium.LayerControl().add_to(map)
-        folium.plugins.LocateControl().add_to(map)
-
-        # Add fullscreen function
-        folium.plugins.Fullscreen(
-            title="Agrandir",
-            title_cancel="Annuler",
-            force_separate_button=True,
-        ).add_to(map)
-
-                
-        legend = branca.element.MacroElement()
-        legend._template = branca.element.Template(
-            legend_html.format(
-                travel_day= (gps_trace["date"].iloc[-1]-gps_trace["date"].iloc[0]).days, 
-                km=round(gps_trace["km"].iloc[-1], 1), 
-                country_crossed= len(gps_trace["current_country"].value_counts()), 
-                last_update="10 jun"))
-        map.get_root().add_child(legend)
-
-        # Limit bounds
-        map.fit_bounds(map.get_bounds())
-
-        map.save(site_folder+"saves/"+map_data[1]+"_"+date+".html")
-        print("Saved in ", site_folder+"saves/"+map_data[1]+"_"+date+".html")
-        map.save(site_folder+map_data[1]+"_index.html")
-        print("Saved in ", site_folder+map_data[1]+"_index.html")
\ No newline at end of file
+sleep_marker_html = '<h1>{date}</h1><p>Etape {step}</p><p>Distance parcourue {km} km</p><p>Coordonnée GPS: {lat}, {lon}</p>'
+stay_marker_html = '<h1>{date}</h1><p>{nights} nuit(s)</p><p>Coordonnée GPS: {lat}, {lon}</p>'
+planned_route_html = '<h1>{route}</h1><p>Itinéraire prévu, écart maximal du trajet: {deviation} km</p>'
+
+# Shared data file of the maps (trace, markers and planned routes), loaded by each page instead of being inlined
+trip_data_filename = "trip_data.json"
+# Script of the maps drawing the shared data file in the groups created by render_map (paths as encoded polylines,
+# see geodesy.encode_polyline)
+trip_data_script = """
+{% macro script(this, kwargs) %}
+    function decodePolyline(encoded) {
+        const points = [];
+        let index = 0, latitude = 0, longitude = 0;
+        while (index < encoded.length) {
+            const deltas = [0, 0];
+            for (let coordinate = 0; coordinate < 2; coordinate++) {
+                let shift = 0, value = 0, byte;
+                do {
+                    byte = encoded.charCodeAt(index++) - 63;
+                    value |= (byte & 0x1f) << shift;
+                    shift += 5;
+                } while (byte >= 0x20);
+                deltas[coordinate] = value & 1 ? ~(value >> 1) : value >> 1;
+            }
+            latitude += deltas[0];
+            longitude += deltas[1];
+            points.push([latitude / 1e5, longitude / 1e5]);
+        }
+        return points;
+    }
+    fetch({{ this.data_url|tojson }}).then(response => response.json()).then(data => {
+        for (const step of data.steps) {
+            if (step.points > 1) {
+                L.polyline.antPath(decodePolyline(step.path), {color: "#F6FFF3", pulseColor: "#000000", weight: 6,
+                    opacity: 0.5, dashArray: [10, 15], delay: 800, paused: false, reverse: false})
+                    .addTo({{ this.map_name }});
+            }
+            L.marker(step.marker, {icon: L.AwesomeMarkers.icon(
+                {markerColor: "green", iconColor: "white", icon: "flag", prefix: "fa"})})
+                .bindTooltip(step.tooltip, {sticky: true}).addTo({{ this.step_group }});
+        }
+        for (const stay of data.stays) {
+            L.marker(stay.location, {icon: L.AwesomeMarkers.icon(
+                {markerColor: "blue", iconColor: "white", icon: "bed", prefix: "fa"})})
+                .bindTooltip(stay.tooltip, {sticky: true}).addTo({{ this.stay_group }});
+        }
+        for (const route of data.routes) {
+            L.polyline(decodePolyline(route.path), {color: "#E8710A", weight: 4, opacity: 0.8, dashArray: "8 8"})
+                .bindTooltip(route.tooltip, {sticky: true}).addTo({{ this.route_group }});
+        }
+    });
+{% endmacro %}"""
+
+
+# Cached layer of a step in the cache folder of the site
+step_layer_pattern = re.compile(r"^step_(\d+)\.geojson$")
+
+
+def step_content_hash(step_trace: pd.DataFrame, tolerance: float) -> str:
+    """
+    Version of the rendered layer of a step: hash of the positions the layer is drawn from, so that a corrected
+    position changes it even if the summary of the step does not
+    param: step_trace: gps trace of the step (see load_step_trace)
+    param: tolerance: simplification tolerance in meters (part of the key)
+    result: key of the cached layer
+    """
+    content_hash = hashlib.sha1(repr(float(tolerance)).encode())
+    for column in ["timestamp", "latitude", "longitude", "km"]:
+        content_hash.update(np.ascontiguousarray(step_trace[column].values, dtype=np.float64).tobytes())
+    return content_hash.hexdigest()
+
+
+def build_step_layer(step, step_trace: pd.DataFrame, tolerance: float, content_hash: str) -> geojson.FeatureCollection:
+    """
+    Render the layer of a step: the simplified path and the marker at its last position
+    param: step: the step
+    param: step_trace: gps trace of the step (with a date column)
+    param: tolerance: simplification tolerance in meters
+    param: content_hash: see step_content_hash
+    result: geojson FeatureCollection (LineString path + Point marker)
+    """
+    keep = simplify_polyline(step_trace["latitude"].values, step_trace["longitude"].values, tolerance)
+    path = step_trace[keep]
+    last_position = step_trace.iloc[-1]
+    tooltip = sleep_marker_html.format(
+        date=datetime.strftime(last_position["date"], "%d %B %Y"),
+        step=step + 1,
+        km=round(last_position["km"], 1),
+        lat=last_position["latitude"],
+        lon=last_position["longitude"])
+    return geojson.FeatureCollection(
+        [geojson.Feature(geometry=geojson.LineString(list(zip(path["longitude"].tolist(), path["latitude"].tolist()))),
+                         properties={"points": len(step_trace)}),
+         geojson.Feature(geometry=geojson.Point((float(last_position["longitude"]), float(last_position["latitude"]))),
+                         properties={"tooltip": tooltip})],
+        properties={"step": int(step), "hash": content_hash, "tolerance": tolerance})
+
+
+def load_step_trace(trip_data: OverviewDatabase, step) -> pd.DataFrame:
+    """
+    param: trip_data: OverviewDatabase
+    param: step: the step
+    result: gps trace of the step with a date column (see build_step_layer)
+    """
+    step_trace = trip_data.query_step(step, columns=["timestamp", "latitude", "longitude", "km"])
+    step_trace["date"] = pd.to_datetime(step_trace["timestamp"], unit="s")
+    return step_trace
+
+
+def load_step_layers(steps, step_trace: Callable, cache_folder: str, tolerance: float) -> dict:
+    """
+    Get the layer of each step, from the cache folder if the positions of the step did not change (same content
+    hash): only the new or changed steps are simplified and rendered. The layers of the steps that no longer exist
+    are deleted
+    param: steps: the steps, ex: the index of OverviewDatabase.get_step_summaries
+    param: step_trace: function returning the gps trace of a step (see load_step_trace)
+    param: cache_folder: folder of the cached layers (step_<n>.geojson)
+    param: tolerance: simplification tolerance in meters
+    result: dict of the geojson layer of each step
+    """
+    os.makedirs(cache_folder, exist_ok=True)
+    step_layers = {}
+    rendered = 0
+    for step in steps:
+        step = int(step)
+        trace = step_trace(step)
+        content_hash = step_content_hash(trace, tolerance)
+        cache_filepath = os.path.join(cache_folder, "step_" + str(step) + ".geojson")
+        if os.path.exists(cache_filepath):
+            with open(cache_filepath, "r") as file:
+                step_layer = geojson.load(file)
+            if step_layer["properties"]["hash"] == content_hash:
+                step_layers[step] = step_layer
+                continue
+        step_layers[step] = build_step_layer(step, trace, tolerance, content_hash)
+        with open(cache_filepath, "w") as file:
+            geojson.dump(step_layers[step], file)
+        rendered += 1
+    removed = 0
+    for filename in os.listdir(cache_folder):
+        cached_step = step_layer_pattern.match(filename)
+        if cached_step and int(cached_step.group(1)) not in step_layers:
+            os.remove(os.path.join(cache_folder, filename))
+            removed += 1
+    logging.info("Step layers: %d rendered, %d from cache, %d removed", rendered, len(step_layers) - rendered,
+                 removed)
+    return step_layers
+
+
+def create_site(trip_data: OverviewDatabase, site_folder: str, date, url, simplify_tolerance=10.0, simplify_zoom=None,
+                extra_tile_variants: List[dict] = None, workers: int = None):
+    """
+    Generate the offline and online site
+    param: simplify_tolerance: tolerance in meters of the trace simplification
+    param: simplify_zoom: if set, the tolerance is the size of one pixel at this zoom level (overrides simplify_tolerance)
+    param: extra_tile_variants: other maps to generate, list of {"name": ..., "tiles": ..., "attr": ...}
+    param: workers: number of processes rendering the maps (one per map by default, 1 to render sequentially)
+    """
+    with span("trace_loading") as record:
+        summary = trip_data.get_trip_summary()
+        step_summaries = trip_data.get_step_summaries()
+        record["rows"] = len(step_summaries)
+    if summary is None or summary["last_timestamp"] is None:
+        logging.info("No position in the database, the site is not generated")
+        return
+    last_position = trip_data.query_range(summary["last_timestamp"], summary["last_timestamp"],
+                                          columns=["latitude", "longitude"])
+    center_of_map = last_position.iloc[-1].tolist() # Last updated GPS position
+
+    # Simplified path and marker of each step, only the steps whose positions changed are rendered again
+    if simplify_zoom is not None:
+        simplify_tolerance = zoom_tolerance(simplify_zoom, center_of_map[0])
+    with span("layer_building") as record:
+        step_layers = load_step_layers(step_summaries.index, lambda step: load_step_trace(trip_data, step),
+                                       site_folder + "cache/", simplify_tolerance)
+        record["rows"] = summary["positions"]
+    simplified_points = sum(len(step_layer["features"][0]["geometry"]["coordinates"])
+                            for step_layer in step_layers.values())
+    logging.info("Trace simplified with a tolerance of %.1f m: %d -> %d points", simplify_tolerance,
+                 summary["positions"], simplified_points)
+
+    # Sleeping locations, detected when the positions are committed
+    with span("stay_detection") as record:
+        sleeping_locations = trip_data.query_sleeping_locations()
+        record["rows"] = len(sleeping_locations) if sleeping_locations is not None else 0
+    stay_markers = [dict(location=[round(float(stay.latitude), 6), round(float(stay.longitude), 6)],
+                         tooltip=stay_marker_html.format(
+                             date=datetime.utcfromtimestamp(stay.arrival).strftime("%d %B %Y"),
+                             nights=max(stay.departure // 86400 - stay.arrival // 86400, 1),
+                             lat=round(stay.latitude, 5), lon=round(stay.longitude, 5)))
+                    for stay in (sleeping_locations.itertuples() if sleeping_locations is not None else [])]
+
+    # Planned routes, simplified like the trace, with the deviation of the trace from them
+    with span("planned_route") as record:
+        planned_route = trip_data.query_planned_route()
+        route_lines = []
+        if planned_route is not None and not planned_route.empty:
+            record["rows"] = len(planned_route)
+            # Deviation of the trace from each route, the positions are read once
+            positions = trip_data.query_range(columns=["timestamp", "latitude", "longitude"])
+            deviations = {route: trip_data.get_route_deviation(route, positions)["deviation"].values
+                          for route in planned_route["route"].unique()}
+            for route, route_deviations in deviations.items():
+                logging.info("Deviation of the trace from the planned route %s: %.0f m on average, %.0f m at most",
+                             route, route_deviations.mean(), route_deviations.max())
+            for (route, _), points in planned_route.groupby(["route", "segment"], sort=False):
+                keep = simplify_polyline(points["latitude"].values, points["longitude"].values, simplify_tolerance)
+                route_lines.append(dict(path=encode_polyline(points["latitude"].values[keep],
+                                                             points["longitude"].values[keep]),
+                                        tooltip=planned_route_html.format(
+                                            route=route, deviation=round(deviations[route].max() / 1000, 1))))
+
+    # Tile-independent values of the legend, read from the trip summary
+    travel_day, country_crossed, km, _ = trip_data.describe_trip()
+    legend_values = dict(
+        travel_day=travel_day,
+        km=round(float(km), 1),
+        country_crossed=country_crossed,
+        last_update=datetime.utcfromtimestamp(summary["last_timestamp"]).strftime("%d %B %Y"))
+
+    # Trace and markers written once in the shared data file, with its compressed variants
+    with span("data_save") as record:
+        trip_data_content = build_trip_data(step_layers, stay_markers, route_lines)
+        data_version = hashlib.sha1(json.dumps(trip_data_content, sort_keys=True).encode()).hexdigest()[:12]
+        record["rows"] = simplified_points
+        data_size = write_precompressed(site_folder + trip_data_filename,
+                                        json.dumps(trip_data_content, separators=(",", ":")).encode())
+        logging.info("Trip data saved: %d bytes for %d points", data_size, simplified_points)
+        # Snapshot of the run, only the parts that changed since the previous snapshots are written
+        written_parts = save_snapshot(site_folder + "saves/", date, trip_data_content, legend_values)
+        logging.info("Snapshot %s saved: %d new parts", date, written_parts)
+    bounds = trip_data_bounds(step_layers, stay_markers, route_lines)
+
+    # Maps, one per tile variant, rendered concurrently. The pages only reference the data file, the version in
+    # its URL reloads it when it changed
+    tile_variants = [{"name": "offline", "tiles": url}, {"name": "online", "tiles": "OpenStreetMap"}] \
+        + list(extra_tile_variants or [])
+    render_arguments = [(tile_variant["name"], tile_variant["tiles"], tile_variant.get("attr", "Capsule map"),
+                         center_of_map, bounds, trip_data_filename + "?v=" + data_version, bool(route_lines),
+                         legend_values, site_folder)
+                        for tile_variant in tile_variants]
+    with span("html_save", rows=len(render_arguments)) as record:
+        if workers == 1 or len(render_arguments) == 1:
+            rendered_maps = [render_map(*arguments) for arguments in render_arguments]
+        else:
+            with concurrent.futures.ProcessPoolExecutor(max_workers=workers or len(render_arguments)) as executor:
+                rendered_maps = list(executor.map(render_map, *zip(*render_arguments)))
+            # Written by the rendering processes
+            record["bytes_written"] += sum(size for _, size in rendered_maps)
+        for map_name, _ in rendered_maps:
+            with open(site_folder + map_name + "_index.html", "rb") as file:
+                write_precompressed(site_folder + map_name + "_index.html", file.read(), original=False)
+    for map_name, size in rendered_maps:
+        logging.info("%s map saved: %d bytes", map_name, size)
+
+
+def build_trip_data(step_layers: dict, stay_markers: List[dict], route_lines: List[dict]) -> dict:
+    """
+    Content of the shared data file of the maps
+    param: step_layers: see load_step_layers
+    param: stay_markers: list of {"location": [latitude, longitude], "tooltip": ...} of the sleeping locations
+    param: route_lines: list of {"path": encoded polyline, "tooltip": ...} of the planned routes
+    result: dict of steps ([{"step", "points", "path" (encoded polyline), "marker" ([latitude, longitude]),
+        "tooltip"}]), stays and routes
+    """
+    steps = []
+    for step, step_layer in sorted(step_layers.items()):
+        path, marker = step_layer["features"]
+        coordinates = np.array(path["geometry"]["coordinates"], dtype=np.float64).reshape(-1, 2)
+        longitude, latitude = marker["geometry"]["coordinates"]
+        steps.append(dict(step=int(step), points=path["properties"]["points"],
+                          path=encode_polyline(coordinates[:, 1], coordinates[:, 0]),
+                          marker=[round(latitude, 6), round(longitude, 6)], tooltip=marker["properties"]["tooltip"]))
+    return dict(steps=steps, stays=stay_markers, routes=route_lines)
+
+
+def trip_data_bounds(step_layers: dict, stay_markers: List[dict], route_lines: List[dict]) -> list:
+    """
+    param: step_layers, stay_markers, route_lines: see build_trip_data
+    result: [[south, west], [north, east]] of the drawn positions, None if there is none
+    """
+    latitudes, longitudes = [], []
+    for step_layer in step_layers.values():
+        for feature in step_layer["features"]:
+            coordinates = np.array(feature["geometry"]["coordinates"], dtype=np.float64).reshape(-1, 2)
+            longitudes.append(coordinates[:, 0])
+            latitudes.append(coordinates[:, 1])
+    for stay_marker in stay_markers:
+        latitudes.append([stay_marker["location"][0]])
+        longitudes.append([stay_marker["location"][1]])
+    for route_line in route_lines:
+        route_latitudes, route_longitudes = decode_polyline(route_line["path"])
+        latitudes.append(route_latitudes)
+        longitudes.append(route_longitudes)
+    if not latitudes:
+        return None
+    latitudes, longitudes = np.concatenate(latitudes), np.concatenate(longitudes)
+    return [[float(latitudes.min()), float(longitudes.min())], [float(latitudes.max()), float(longitudes.max())]]
+
+
+def write_precompressed(filepath: str, content: bytes, original=True) -> int:
+    """
+    Write a static file with its gzip (.gz) and brotli (.br, if the brotli module is installed) variants, served as
+    they are by the web server (ex: gzip_static and brotli_static of nginx). Each file is replaced atomically
+    param: filepath: path of the file
+    param: content: content of the file
+    param: original: False if the file is already written, only its variants are
+    result: size of the content in bytes
+    """
+    variants = [(filepath, content)] if original else []
+    variants.append((filepath + ".gz", gzip.compress(content, compresslevel=9, mtime=0)))
+    try:
+        import brotli
+        variants.append((filepath + ".br", brotli.compress(content)))
+    except ImportError:
+        pass
+    for variant_filepath, variant_content in variants:
+        with open(variant_filepath + ".tmp", "wb") as file:
+            file.write(variant_content)
+        os.replace(variant_filepath + ".tmp", variant_filepath)
+    return len(content)
+
+
+def save_snapshot(saves_folder: str, date, trip_data_content: dict, legend_values: dict) -> int:
+    """
+    Save the data of a run in the deduplicated snapshots: each step, the stays and the routes are stored once in
+    <saves_folder>parts/<hash>.json.gz and <saves_folder><date>.json lists the parts of the run. A closed step is
+    never written again, a run only adds the parts that changed
+    param: saves_folder: folder of the snapshots
+    param: date: name of the snapshot
+    param: trip_data_content: see build_trip_data
+    param: legend_values: legend of the maps
+    result: number of parts written
+    """
+    os.makedirs(saves_folder + "parts", exist_ok=True)
+    written = 0
+
+    def save_part(part):
+        nonlocal written
+        content = json.dumps(part, sort_keys=True, separators=(",", ":")).encode()
+        part_hash = hashlib.sha1(content).hexdigest()
+        part_filepath = saves_folder + "parts/" + part_hash + ".json.gz"
+        if not os.path.exists(part_filepath):
+            with open(part_filepath + ".tmp", "wb") as file:
+                file.write(gzip.compress(content, mtime=0))
+            os.replace(part_filepath + ".tmp", part_filepath)
+            written += 1
+        return part_hash
+
+    manifest = dict(date=date, legend=legend_values, steps=[save_part(step) for step in trip_data_content["steps"]],
+                    stays=save_part(trip_data_content["stays"]), routes=save_part(trip_data_content["routes"]))
+    with open(saves_folder + str(date) + ".json", "w") as file:
+        json.dump(manifest, file)
+    return written
+
+
+def load_snapshot(saves_folder: str, date) -> dict:
+    """
+    Data of a previous run, from the deduplicated snapshots
+    param: saves_folder: folder of the snapshots
+    param: date: name of the snapshot (see create_site)
+    result: content of the shared data file of the run (see build_trip_data) and its legend values, None if there
+        is no snapshot of this date
+    """
+    if not os.path.exists(saves_folder + str(date) + ".json"):
+        return None
+    with open(saves_folder + str(date) + ".json", "r") as file:
+        manifest = json.load(file)
+
+    def load_part(part_hash):
+        with gzip.open(saves_folder + "parts/" + part_hash + ".json.gz", "rb") as file:
+            return json.loads(file.read())
+    return dict(steps=[load_part(part_hash) for part_hash in manifest["steps"]], stays=load_part(manifest["stays"]),
+                routes=load_part(manifest["routes"]), legend=manifest["legend"])
+
+
+def render_map(map_name, tiles, attr, center_of_map, bounds, data_url, with_routes, legend_values, site_folder):
+    """
+    Build a map referencing the shared data file and save it (run in a worker process by create_site)
+    param: map_name: name of the tile variant, the map is saved in <site_folder><map_name>_index.html
+    param: tiles, attr: folium tile layer
+    param: center_of_map: [latitude, longitude]
+    param: bounds: [[south, west], [north, east]] of the drawn positions (see trip_data_bounds)
+    param: data_url: URL of the shared data file (see build_trip_data), relative to the page
+    param: with_routes: add the group of the planned routes
+    param: legend_values: travel_day, km, country_crossed and last_update of the legend
+    result: map_name, size of the saved map in bytes
+    """
+    # Imported on first use, only the site generation needs them
+    import folium
+    import folium.plugins
+    import branca
+
+    map = folium.Map(center_of_map, tiles=tiles, attr=attr)
+    # The paths are drawn by the data script, with the AntPath plugin
+    for name, url in folium.plugins.AntPath.default_js:
+        map.get_root().header.add_child(folium.JavascriptLink(url), name=name)
+
+    # Markers groups, filled by the data script
+    planned_route_group = folium.FeatureGroup(name="Itinéraire prévu")
+    sleep_position_group = folium.FeatureGroup(name="Campements")
+    step_group = folium.FeatureGroup(name="Etapes")
+
+    # Add markers to map
+    if with_routes:
+        planned_route_group.add_to(map)
+    sleep_position_group.add_to(map)
+    step_group.add_to(map)
+    folium.LayerControl().add_to(map)
+    folium.plugins.LocateControl().add_to(map)
+
+    # Add fullscreen function
+    folium.plugins.Fullscreen(
+        title="Agrandir",
+        title_cancel="Annuler",
+        force_separate_button=True,
+    ).add_to(map)
+
+    legend = branca.element.MacroElement()
+    legend._template = branca.element.Template(legend_html.format(**legend_values))
+    map.get_root().add_child(legend)
+
+    trip_data_loader = branca.element.MacroElement()
+    trip_data_loader._template = branca.element.Template(trip_data_script)
+    trip_data_loader.data_url = data_url
+    trip_data_loader.map_name = map.get_name()
+    trip_data_loader.step_group = step_group.get_name()
+    trip_data_loader.stay_group = sleep_position_group.get_name()
+    trip_data_loader.route_group = planned_route_group.get_name()
+    map.add_child(trip_data_loader)
+
+    # Limit bounds
+    if bounds is not None:
+        map.fit_bounds(bounds)
+
+    map.save(site_folder+map_name+"_index.html")
+    print("Saved in ", site_folder+map_name+"_index.html")
+    return map_name, os.path.getsize(site_folder+map_name+"_index.html")
@@ -0,0 +1,77 @@
+#!/usr/bin/python3
+# Ingest the gps_measure MQTT topics directly into the trip database, as they are published (instead of polling
+# InfluxDB), until SIGTERM. Set daemon.ingest_interval to 0 so that generate_site.py --daemon only renders the site.
+# Usage: python3 mqtt_ingest.py [--config /etc/capsule/trip_overview/config.yaml]
+
+import sys
+import signal
+import asyncio
+import logging
+import argparse
+import yaml
+from OverviewDatabase import OverviewDatabase
+from MqttIngestion import MqttIngestion, subscribe
+
+
+parser = argparse.ArgumentParser(description="Ingest the gps_measure MQTT topics into the trip database")
+parser.add_argument("--config", default="/etc/capsule/trip_overview/config.yaml", help="path of the configuration")
+args = parser.parse_args()
+
+with open(args.config, "r") as file:
+    conf = yaml.load(file, Loader=yaml.FullLoader)
+mqtt_conf = conf.get("mqtt") or {}
+logging.basicConfig(
+    filename=conf.get("log_filepath", "/var/log/capsule/trip_overview.log"),
+    filemode="a",
+    level=logging.DEBUG if conf["debug"] else logging.INFO,
+    format="%(asctime)s %(levelname)s:%(message)s",
+    datefmt='%m/%d/%Y %I:%M:%S %p')
+
+# WAL so that the site rendering reads the database while the positions are written
+trip_data = OverviewDatabase(buffer_size=mqtt_conf.get("batch_size", 100),
+                             flush_interval=mqtt_conf.get("flush_interval", 30), journal_mode="WAL",
+                             compact=conf.get("compact_storage") or None)
+trip_data.connect_to_database(conf["database_filepath"], True)
+if trip_data.database is None:
+    sys.exit("Database %s can not be opened" % conf["database_filepath"])
+
+
+async def ingest():
+    # Reconnected after a delay doubled at each failed connection, up to mqtt.reconnect_max_delay seconds
+    delay = 1
+    while True:
+        # Restarts after the last committed position
+        ingestion = MqttIngestion(trip_data, resampling=mqtt_conf.get("resampling", 5),
+                                  join_window=mqtt_conf.get("join_window", 10),
+                                  queue_size=mqtt_conf.get("queue_size", 1000),
+                                  topic_prefix=mqtt_conf.get("topic_prefix", "gps_measure/"))
+        try:
+            await ingestion.run(subscribe(
+                mqtt_conf.get("host", "localhost"), mqtt_conf.get("port", 1883), mqtt_conf.get("user"),
+                mqtt_conf.get("pass"), mqtt_conf.get("topic_prefix", "gps_measure/")))
+            error = "the subscription ended"
+        except asyncio.CancelledError:
+            logging.info("MQTT ingestion stopped: %s" % ingestion.stats)
+            raise
+        except Exception as e:
+            error = e
+        delay = 1 if ingestion.stats["messages"] > 0 else min(delay * 2, mqtt_conf.get("reconnect_max_delay", 60))
+        logging.warning("MQTT ingestion interrupted: %s, reconnect in %d s (%s)" % (error, delay, ingestion.stats))
+        await asyncio.sleep(delay)
+
+
+async def main():
+    task = asyncio.create_task(ingest())
+    # The assembled fixes are committed before stopping
+    for signum in (signal.SIGTERM, signal.SIGINT):
+        asyncio.get_running_loop().add_signal_handler(signum, task.cancel)
+    try:
+        await task
+    except asyncio.CancelledError:
+        pass
+
+
+logging.info("Start the MQTT ingestion of %s" % conf["database_filepath"])
+asyncio.run(main())
+trip_data.close_database()
+sys.exit(0)
@@ -0,0 +1,31 @@
+#!/usr/bin/python3
+# Migration tool: split the trip_data table of an existing database into monthly partitions
+# and optionally move the old months to the yearly archive databases
+# Usage: python3 partition_database.py <database_filepath> [--archive-before YYYY_MM]
+
+import sys
+import argparse
+from OverviewDatabase import OverviewDatabase
+
+
+parser = argparse.ArgumentParser(description="Split the trip database into monthly partitions")
+parser.add_argument("database_filepath", help="path of the trip database")
+parser.add_argument("--archive-before", help="archive the partitions older than this month (ex: 2021_06)")
+args = parser.parse_args()
+
+trip_data = OverviewDatabase()
+trip_data.connect_to_database(args.database_filepath)
+if trip_data.database is None:
+    sys.exit("Database %s does not exist" % args.database_filepath)
+
+if not trip_data.partitioned and not trip_data.split_into_partitions():
+    sys.exit("Failed to split the database into partitions")
+print("Partitions:", ", ".join(trip_data.partitions))
+
+if args.archive_before:
+    for month in list(trip_data.partitions):
+        if month < args.archive_before and trip_data.partitions[month].startswith("main."):
+            print("Archive partition", month, "->", "success" if trip_data.archive_partition(month) else "failure")
+
+trip_data.close_database()
+sys.exit(0)
@@ -0,0 +1,27 @@
+#!/usr/bin/python3
+# Maintenance tool: create or recompute the trip summary (trip_summary tables) of an existing database, and its
+# spatial index if it has one
+# Usage: python3 rebuild_summary.py <database_filepath>
+
+import sys
+import argparse
+from OverviewDatabase import OverviewDatabase
+
+
+parser = argparse.ArgumentParser(description="Rebuild the trip summary from the positions of the trip database")
+parser.add_argument("database_filepath", help="path of the trip database")
+args = parser.parse_args()
+
+trip_data = OverviewDatabase()
+trip_data.connect_to_database(args.database_filepath)
+if trip_data.database is None:
+    sys.exit("Database %s does not exist" % args.database_filepath)
+
+if not trip_data.rebuild_summary():
+    sys.exit("Failed to rebuild the trip summary")
+if trip_data.spatial_indexes and not trip_data.rebuild_spatial_index():
+    sys.exit("Failed to rebuild the spatial index")
+print(trip_data.describe_trip()[3])
+
+trip_data.close_database()
+sys.exit(0)
@@ -0,0 +1,64 @@
+import xml.etree.ElementTree as ElementTree
+
+# Elements of the points of a GPX route or track, the points of a <trkseg> or <rte> form one segment
+gpx_point_tags = {"trkpt", "rtept"}
+gpx_segment_tags = {"trkseg", "rte"}
+# Elements of the coordinates of a KML line: <LineString><coordinates> ("lon,lat[,alt] ...") and <gx:Track><gx:coord>
+# ("lon lat [alt]"), one segment per <LineString> or <gx:Track>
+kml_segment_tags = {"LineString", "Track"}
+
+
+def local_name(tag):
+    """
+    :param tag: tag of an element, with its namespace ("{http://www.topografix.com/GPX/1/1}trkpt")
+    :return: tag without the namespace ("trkpt")
+    """
+    return tag.rsplit("}", 1)[-1]
+
+
+def read_route(filepath):
+    """
+    Stream the points of a GPX or KML route (format detected from the root element). The file is parsed
+    incrementally (iterparse) and each point is removed from the tree once read, so the memory does not grow with the
+    number of points, except for a KML <coordinates> element, whose text is read at once.
+    :param filepath: path of the GPX or KML file
+    :return: generator of (segment, latitude, longitude, altitude), altitude is None if the point has none
+    """
+    parents = []
+    segment = -1
+    route_format = None
+    for event, element in ElementTree.iterparse(filepath, events=("start", "end")):
+        tag = local_name(element.tag)
+        if event == "start":
+            if route_format is None:
+                route_format = tag.lower()
+                if route_format not in ("gpx", "kml"):
+                    raise ValueError("%s is neither a GPX nor a KML file (root element %s)" % (filepath, tag))
+            if tag in (gpx_segment_tags if route_format == "gpx" else kml_segment_tags):
+                segment += 1
+            parents.append(element)
+            continue
+        parents.pop()
+        if route_format == "gpx" and tag in gpx_point_tags:
+            elevation = next((child.text for child in element if local_name(child.tag) == "ele"), None)
+            yield segment, float(element.get("lat")), float(element.get("lon")), \
+                float(elevation) if elevation else None
+        elif route_format == "kml" and tag == "coordinates" and parents \
+                and local_name(parents[-1].tag) == "LineString":
+            for coordinates in (element.text or "").split():
+                yield (segment, *kml_coordinates(coordinates.split(",")))
+        elif route_format == "kml" and tag == "coord":
+            yield (segment, *kml_coordinates((element.text or "").split()))
+        elif not (route_format == "kml" and tag == "when"):
+            continue
+        # The point (or the time of a gx:Track point) is read, it is removed from its parent
+        if parents:
+            parents[-1].remove(element)
+
+
+def kml_coordinates(values):
+    """
+    :param values: [longitude, latitude] or [longitude, latitude, altitude] (strings)
+    :return: latitude, longitude, altitude (None if not set)
+    """
+    return float(values[1]), float(values[0]), float(values[2]) if len(values) > 2 else None
@@ -0,0 +1,32 @@
+from datetime import datetime, timezone
+
+# Date of the last rendering of the site (last_update_filepath), read by generate_site.py before any heavy import
+
+
+def read_last_update(filepath):
+    """
+    Read the date of the last rendering of the site
+    The date is stored with its UTC offset, the files written by the former versions (without offset) are in the
+    local time of the device.
+    :param filepath: path of the file, see write_last_update
+    :return: naive UTC datetime (as datetime.utcnow()), None if the site was never rendered
+    """
+    try:
+        with open(filepath, "r") as f:
+            last_update = datetime.fromisoformat(f.readline().strip("\n"))
+    except FileNotFoundError:
+        return None
+    # astimezone considers a naive datetime in the local time
+    return last_update.astimezone(timezone.utc).replace(tzinfo=None)
+
+
+def write_last_update(filepath, date):
+    """
+    Store the date of the last rendering of the site, isoformat with the UTC offset (ex: 2021-06-01T12:00:00+00:00)
+    :param filepath: path of the file
+    :param date: naive UTC datetime (as datetime.utcnow()) or aware datetime
+    """
+    if date.tzinfo is None:
+        date = date.replace(tzinfo=timezone.utc)
+    with open(filepath, "w") as f:
+        f.write(date.astimezone(timezone.utc).isoformat())
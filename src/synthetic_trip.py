@@ -0,0 +1,149 @@
+import re
+import numpy as np
+import pandas as pd
+from geodesy import consecutive_distance
+from CountryResolver import get_country_resolver
+from OverviewDatabase import OverviewDatabase, trip_data_columns
+
+# Loop through France, Belgium, the Netherlands, Germany, Switzerland, Italy, Spain and Andorra
+default_route = [(48.8566, 2.3522), (50.8503, 4.3517), (52.3676, 4.9041), (50.9375, 6.9603), (48.5734, 7.7521),
+                 (47.5596, 7.5886), (45.4642, 9.1900), (43.7102, 7.2620), (41.3874, 2.1686), (43.6047, 1.4442),
+                 (48.8566, 2.3522)]
+
+
+def generate_trip(days=7, interval=5, start="2021-06-01", seed=0, route=None, drive_hours=8, speed=70.0,
+                  step_days=3, rest_probability=0.2, gap_probability=0.3, jitter=3.0):
+    """
+    Deterministic synthetic trip: the vehicle follows a looping route from 9h (UTC) during drive_hours a day and
+    is parked the rest of the time, with rest days (stays of several nights), logging gaps during some nights
+    and GPS jitter. The same parameters always give the same positions.
+    :param days: duration of the trip in days (365 days with interval=5 is about 6M positions)
+    :param interval: seconds between two positions
+    :param start: first day of the trip (UTC)
+    :param seed: seed of the random generator
+    :param route: list of (latitude, longitude) waypoints, looped (default: default_route, 8 countries)
+    :param drive_hours: hours of driving per day
+    :param speed: mean speed in km/h
+    :param step_days: number of days of each step
+    :param rest_probability: probability that the vehicle stays parked a whole day
+    :param gap_probability: probability that nothing is logged during a night (from 22h to 7h)
+    :param jitter: standard deviation of the GPS noise in meters
+    :return: pandas.DataFrame of timestamp, latitude, longitude, altitude, speed, km and current_step
+        (ordered by timestamp, without current_country)
+    """
+    rng = np.random.default_rng(seed)
+    route = np.asarray(route or default_route, dtype=np.float64)
+    start_timestamp = int(pd.Timestamp(start, tz="UTC").timestamp())
+    timestamps = start_timestamp + np.arange(0, days * 86400, interval, dtype=np.int64)
+    day = (timestamps - start_timestamp) // 86400
+    hour = (timestamps % 86400) / 3600
+
+    # Driving from 9h during drive_hours, except the rest days
+    rest_days = rng.random(days) < rest_probability
+    moving = (hour >= 9) & (hour < 9 + drive_hours) & ~rest_days[day]
+    speeds = np.where(moving, np.clip(rng.normal(speed, speed / 5, len(timestamps)), 5.0, None),
+                      rng.uniform(0.0, 0.5, len(timestamps)))
+    km = np.cumsum(np.where(moving, speeds * interval / 3600, 0.0))
+
+    # Position along the looping route
+    route_km = np.concatenate([[0.0], np.cumsum(consecutive_distance(route[:, 0], route[:, 1])[1:])])
+    distance = km % route_km[-1]
+    latitudes = np.interp(distance, route_km, route[:, 0])
+    longitudes = np.interp(distance, route_km, route[:, 1])
+    # GPS jitter in meters
+    latitudes += rng.normal(0, jitter, len(timestamps)) / 111320
+    longitudes += rng.normal(0, jitter, len(timestamps)) / (111320 * np.cos(np.radians(latitudes)))
+    altitudes = 200 + 150 * np.sin(distance / 37.0) + rng.normal(0, 2, len(timestamps))
+
+    # Nights without logging
+    gap_nights = rng.random(days + 1) < gap_probability
+    logged = ~(((hour >= 22) & gap_nights[day]) | ((hour < 7) & gap_nights[day - 1] & (day > 0)))
+    return pd.DataFrame({"timestamp": timestamps,
+                         "latitude": latitudes,
+                         "longitude": longitudes,
+                         "altitude": altitudes,
+                         "speed": speeds,
+                         "km": np.round(km, 2),
+                         "current_step": day // step_days})[logged].reset_index(drop=True)
+
+
+def write_trip_database(db_filepath, positions, chunk_size=100000):
+    """
+    Write synthetic positions in a trip_data database (created if it does not exist)
+    :param db_filepath: path of the database
+    :param positions: output of generate_trip
+    :param chunk_size: number of positions inserted per transaction
+    :return: number of positions written
+    """
+    positions = positions.copy()
+    positions["current_country"] = get_country_resolver().assign(positions["latitude"].values,
+                                                                 positions["longitude"].values)
+    trip_data = OverviewDatabase()
+    trip_data.connect_to_database(db_filepath, True)
+    written = 0
+    positions = positions[trip_data_columns]
+    for first in range(0, len(positions), chunk_size):
+        rows = positions.iloc[first:first + chunk_size].values.tolist()
+        if trip_data.insert_positions(rows):
+            written += len(rows)
+    trip_data.close_database()
+    return written
+
+
+def influxdb_frames(positions):
+    """
+    Synthetic positions as returned by influxdb.DataFrameClient.query grouped by topic
+    :param positions: output of generate_trip
+    :return: dict keyed by ("mqtt_consumer", (("topic", "gps_measure/<column>"),)) of DataFrame ("mean" column)
+        indexed by UTC time
+    """
+    index = pd.to_datetime(positions["timestamp"].values, unit="s", utc=True)
+    return {("mqtt_consumer", (("topic", "gps_measure/" + column),)):
+            pd.DataFrame({"mean": positions[column].values}, index=index)
+            for column in ["latitude", "longitude", "altitude", "speed"]}
+
+
+def mqtt_messages(positions, seed=0, delay=2.0):
+    """
+    Synthetic positions as published on the gps_measure topics: one message per measure, received in a random order
+    within `delay` seconds after the time of the position
+    :param positions: output of generate_trip
+    :param seed: seed of the random delays
+    :param delay: maximal delay in seconds of the messages
+    :return: list of (topic, payload, timestamp) ordered by timestamp
+    """
+    rng = np.random.default_rng(seed)
+    timestamps = positions["timestamp"].values
+    messages = []
+    for column in ["latitude", "longitude", "altitude", "speed"]:
+        received = timestamps + rng.uniform(0.0, delay, len(timestamps))
+        messages.extend(zip(["gps_measure/" + column] * len(timestamps),
+                            [repr(value).encode() for value in positions[column].tolist()], received.tolist()))
+    return sorted(messages, key=lambda message: message[2])
+
+
+class SyntheticDataFrameClient:
+    """Stand-in of influxdb.DataFrameClient serving synthetic positions, for the benchmarks.
+    Only the time range of the queries is interpreted.
+    Usage:
+     client = SyntheticDataFrameClient(generate_trip(days=30))
+     retrieve_influxdb_data([start, end], client, "5s")"""
+
+    def __init__(self, positions):
+        """
+        Initiation
+        :param positions: output of generate_trip
+        """
+        self.frames = influxdb_frames(positions)
+        self.queries = 0
+
+    def query(self, query, chunked=False, chunk_size=0):
+        """
+        :param query: InfluxQL query with a "time >= '...Z' AND time < '...Z'" condition
+        :return: the frames of the time range, see influxdb_frames
+        """
+        self.queries += 1
+        start, end = re.findall(r"time >= '(.*?)Z' AND time < '(.*?)Z'", query)[0]
+        start, end = pd.Timestamp(start, tz="UTC"), pd.Timestamp(end, tz="UTC")
+        return {key: frame.iloc[frame.index.searchsorted(start):frame.index.searchsorted(end)]
+                for key, frame in self.frames.items()}
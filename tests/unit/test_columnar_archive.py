@@ -0,0 +1,93 @@
+import os
+import shutil
+import unittest
+import tempfile
+import importlib.util
+import pandas as pd
+from unittest import TestCase
+from OverviewDatabase import OverviewDatabase
+from ColumnarArchive import ColumnarArchive, concat_positions
+
+
+@unittest.skipIf(importlib.util.find_spec("pyarrow") is None, "The columnar archive needs pyarrow")
+class TestColumnarArchive(TestCase):
+    insert_stmt = ("INSERT INTO trip_data (timestamp, latitude, longitude, altitude, speed, km, current_country, "
+                   "current_step) VALUES (?, ?, ?, ?, ?, ?, ?, ?)")
+    # 2021-05-31 23:00, 2021-06-01 01:00, 2021-06-15, 2021-07-01 00:00 UTC
+    timestamps = [1622502000, 1622509200, 1623715200, 1625097600]
+    countries = ["France", "France", "Spain", "Spain"]
+
+    def setUp(self):
+        self.folder = tempfile.mkdtemp()
+        self.trip_data = OverviewDatabase(archive_folder=os.path.join(self.folder, "archive"))
+        self.trip_data.connect_to_database(os.path.join(self.folder, "trip.db"), True)
+        self.trip_data.execute_query(self.insert_stmt, "multiple", data=[
+            (timestamp, 49.0, 2.0 + i, 10, 30, i, country, i)
+            for i, (timestamp, country) in enumerate(zip(self.timestamps, self.countries))])
+
+    def tearDown(self):
+        self.trip_data.close_database()
+        shutil.rmtree(self.folder)
+
+    def test_export_and_compact(self):
+        archive = self.trip_data.columnar_archive
+        self.assertEqual(archive.last_timestamp, None)
+        self.assertEqual(archive.read().empty, True)
+        # The last position is not in a closed day
+        self.assertEqual(archive.export(self.trip_data, self.timestamps[3]), 3)
+        self.assertEqual([segment[:2] for segment in archive.segments()],
+                         [(self.timestamps[0], self.timestamps[0]), (self.timestamps[1], self.timestamps[2])])
+        self.assertEqual(archive.export(self.trip_data, self.timestamps[3]), 0)
+        self.assertEqual(archive.export(self.trip_data, self.timestamps[3] + 1), 1)
+        self.assertEqual(len(archive.segments()), 3)
+
+        positions = archive.read()
+        self.assertEqual(positions["timestamp"].tolist(), self.timestamps)
+        self.assertEqual(positions["current_country"].tolist(), self.countries)
+        self.assertEqual(isinstance(positions["current_country"].dtype, pd.CategoricalDtype), True)
+        self.assertEqual(archive.read(["timestamp", "km"]).columns.tolist(), ["timestamp", "km"])
+
+        # Two exports of the same month are merged
+        self.trip_data.execute_query(self.insert_stmt, "single", data=(1625184000, 49.0, 6.0, 10, 30, 4, "Spain", 4))
+        self.assertEqual(archive.export(self.trip_data, 1625184001), 1)
+        self.assertEqual(archive.compact(), 2)
+        self.assertEqual([segment[:2] for segment in archive.segments()][-1], (self.timestamps[3], 1625184000))
+        self.assertEqual(archive.read()["timestamp"].tolist(), self.timestamps + [1625184000])
+
+    def test_query_raw_database(self):
+        self.trip_data.columnar_archive.export(self.trip_data, self.timestamps[2])
+        self.trip_data.query_raw_database()
+        self.assertEqual(self.trip_data.raw_data["timestamp"].tolist(), self.timestamps)
+        self.assertEqual(self.trip_data.raw_data["current_country"].tolist(), self.countries)
+        # Only the rows newer than the archive are read from SQLite
+        self.trip_data.execute_query(self.insert_stmt, "single", data=(1625184000, 49.0, 6.0, 10, 30, 4, "Italy", 4))
+        self.trip_data.query_raw_database()
+        self.assertEqual(self.trip_data.raw_data["current_country"].tolist(), self.countries + ["Italy"])
+
+    def test_insert_after_export(self):
+        archive = self.trip_data.columnar_archive
+        self.assertEqual(archive.export(self.trip_data, self.timestamps[3] + 1), 4)
+        # Late positions of June, older than the last archived timestamp
+        self.trip_data.execute_query(self.insert_stmt, "single", data=(1623715100, 49.0, 3.5, 10, 30, 1, "Spain", 1))
+        self.trip_data.commit_position(1623715300, 49.0, 4.5, 10)
+        self.trip_data.query_raw_database()
+        timestamps = sorted(self.timestamps + [1623715100, 1623715300])
+        self.assertEqual(self.trip_data.raw_data["timestamp"].tolist(), timestamps)
+        # The segments of June and July are invalidated, May is kept
+        self.assertEqual([segment[:2] for segment in archive.segments()], [(self.timestamps[0], self.timestamps[0])])
+        self.assertEqual(archive.export(self.trip_data, self.timestamps[3] + 1), 5)
+        self.assertEqual(archive.read()["timestamp"].tolist(), timestamps)
+        self.assertEqual(archive.check(self.trip_data), 0)
+
+
+class TestConcatPositions(TestCase):
+    def test_concat_positions(self):
+        archived = pd.DataFrame({"timestamp": [1], "current_country": pd.Categorical(["France"])})
+        newer = pd.DataFrame({"timestamp": [2], "current_country": ["Spain"]})
+        positions = concat_positions([archived, None, newer])
+        self.assertEqual(positions["current_country"].tolist(), ["France", "Spain"])
+        self.assertEqual(isinstance(positions["current_country"].dtype, pd.CategoricalDtype), True)
+
+
+if __name__ == '__main__':
+    unittest.main()
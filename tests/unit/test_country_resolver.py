@@ -0,0 +1,41 @@
+import unittest
+import numpy as np
+from unittest import TestCase
+from CountryResolver import CountryResolver, get_country_resolver
+
+
+class TestCountryResolver(TestCase):
+    def test_singleton(self):
+        self.assertEqual(get_country_resolver() is get_country_resolver(), True)
+
+    def test_resolve(self):
+        resolver = CountryResolver(cache_size=2)
+        self.assertEqual(resolver.resolve(49.0659719561271, 1.99154344325376), "France")
+        self.assertEqual(resolver.resolve(49.0659, 1.9915), "France")  # same cell
+        self.assertEqual(resolver.cache_info(), {"hits": 1, "misses": 1, "maxsize": 2, "currsize": 1})
+
+        self.assertEqual(resolver.resolve_many([(52.2296756, 21.0122287), (40.4167, -3.70325), (52.2296, 21.0122)]),
+                         ["Poland", "Spain", "Poland"])
+        # The cache is bounded, the least recently used cell (France) is evicted
+        self.assertEqual(resolver.cache_info(), {"hits": 2, "misses": 3, "maxsize": 2, "currsize": 2})
+        resolver.resolve(49.0659, 1.9915)
+        self.assertEqual(resolver.cache_info()["misses"], 4)
+
+        resolver.clear_cache()
+        self.assertEqual(resolver.cache_info(), {"hits": 0, "misses": 0, "maxsize": 2, "currsize": 0})
+
+    def test_assign(self):
+        resolver = CountryResolver()
+        # Paris -> Madrid -> Paris, with a trace of 1000 positions
+        latitudes = np.concatenate([np.linspace(48.85, 40.41, 500), np.linspace(40.41, 48.85, 500)])
+        longitudes = np.concatenate([np.linspace(2.35, -3.70, 500), np.linspace(-3.70, 2.35, 500)])
+        self.assertEqual(resolver.assign([], []), [])
+        countries = resolver.assign(latitudes, longitudes, stride=64)
+        self.assertEqual(countries, resolver.query(list(zip(latitudes, longitudes))))
+        self.assertEqual(countries[0], "France")
+        self.assertEqual(countries[499], "Spain")
+        self.assertEqual(resolver.assign(latitudes[:1], longitudes[:1]), ["France"])
+
+
+if __name__ == '__main__':
+    unittest.main()
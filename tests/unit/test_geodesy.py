@@ -0,0 +1,129 @@
+import math
+import unittest
+import numpy as np
+from unittest import TestCase
+from geodesy import haversine, pairwise_distance, consecutive_distance, cumulative_distance, simplify_polyline, \
+    zoom_tolerance, detect_stays, route_deviation, to_cartesian, segment_distance, encode_polyline, decode_polyline
+
+
+def scalar_haversine(origin, destination, radius=6371.0):
+    # Former scalar implementation used as reference
+    diff_latitude = math.radians(destination[0] - origin[0])
+    diff_longitude = math.radians(destination[1] - origin[1])
+    a = math.sin(diff_latitude / 2) ** 2 + math.cos(math.radians(origin[0])) \
+        * math.cos(math.radians(destination[0])) * math.sin(diff_longitude / 2) ** 2
+    return radius * 2 * math.atan2(math.sqrt(a), math.sqrt(1 - a))
+
+
+class TestGeodesy(TestCase):
+    rng = np.random.default_rng(0)
+    latitudes = rng.uniform(-89.0, 89.0, 500)
+    longitudes = rng.uniform(-179.0, 179.0, 500)
+
+    def test_haversine(self):
+        self.assertEqual(round(float(haversine(52.2296756, 21.0122287, 52.406374, 16.9251681, 6373.0)), 3), 278.546)
+        result = haversine(self.latitudes[:-1], self.longitudes[:-1], self.latitudes[1:], self.longitudes[1:])
+        for i in range(len(result)):
+            reference = scalar_haversine([self.latitudes[i], self.longitudes[i]],
+                                         [self.latitudes[i + 1], self.longitudes[i + 1]])
+            self.assertAlmostEqual(result[i], reference, delta=1e-9)
+
+    def test_pairwise_distance(self):
+        matrix = pairwise_distance(self.latitudes[:3], self.longitudes[:3], self.latitudes[3:7], self.longitudes[3:7])
+        self.assertEqual(matrix.shape, (3, 4))
+        self.assertAlmostEqual(matrix[2, 1], scalar_haversine([self.latitudes[2], self.longitudes[2]],
+                                                              [self.latitudes[4], self.longitudes[4]]), delta=1e-9)
+
+    def test_consecutive_and_cumulative_distance(self):
+        self.assertEqual(consecutive_distance([], []).tolist(), [])
+        self.assertEqual(consecutive_distance([10.0], [10.0]).tolist(), [0.0])
+        consecutive = consecutive_distance(self.latitudes, self.longitudes)
+        cumulative = cumulative_distance(self.latitudes, self.longitudes, start=100.0)
+        self.assertEqual(consecutive[0], 0.0)
+        self.assertEqual(cumulative[0], 100.0)
+        km = 100.0
+        for i in range(1, len(self.latitudes)):
+            km += scalar_haversine([self.latitudes[i - 1], self.longitudes[i - 1]],
+                                   [self.latitudes[i], self.longitudes[i]])
+            self.assertAlmostEqual(consecutive[i], km - cumulative[i - 1], delta=1e-6)
+        self.assertAlmostEqual(cumulative[-1], km, delta=1e-6)
+
+    def test_simplify_polyline(self):
+        self.assertEqual(simplify_polyline([1.0, 2.0], [1.0, 2.0], 10).tolist(), [True, True])
+        # A straight line is reduced to its extremities
+        latitudes = np.linspace(45.0, 45.1, 1000)
+        longitudes = np.linspace(5.0, 5.1, 1000)
+        keep = simplify_polyline(latitudes, longitudes, 1.0)
+        self.assertEqual(keep.sum(), 2)
+        # A zigzag of 100 m amplitude is kept with a 10 m tolerance, removed with a 200 m tolerance
+        zigzag = longitudes + np.tile([0.0, 0.0013], 500)
+        self.assertEqual(simplify_polyline(latitudes, zigzag, 10.0).sum(), 1000)
+        self.assertEqual(simplify_polyline(latitudes, zigzag, 200.0).sum() < 10, True)
+        # The simplified polyline stays within the tolerance of the original one
+        noisy_longitudes = 5.0 + self.rng.normal(0, 0.0004, 1000)
+        keep = simplify_polyline(latitudes, noisy_longitudes, 10.0)
+        self.assertEqual(2 < keep.sum() < 1000, True)
+        y = np.radians(latitudes) * 6371000
+        x = np.radians(noisy_longitudes) * 6371000 * np.cos(np.radians(np.mean(latitudes)))
+        kept = np.flatnonzero(keep)
+        for first, last in zip(kept[:-1], kept[1:]):
+            dx, dy = x[last] - x[first], y[last] - y[first]
+            for i in range(first + 1, last):
+                self.assertLessEqual(abs(dx * (y[i] - y[first]) - dy * (x[i] - x[first])) / np.hypot(dx, dy), 10.0)
+        self.assertAlmostEqual(zoom_tolerance(0), 156543.03392)
+        self.assertAlmostEqual(zoom_tolerance(1, 60.0), 156543.03392 / 4)
+
+
+    def test_detect_stays(self):
+        self.assertEqual([len(result) if i < 2 else result for i, result in
+                          enumerate(detect_stays([], [], [], [], 100, 3600, 1))], [0, 0, 0])
+        # Drive, park 2 nights with a logging gap, drive, short stop (30 minutes), drive
+        timestamps = np.array([0, 60, 120, 180, 240, 180000, 180060, 180120, 180180, 182000, 182060])
+        latitudes = np.array([45.0, 45.01, 45.02, 45.0201, 45.0202, 45.0202, 45.03, 45.04, 45.04, 45.05, 45.06])
+        speeds = np.array([50, 50, 0.5, 0, 0, 0, 50, 0, 0.2, 0, 50])
+        firsts, lasts, last_run = detect_stays(timestamps, latitudes, np.full(11, 5.0), speeds, 100, 4 * 3600, 1)
+        self.assertEqual((firsts.tolist(), lasts.tolist(), last_run), ([2], [5], 10))
+        # The short stop is a stay with a lower dwell time, not with a smaller radius (the positions are 1 km apart)
+        firsts, lasts, last_run = detect_stays(timestamps, latitudes, np.full(11, 5.0), speeds, 100, 60, 1)
+        self.assertEqual((firsts.tolist(), lasts.tolist()), ([2, 7], [5, 8]))
+        firsts, lasts, last_run = detect_stays(timestamps, latitudes, np.full(11, 5.0), speeds, 2000, 60, 1)
+        self.assertEqual((firsts.tolist(), lasts.tolist()), ([2, 7], [5, 9]))
+
+
+    def test_route_deviation(self):
+        rng = np.random.default_rng(1)
+        route_latitudes = 45.0 + np.cumsum(rng.normal(0.0, 0.002, 1000))
+        route_longitudes = 5.0 + np.cumsum(rng.normal(0.0, 0.002, 1000))
+        # Positions along the route and far from it (other side of the earth)
+        latitudes = np.append(route_latitudes[rng.integers(0, 1000, 300)] + rng.normal(0.0, 0.01, 300), -45.0)
+        longitudes = np.append(route_longitudes[rng.integers(0, 1000, 300)] + rng.normal(0.0, 0.01, 300), -175.0)
+        segments = np.repeat([0, 1], 500)
+        deviations = route_deviation(route_latitudes, route_longitudes, latitudes, longitudes, segments,
+                                     max_pairs=1000)
+
+        # Reference: distance to all the segments (straight, the pieces of route_deviation follow the sphere)
+        points, route = to_cartesian(latitudes, longitudes), to_cartesian(route_latitudes, route_longitudes)
+        joined = segments[1:] == segments[:-1]
+        for i in range(len(points)):
+            reference = segment_distance(np.repeat(points[i:i + 1], joined.sum(), axis=0), route[:-1][joined],
+                                         route[1:][joined]).min()
+            self.assertAlmostEqual(deviations[i], reference, delta=0.01)
+        # Close to the great-circle distance to a single point
+        self.assertAlmostEqual(route_deviation([45.0], [5.0], [45.01], [5.0])[0],
+                               haversine(45.0, 5.0, 45.01, 5.0) * 1000, delta=0.01)
+        self.assertEqual(route_deviation([], [], [45.0], [5.0]).tolist(), [np.inf])
+
+    def test_polyline(self):
+        # Example of the format documentation
+        self.assertEqual(encode_polyline([38.5, 40.7, 43.252], [-120.2, -120.95, -126.453]),
+                         "_p~iF~ps|U_ulLnnqC_mqNvxq`@")
+        latitudes = np.random.default_rng(0).uniform(-90, 90, 1000)
+        longitudes = np.random.default_rng(1).uniform(-180, 180, 1000)
+        decoded_latitudes, decoded_longitudes = decode_polyline(encode_polyline(latitudes, longitudes))
+        self.assertLessEqual(np.abs(decoded_latitudes - latitudes).max(), 0.5e-5 + 1e-9)
+        self.assertLessEqual(np.abs(decoded_longitudes - longitudes).max(), 0.5e-5 + 1e-9)
+        self.assertEqual(encode_polyline([], []), "")
+
+
+if __name__ == '__main__':
+    unittest.main()
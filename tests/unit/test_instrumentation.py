@@ -0,0 +1,72 @@
+import os
+import json
+import shutil
+import unittest
+import tempfile
+import numpy as np
+import pandas as pd
+from unittest import TestCase
+from OverviewDatabase import OverviewDatabase
+from instrumentation import Instrumentation, get_instrumentation, span
+
+
+class TestInstrumentation(TestCase):
+    def setUp(self):
+        self.folder = tempfile.mkdtemp()
+
+    def tearDown(self):
+        get_instrumentation().disable()
+        shutil.rmtree(self.folder)
+
+    def test_span(self):
+        instrumentation = Instrumentation()
+        with instrumentation.span("disabled", rows=10):
+            pass
+        self.assertEqual(instrumentation.spans, [])
+
+        instrumentation.enable()
+        for rows in [10, 5]:
+            with instrumentation.span("write", rows=rows) as record:
+                with open(os.path.join(self.folder, "file.txt"), "w") as file:
+                    file.write("x" * 100000)
+                record["bytes_written"] += 1
+        with instrumentation.span("read") as record:
+            record["rows"] = 3
+        self.assertEqual([record["name"] for record in instrumentation.spans], ["write", "write", "read"])
+        self.assertEqual(instrumentation.spans[0]["bytes_written"] > 100000, True)
+        self.assertEqual(instrumentation.spans[0]["peak_rss_bytes"] > 0, True)
+        totals = instrumentation.totals()
+        self.assertEqual(list(totals), ["write", "read"])
+        self.assertEqual((totals["write"]["rows"], totals["write"]["count"], totals["read"]["rows"]), (15, 2, 3))
+
+        instrumentation.write_json(os.path.join(self.folder, "metrics.json"))
+        with open(os.path.join(self.folder, "metrics.json")) as file:
+            self.assertEqual(len(json.load(file)["spans"]), 3)
+        instrumentation.write_prometheus(os.path.join(self.folder, "metrics.prom"))
+        with open(os.path.join(self.folder, "metrics.prom")) as file:
+            lines = file.read().splitlines()
+        self.assertEqual('trip_overview_stage_rows{stage="write"} 15' in lines, True)
+        self.assertEqual("# TYPE trip_overview_stage_seconds gauge" in lines, True)
+
+    def test_pipeline_spans(self):
+        get_instrumentation().enable()
+        trip_data = OverviewDatabase()
+        trip_data.connect_to_database(os.path.join(self.folder, "trip.db"), True)
+        trip_data.commit_dataframe(pd.DataFrame({"timestamp": np.arange(100), "latitude": 48.0, "longitude": 2.0,
+                                                 "altitude": 100.0, "speed": 0.0, "km": 0.0, "current_step": 0}))
+        trip_data.close_database()
+        self.assertEqual([(record["name"], record["rows"]) for record in get_instrumentation().spans],
+                         [("country_resolution", 100), ("sqlite_commit", 100)])
+
+    def test_profiling(self):
+        instrumentation = Instrumentation()
+        self.assertEqual(instrumentation.stop_profiling(), [])
+        instrumentation.start_profiling(os.path.join(self.folder, "profile"))
+        sorted(np.random.default_rng(0).random(1000).tolist())
+        dumps = instrumentation.stop_profiling()
+        self.assertEqual([os.path.splitext(dump)[1] for dump in dumps], [".prof", ".txt", ".tracemalloc"])
+        self.assertEqual(all(os.path.getsize(dump) > 0 for dump in dumps), True)
+
+
+if __name__ == '__main__':
+    unittest.main()
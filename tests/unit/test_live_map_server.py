@@ -0,0 +1,103 @@
+import io
+import os
+import gzip
+import contextlib
+import json
+import shutil
+import unittest
+import tempfile
+from http import HTTPStatus
+from unittest import TestCase
+from email.utils import formatdate
+from OverviewDatabase import OverviewDatabase
+from LiveMapServer import LiveMapServer, positions_to_features
+from synthetic_trip import generate_trip
+
+
+class TestLiveMapServer(TestCase):
+    def setUp(self):
+        self.folder = tempfile.mkdtemp()
+        self.positions = generate_trip(days=3, interval=60, step_days=1)
+        self.trip_data = OverviewDatabase()
+        self.trip_data.connect_to_database(os.path.join(self.folder, "trip.db"), True)
+        self.server = LiveMapServer(self.trip_data, tiles_url="http://localhost/{z}/{x}/{y}.png", poll_interval=10)
+
+    def tearDown(self):
+        self.trip_data.close_database()
+        shutil.rmtree(self.folder)
+
+    def get(self, path, **headers):
+        status, response_headers, body = self.server.respond(path, {name.replace("_", "-"): value
+                                                                    for name, value in headers.items()})
+        if response_headers.get("Content-Encoding") == "gzip":
+            body = gzip.decompress(body)
+        return status, response_headers, json.loads(body) if status == HTTPStatus.OK and body[:1] in b"{[" else body
+
+    def test_positions_to_features(self):
+        features = positions_to_features(self.positions.iloc[[0, 1, 2]].assign(current_step=[0, 0, 1]))
+        self.assertEqual([feature["geometry"]["type"] for feature in features], ["LineString", "Point"])
+        self.assertEqual(features[0]["geometry"]["coordinates"][1],
+                         [round(self.positions["longitude"].iloc[1], 5), round(self.positions["latitude"].iloc[1], 5)])
+        self.assertEqual(features[1]["properties"]["step"], 1)
+        self.assertEqual(positions_to_features(self.positions.iloc[:0]), [])
+
+    def test_endpoints(self):
+        status, _, _ = self.get("/summary")
+        self.assertEqual(status, HTTPStatus.SERVICE_UNAVAILABLE)
+        status, headers, page = self.server.respond("/")
+        self.assertEqual(status, HTTPStatus.OK)
+        self.assertIn(b"http://localhost/{z}/{x}/{y}.png", page)
+        self.assertEqual(self.server.respond("/", {"If-None-Match": headers["ETag"]})[0], HTTPStatus.NOT_MODIFIED)
+
+        middle = len(self.positions) // 2
+        self.trip_data.commit_dataframe(self.positions.iloc[:middle].copy())
+        status, headers, summary = self.get("/summary")
+        self.assertEqual(summary["positions"], middle)
+        self.assertEqual([step["step"] for step in summary["steps"]], sorted(set(self.positions["current_step"]
+                                                                                 .iloc[:middle])))
+        self.assertEqual(headers["Last-Modified"], formatdate(summary["last_timestamp"], usegmt=True))
+        status, _, step = self.get("/steps/0", Accept_Encoding="gzip, deflate")
+        self.assertEqual(len(step["geometry"]["coordinates"]), summary["steps"][0]["positions"])
+        self.assertEqual(self.get("/steps/9")[0], HTTPStatus.NOT_FOUND)
+        self.assertEqual(self.get("/trace?since=now")[0], HTTPStatus.BAD_REQUEST)
+        self.assertEqual(self.get("/unknown")[0], HTTPStatus.NOT_FOUND)
+
+        # No new position: the poll is a 304, with its ETag or its date
+        since = summary["last_timestamp"]
+        status, headers, delta = self.get("/trace?since=%d" % since)
+        self.assertEqual((delta["features"], delta["last_timestamp"]), ([], since))
+        self.assertEqual(self.get("/trace?since=%d" % since, If_None_Match=headers["ETag"])[0],
+                         HTTPStatus.NOT_MODIFIED)
+        self.assertEqual(self.get("/trace?since=%d" % since, If_Modified_Since=headers["Last-Modified"])[0],
+                         HTTPStatus.NOT_MODIFIED)
+
+        # New positions: only them are sent, after the last position already drawn
+        self.trip_data.commit_dataframe(self.positions.iloc[middle:].copy())
+        status, headers_after, delta = self.get("/trace?since=%d" % since, If_None_Match=headers["ETag"],
+                                                Accept_Encoding="gzip")
+        self.assertEqual(status, HTTPStatus.OK)
+        self.assertEqual(headers_after["Content-Encoding"], "gzip")
+        self.assertNotEqual(headers_after["ETag"], headers["ETag"])
+        self.assertEqual(delta["last_timestamp"], self.positions["timestamp"].iloc[-1])
+        new_positions = len(self.positions) - middle
+        self.assertEqual(sum(len(feature["geometry"]["coordinates"]) for feature in delta["features"]),
+                         new_positions + 1)
+        self.assertEqual(delta["features"][0]["geometry"]["coordinates"][0],
+                         [round(self.positions["longitude"].iloc[middle - 1], 5),
+                          round(self.positions["latitude"].iloc[middle - 1], 5)])
+        # The followers polling the same delta share its body, the polls do not print the queried rows
+        with contextlib.redirect_stdout(io.StringIO()) as output:
+            self.get("/trace?since=%d" % since)
+            self.get("/summary")
+        self.assertEqual(self.server.stats["cache_hits"], 1)
+        self.assertEqual(output.getvalue(), "")
+        # The unchanged steps keep their ETag
+        self.assertEqual(self.get("/steps/0", If_None_Match=step_etag(summary, 0))[0], HTTPStatus.NOT_MODIFIED)
+
+
+def step_etag(summary, step):
+    return next(row["etag"] for row in summary["steps"] if row["step"] == step)
+
+
+if __name__ == '__main__':
+    unittest.main()
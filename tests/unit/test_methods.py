@@ -1,12 +1,165 @@
+import os
+import re
+import gzip
+import json
+import shutil
+import tempfile
 import unittest
+import numpy as np
+import pandas as pd
 from unittest import TestCase
-from script.methods import dist_from_gps
+from OverviewDatabase import OverviewDatabase
+from methods import dist_from_gps, retrieve_influxdb_data, load_step_layers, create_site, load_snapshot
+from geodesy import decode_polyline
+
+
+class FakeDataFrameClient:
+    """Local stand-in of influxdb.DataFrameClient returning one series per gps_measure topic"""
+    def __init__(self, missing_timestamps=()):
+        self.queries = []
+        self.missing_timestamps = pd.DatetimeIndex(missing_timestamps, tz="UTC")
+
+    def query(self, query, chunked=False, chunk_size=0):
+        self.queries.append(query)
+        start, end = re.findall(r"time >= '(.*?)Z' AND time < '(.*?)Z'", query)[0]
+        index = pd.date_range(pd.Timestamp(start).ceil("5s"), pd.Timestamp(end), freq="5s", tz="UTC")
+        # End excluded, sliced by hand: the inclusive argument needs pandas >= 1.4 (not available on Python 3.7)
+        index = index[index < pd.Timestamp(end, tz="UTC")]
+        seconds = (index - pd.Timestamp("2021-06-01", tz="UTC")).total_seconds().values
+        values = {"latitude": 48.0 + seconds / 1e5, "longitude": 2.0 + seconds / 1e5,
+                  "altitude": np.full(len(index), 100.0), "speed": np.full(len(index), 50.0)}
+        result = {}
+        for topic, value in values.items():
+            frame = pd.DataFrame({"mean": value}, index=index)
+            if topic == "speed":
+                frame = frame.drop(self.missing_timestamps, errors="ignore")
+            result[("mqtt_consumer", (("topic", "gps_measure/" + topic),))] = frame
+        return result
 
 
 class TestMethods(TestCase):
     def test_dist_from_gps(self):
         self.assertEqual(round(dist_from_gps([52.2296756, 21.0122287], [52.406374, 16.9251681]), 3), 278.546) 
 
+    def test_retrieve_influxdb_data(self):
+        client = FakeDataFrameClient(missing_timestamps=["2021-06-01T12:00:00"])
+        stats = {}
+        results = retrieve_influxdb_data(["2021-06-01T10:00:00", "2021-06-02T10:00:00"], client, "5s", stats=stats)
+        # One grouped query per 6h window
+        self.assertEqual(len(client.queries), 5)
+        self.assertEqual("GROUP BY time(5s), \"topic\"" in client.queries[0], True)
+        # The topics are joined on the timestamp, the fix without speed is dropped
+        self.assertEqual(len(results), 24 * 720)
+        self.assertEqual(int(pd.Timestamp("2021-06-01T12:00:00Z").timestamp()) in results["timestamp"].values, False)
+        row = results.loc[pd.Timestamp("2021-06-01T12:00:05Z")]
+        self.assertAlmostEqual(row["latitude"], 48.0 + 43205 / 1e5)
+        self.assertAlmostEqual(row["longitude"], 2.0 + 43205 / 1e5)
+        self.assertEqual(stats["rows"], len(results))
+        self.assertEqual(stats["rows_per_second"] > 0, True)
+
+
+    def test_load_step_layers(self):
+        cache_folder = tempfile.mkdtemp()
+        timestamps = 1622541600 + np.arange(300) * 5
+        gps_trace = pd.DataFrame({"timestamp": timestamps,
+                                  "latitude": np.linspace(48.0, 48.3, 300),
+                                  "longitude": np.linspace(2.0, 2.3, 300),
+                                  "km": np.linspace(0, 40, 300),
+                                  "current_step": np.arange(300) // 100})
+        gps_trace["date"] = pd.to_datetime(gps_trace["timestamp"], unit="s")
+
+        def step_trace(step):
+            return gps_trace[gps_trace["current_step"] == step]
+
+        def rendered_steps(steps):
+            # The cached layers are dated 0, the rendered ones are written again
+            for filename in os.listdir(cache_folder):
+                os.utime(os.path.join(cache_folder, filename), (0, 0))
+            step_layers = load_step_layers(steps, step_trace, cache_folder, 10.0)
+            return step_layers, [step for step in steps if os.path.getmtime(
+                os.path.join(cache_folder, "step_%d.geojson" % step)) > 0]
+
+        step_layers, rendered = rendered_steps([0, 1, 2])
+        self.assertEqual((sorted(step_layers), rendered), ([0, 1, 2], [0, 1, 2]))
+        path, marker = step_layers[2]["features"]
+        self.assertEqual(len(path["geometry"]["coordinates"]), 2)
+        self.assertEqual(path["geometry"]["coordinates"][-1], [2.3, 48.3])
+        self.assertEqual(marker["geometry"]["coordinates"], [2.3, 48.3])
+        self.assertEqual("Etape 3" in marker["properties"]["tooltip"], True)
+        self.assertEqual(rendered_steps([0, 1, 2])[1], [])
+
+        # Only the changed steps are rendered again: a new position, a corrected one which keeps the summary of
+        # its step (count, first and last timestamps and km)
+        gps_trace.loc[len(gps_trace)] = [timestamps[-1] + 5, 48.31, 2.3, 40.5, 2, gps_trace["date"].iloc[-1]]
+        gps_trace.loc[150, "latitude"] += 0.01
+        step_layers, rendered = rendered_steps([0, 1, 2])
+        self.assertEqual(rendered, [1, 2])
+        self.assertEqual(step_layers[2]["features"][1]["geometry"]["coordinates"], [2.3, 48.31])
+
+        # The layers of the removed steps are deleted
+        load_step_layers([0, 1], step_trace, cache_folder, 10.0)
+        self.assertEqual(sorted(os.listdir(cache_folder)), ["step_0.geojson", "step_1.geojson"])
+        shutil.rmtree(cache_folder)
+
+
+    def test_create_site(self):
+        site_folder = tempfile.mkdtemp() + "/"
+        os.makedirs(site_folder + "saves")
+        trip_data = OverviewDatabase()
+        trip_data.connect_to_database(site_folder + "trip.db", True)
+        # Nothing to render before the first position
+        create_site(trip_data, site_folder, "2021_05_31", "http://localhost/{z}/{x}/{y}.png")
+        self.assertEqual(os.path.exists(site_folder + "trip_data.json"), False)
+        trip_data.commit_dataframe(pd.DataFrame({"timestamp": 1622541600 + np.arange(200) * 5,
+                                                 "latitude": np.linspace(48.0, 48.3, 200),
+                                                 "longitude": np.linspace(2.0, 2.3, 200),
+                                                 "altitude": 100.0, "speed": 50.0,
+                                                 "km": np.linspace(0, 40, 200),
+                                                 "current_step": np.arange(200) // 100}))
+        create_site(trip_data, site_folder, "2021_06_01", "http://localhost/{z}/{x}/{y}.png",
+                    extra_tile_variants=[{"name": "topo", "tiles": "OpenTopoMap"}], workers=2)
+        # The trace and the markers are written once, the maps reference them
+        with open(site_folder + "trip_data.json") as file:
+            data = json.load(file)
+        self.assertEqual([step["step"] for step in data["steps"]], [0, 1])
+        self.assertEqual(data["steps"][1]["marker"], [48.3, 2.3])
+        latitudes, longitudes = decode_polyline(data["steps"][0]["path"])
+        self.assertEqual((latitudes[0], longitudes[0]), (48.0, 2.0))
+        with gzip.open(site_folder + "trip_data.json.gz") as file:
+            self.assertEqual(json.loads(file.read()), data)
+        for map_name in ["offline", "online", "topo"]:
+            with open(site_folder + map_name + "_index.html") as file:
+                page = file.read()
+            self.assertEqual("trip_data.json?v=" in page, True)
+            self.assertEqual("48.149" in page, False)
+            self.assertEqual("40.0 km parcouru" in page, True)
+            self.assertEqual(os.path.exists(site_folder + map_name + "_index.html.gz"), True)
+
+        # The snapshots only store the parts that changed: the new position changes the last step
+        trip_data.commit_position(1622541600 + 200 * 5, 48.31, 2.31, 100.0, 50.0, 41.0, 1)
+        create_site(trip_data, site_folder, "2021_06_02", "http://localhost/{z}/{x}/{y}.png", workers=1)
+        trip_data.close_database()
+        self.assertEqual(sorted(os.listdir(site_folder + "saves")), ["2021_06_01.json", "2021_06_02.json", "parts"])
+        self.assertEqual(len(os.listdir(site_folder + "saves/parts")), 4)
+        snapshot = load_snapshot(site_folder + "saves/", "2021_06_01")
+        self.assertEqual(snapshot.pop("legend")["km"], 40.0)
+        self.assertEqual(snapshot, data)
+        self.assertEqual(load_snapshot(site_folder + "saves/", "2021_06_02")["steps"][1]["marker"], [48.31, 2.31])
+        self.assertEqual(load_snapshot(site_folder + "saves/", "2021_06_03"), None)
+
+        # The tooltip of each planned route shows the deviation of the trace from this route
+        trip_data.connect_to_database(site_folder + "trip.db")
+        trip_data.import_route("along", [(0, 48.0, 2.0, None), (0, 48.31, 2.31, None)])
+        trip_data.import_route("detour", [(0, 49.0, 2.0, None), (0, 49.0, 3.0, None)])
+        create_site(trip_data, site_folder, "2021_06_03", "http://localhost/{z}/{x}/{y}.png", workers=1)
+        trip_data.close_database()
+        with open(site_folder + "trip_data.json") as file:
+            tooltips = [route["tooltip"] for route in json.load(file)["routes"]]
+        self.assertEqual(["<h1>along</h1>" in tooltips[0], "écart maximal du trajet: 0.0 km" in tooltips[0]],
+                         [True, True])
+        self.assertEqual("<h1>detour</h1>" in tooltips[1] and "0.0 km" not in tooltips[1], True)
+        shutil.rmtree(site_folder)
+
         
 if __name__ == '__main__':
-    unittest.main()
\ No newline at end of file
+    unittest.main()
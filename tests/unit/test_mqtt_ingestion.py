@@ -0,0 +1,109 @@
+import os
+import shutil
+import asyncio
+import unittest
+import tempfile
+from unittest import TestCase
+from OverviewDatabase import OverviewDatabase
+from MqttIngestion import FixAssembler, MqttIngestion, InProcessBroker
+from synthetic_trip import generate_trip, mqtt_messages
+
+
+class TestFixAssembler(TestCase):
+    def test_assemble(self):
+        assembler = FixAssembler(resampling=5, join_window=10)
+        self.assertEqual(assembler.add("latitude", 45.0, 100.5), [])
+        self.assertEqual(assembler.add("latitude", 45.2, 101.0), [])
+        self.assertEqual(assembler.add("longitude", 5.0, 102.0), [])
+        self.assertEqual(assembler.add("altitude", 200.0, 103.0), [])
+        self.assertEqual(assembler.add("speed", 50.0, 104.0), [])
+        # The period [100, 105) is closed 10 s after its end, with the mean of each measure
+        self.assertEqual(assembler.add("latitude", 45.3, 112.0), [])
+        self.assertEqual(assembler.add("latitude", 45.4, 115.0), [(100, 45.1, 5.0, 200.0, 50.0)])
+        # Late message of a closed period
+        self.assertEqual(assembler.add("speed", 60.0, 103.0), [])
+        self.assertEqual(assembler.late_messages, 1)
+        # The missing measures take their previous value: 120 has the coordinates of 115 and is removed, 130 is
+        # parked after a parked fix and is removed
+        fixes = assembler.add("speed", 0.5, 121.0) + assembler.add("latitude", 45.5, 126.0) \
+            + assembler.add("latitude", 45.6, 131.0) + assembler.flush()
+        self.assertEqual([fix[0] for fix in fixes], [110, 115, 125])
+        self.assertEqual(fixes[-1], (125, 45.5, 5.0, 200.0, 0.5))
+        self.assertEqual(assembler.flush(), [])
+        # Periods before the last committed position are late
+        assembler = FixAssembler(resampling=5, join_window=10, closed_until=200)
+        self.assertEqual(assembler.add("latitude", 45.0, 199.0), [])
+        self.assertEqual(assembler.late_messages, 1)
+
+
+class TestMqttIngestion(TestCase):
+    def setUp(self):
+        self.folder = tempfile.mkdtemp()
+        self.positions = generate_trip(days=1, interval=5, drive_hours=2)
+
+    def tearDown(self):
+        shutil.rmtree(self.folder)
+
+    def ingest(self, trip_data, messages, queue_size):
+        async def publish(broker):
+            for message in messages:
+                await broker.publish(*message)
+            await broker.publish("gps_measure/speed", b"not a number", messages[-1][2])
+            await broker.close()
+
+        async def main():
+            broker = InProcessBroker(maxsize=10)
+            ingestion = MqttIngestion(trip_data, queue_size=queue_size)
+            stats, _ = await asyncio.gather(ingestion.run(broker.subscribe()), publish(broker))
+            return stats
+        return asyncio.run(main())
+
+    def test_ingest(self):
+        trip_data = OverviewDatabase(buffer_size=100)
+        trip_data.connect_to_database(os.path.join(self.folder, "trip.db"), True)
+        messages = mqtt_messages(self.positions)
+        stats = self.ingest(trip_data, messages[:len(messages) // 2], queue_size=5)
+        self.assertEqual(stats["messages"], len(messages) // 2 + 1)
+        self.assertEqual(stats["invalid_messages"], 1)
+        self.assertLessEqual(stats["max_queue"], 5)
+        # Driving positions are all kept, the parked ones are reduced to the first of each stop
+        positions = trip_data.query_range()
+        self.assertEqual(len(positions), stats["fixes"])
+        moving = self.positions[self.positions["speed"] >= 1.0]
+        self.assertEqual(set(moving["timestamp"]) <= set(positions["timestamp"]) | set(
+            self.positions["timestamp"].iloc[len(self.positions) // 2 - 1:]), True)
+        self.assertLess(abs(positions["latitude"] - self.positions.set_index("timestamp").loc[
+            positions["timestamp"], "latitude"].values).max(), 1e-9)
+
+        # Restart: the periods already committed are not ingested again
+        stats = self.ingest(trip_data, messages, queue_size=1000)
+        self.assertGreater(stats["late_messages"], 0)
+        summary = trip_data.get_trip_summary()
+        self.assertEqual(summary["positions"], len(positions) + stats["fixes"])
+        # The trip ends parked: the last fix is the first parked position after the last moving one
+        self.assertEqual(summary["last_timestamp"], trip_data.query_range()["timestamp"].iloc[-1])
+        self.assertGreater(summary["last_timestamp"], moving["timestamp"].iloc[-1])
+        trip_data.close_database()
+
+    def test_connection_lost(self):
+        trip_data = OverviewDatabase(buffer_size=100)
+        trip_data.connect_to_database(os.path.join(self.folder, "trip.db"), True)
+        messages = mqtt_messages(self.positions)[:400]
+
+        async def subscribe():
+            for message in messages:
+                yield message
+            raise ConnectionError("Connection lost")
+
+        ingestion = MqttIngestion(trip_data)
+        with self.assertRaises(ConnectionError):
+            asyncio.run(asyncio.wait_for(ingestion.run(subscribe()), 10))
+        # The received messages are assembled and committed before the error is raised
+        self.assertEqual(ingestion.stats["messages"], len(messages))
+        self.assertGreater(ingestion.stats["fixes"], 0)
+        self.assertEqual(trip_data.get_trip_summary()["positions"], ingestion.stats["fixes"])
+        trip_data.close_database()
+
+
+if __name__ == '__main__':
+    unittest.main()
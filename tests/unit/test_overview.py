@@ -1,13 +1,22 @@
 import os
+import shutil
+import tempfile
 import unittest
 import numpy as np
+import pandas as pd
 from unittest import TestCase
-from src.overview.OverviewDatabase import OverviewDatabase
+from OverviewDatabase import OverviewDatabase, trip_data_columns
 
 
 class TestOverviewDatabase(TestCase):
     unit_test_data_folder = os.path.join(os.getcwd(), "tests", "unit", "data")
 
+    def copy_fixture(self, filename):
+        # Opened with create=True, a fixture would be migrated in place
+        folder = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, folder)
+        return shutil.copy(os.path.join(self.unit_test_data_folder, filename), folder)
+
     def test_connect_to_database_not_exist(self):
         # Database does not exist
         timestamp_geo_json = OverviewDatabase()
@@ -33,7 +42,7 @@ class TestOverviewDatabase(TestCase):
 
     def test_connect_to_database_exist(self):
         timestamp_geo_json = OverviewDatabase()
-        timestamp_geo_json.connect_to_database(os.path.join(self.unit_test_data_folder, "database_exists.db"), True)
+        timestamp_geo_json.connect_to_database(self.copy_fixture("database_exists.db"), True)
         self.assertEqual(timestamp_geo_json.database is None, False)
         timestamp_geo_json.close_database()
 
@@ -67,7 +76,7 @@ class TestOverviewDatabase(TestCase):
     def test_sleeping_position_algo(self):
         # Test the algorithm (arr_to_compare was previously computed and retrieve from known database)
         timestamp_geo_json = OverviewDatabase()
-        timestamp_geo_json.connect_to_database(os.path.join(self.unit_test_data_folder, "sleeping_positions.db"))
+        timestamp_geo_json.connect_to_database(self.copy_fixture("sleeping_positions.db"), True)
         sleeping_position = timestamp_geo_json.get_sleeping_locations(static_position_threshold=1.0,
                                                                       min_distance=10000.0)
         arr_to_compare = [[1619634065.0, 49.431277595698134, -20.98148729661071, 1514.1521730711734],
@@ -124,15 +133,405 @@ class TestOverviewDatabase(TestCase):
         if os.path.exists(os.path.join(self.unit_test_data_folder, "create_describe.db")):
             os.remove(os.path.join(self.unit_test_data_folder, "create_describe.db"))
 
+    def test_commit_dataframe(self):
+        db_filepath = os.path.join(self.unit_test_data_folder, "create_dataframe.db")
+        timestamp_geo_json = OverviewDatabase()
+        timestamp_geo_json.connect_to_database(db_filepath, True)
+        df = pd.DataFrame({"timestamp": [30, 10, 20],
+                           "latitude": [40.4167, 48.8566, 43.3],
+                           "longitude": [-3.70325, 2.3522, -1.2],
+                           "altitude": [650, 35, 100],
+                           "speed": [0, 0, 90],
+                           "km": [1100, 0, 800],
+                           "current_step": [0, 0, 0]})
+        timestamp_geo_json.commit_dataframe(df)
+        timestamp_geo_json.query_raw_database()
+        timestamp_geo_json.close_database()
+        self.assertEqual(timestamp_geo_json.raw_data is None, True)
+        timestamp_geo_json.connect_to_database(db_filepath)
+        timestamp_geo_json.query_raw_database()
+        self.assertEqual(timestamp_geo_json.raw_data["timestamp"].tolist(), [10, 20, 30])
+        self.assertEqual(timestamp_geo_json.raw_data["current_country"].tolist(), ["France", "France", "Spain"])
+        # The km of a new position continues from the last committed one, without loading the cached frame
+        timestamp_geo_json.invalidate_raw_data()
+        timestamp_geo_json.commit_position(40, 40.4167, -3.70325, 650)
+        self.assertEqual(timestamp_geo_json.raw_data is None, True)
+        self.assertEqual(timestamp_geo_json.query_range(40)["km"].tolist(), [1100.0])
+        # The positions already stored and the repeated timestamps are skipped, the others are inserted
+        self.assertEqual(timestamp_geo_json.insert_positions([
+            (40, 40.4167, -3.70325, 650, 0, 1100, "Spain", 0), (50, 40.42, -3.7, 650, 0, 1101, "Spain", 0),
+            (50, 40.43, -3.7, 650, 0, 1102, "Spain", 0)]), True)
+        self.assertEqual(timestamp_geo_json.get_trip_summary()["positions"], 5)
+        self.assertEqual(timestamp_geo_json.query_range(50)["latitude"].tolist(), [40.42])
+        timestamp_geo_json.close_database()
+
+        # Remove test.db generated if exists
+        if os.path.exists(db_filepath):
+            os.remove(db_filepath)
+
+    def test_durability_options(self):
+        folder = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, folder)
+        # The values not accepted by the PRAGMA are not set
+        timestamp_geo_json = OverviewDatabase(journal_mode="WAL; DROP TABLE trip_data", synchronous="normal")
+        timestamp_geo_json.connect_to_database(os.path.join(folder, "durability.db"), True)
+        self.assertEqual(timestamp_geo_json.execute_read_query("PRAGMA journal_mode")[1], [("delete",)])
+        self.assertEqual(timestamp_geo_json.execute_read_query("PRAGMA synchronous")[1], [(1,)])
+        self.assertEqual(timestamp_geo_json.execute_read_query("SELECT COUNT(*) FROM trip_data")[0], True)
+        timestamp_geo_json.close_database()
+
+    def test_commit_buffered(self):
+        db_filepath = os.path.join(self.unit_test_data_folder, "create_buffered.db")
+        flushes = []
+        timestamp_geo_json = OverviewDatabase(buffer_size=3, flush_callback=lambda rows, latency, stats:
+                                              flushes.append(rows), journal_mode="WAL", synchronous="NORMAL")
+        timestamp_geo_json.connect_to_database(db_filepath, True)
+        success, journal_mode = timestamp_geo_json.execute_read_query("PRAGMA journal_mode")
+        self.assertEqual(journal_mode, [("wal",)])
+        timestamp_geo_json.commit_position(1, 49.0659719561271, 1.99154344325376, 10, 30, 10, 0)
+        timestamp_geo_json.commit_position(2, 49.0694584269596, 2.0623537554957, 10, 30, 11, 0)
+        # Nothing is written until the buffer is full
+        success, count = timestamp_geo_json.execute_read_query("SELECT COUNT(*) FROM trip_data")
+        self.assertEqual(count, [(0,)])
+        timestamp_geo_json.commit_position(3, 49.0694584269596, 2.0623537554957, 10, 30, 11, 0)
+        self.assertEqual(flushes, [3])
+        timestamp_geo_json.commit_position(4, 49.0659719561271, 1.99154344325376, 10, 30, 10, 0)
+        # Reads see the buffered positions
+        self.assertEqual(timestamp_geo_json.query_range()["km"].tolist(), [10, 15.17, 15.17, 20.34])
+        self.assertEqual(flushes, [3, 1])
+        self.assertEqual(timestamp_geo_json.flush_stats["rows"], 4)
+
+        # Time based flush and flush on close
+        timestamp_geo_json.flush_interval = 0
+        timestamp_geo_json.commit_position(5, 49.0659719561271, 1.99154344325376, 10, 30, 10, 0)
+        self.assertEqual(flushes, [3, 1, 1])
+        timestamp_geo_json.flush_interval = None
+        timestamp_geo_json.commit_position(6, 49.0659719561271, 1.99154344325376, 10, 30, 10, 0)
+        timestamp_geo_json.close_database()
+        self.assertEqual(flushes, [3, 1, 1, 1])
+
+        # Remove test.db generated if exists
+        for suffix in ["", "-wal", "-shm"]:
+            if os.path.exists(db_filepath + suffix):
+                os.remove(db_filepath + suffix)
+
+    def test_raw_data_cache(self):
+        db_filepath = os.path.join(self.unit_test_data_folder, "create_cache.db")
+        insert_stmt = ("INSERT INTO trip_data (timestamp, latitude, longitude, altitude, speed, km, current_country, "
+                       "current_step) VALUES (?, ?, ?, ?, ?, ?, ?, ?)")
+        timestamp_geo_json = OverviewDatabase()
+        timestamp_geo_json.connect_to_database(db_filepath, True)
+        timestamp_geo_json.execute_query(insert_stmt, "single", data=(10, 49.0, 2.0, 10, 30, 0, "France", 0))
+        timestamp_geo_json.execute_query(insert_stmt, "single", data=(20, 49.1, 2.0, 10, 30, 11, "France", 0))
+        timestamp_geo_json.query_raw_database()
+        self.assertEqual(timestamp_geo_json.raw_data_last_timestamp, 20)
+
+        # Rows newer than the high-water mark are appended to the cache
+        timestamp_geo_json.execute_query(insert_stmt, "single", data=(30, 49.2, 2.0, 10, 30, 22, "France", 1))
+        cached = timestamp_geo_json.raw_data
+        timestamp_geo_json.query_raw_database()
+        self.assertEqual(timestamp_geo_json.raw_data["timestamp"].tolist(), [10, 20, 30])
+        self.assertEqual(timestamp_geo_json.raw_data.iloc[:2].equals(cached), True)
+
+        # Rows older than the high-water mark need an invalidation
+        timestamp_geo_json.execute_query(insert_stmt, "single", data=(15, 49.05, 2.0, 10, 30, 5, "France", 0))
+        timestamp_geo_json.invalidate_raw_data(older_than=31)
+        self.assertEqual(timestamp_geo_json.raw_data is None, False)
+        timestamp_geo_json.invalidate_raw_data(older_than=15)
+        self.assertEqual(timestamp_geo_json.raw_data is None, True)
+        timestamp_geo_json.query_raw_database()
+        self.assertEqual(timestamp_geo_json.raw_data["timestamp"].tolist(), [10, 15, 20, 30])
+        timestamp_geo_json.refresh_raw_data()
+        self.assertEqual(len(timestamp_geo_json.raw_data), 4)
+        timestamp_geo_json.close_database()
+
+        # Remove test.db generated if exists
+        if os.path.exists(db_filepath):
+            os.remove(db_filepath)
+
+    def test_query_api(self):
+        db_filepath = os.path.join(self.unit_test_data_folder, "create_query.db")
+        insert_stmt = ("INSERT INTO trip_data (timestamp, latitude, longitude, altitude, speed, km, current_country, "
+                       "current_step) VALUES (?, ?, ?, ?, ?, ?, ?, ?)")
+        timestamp_geo_json = OverviewDatabase()
+        timestamp_geo_json.connect_to_database(db_filepath, True)
+        self.assertEqual(timestamp_geo_json.migrate_schema(), 5)
+        success, indexes = timestamp_geo_json.execute_read_query(
+            "SELECT name FROM sqlite_master WHERE type = 'index' AND tbl_name = 'trip_data'")
+        self.assertEqual(("trip_data_step_index",) in indexes, True)
+        timestamp_geo_json.execute_query(insert_stmt, "multiple", data=[
+            (i * 10, 49.0 + i / 100, 2.0, 10, 30, i, "France", i // 4) for i in range(12)])
+
+        self.assertEqual(timestamp_geo_json.get_last_step(), 2)
+        self.assertEqual(timestamp_geo_json.query_range(20, 50)["timestamp"].tolist(), [20, 30, 40, 50])
+        self.assertEqual(timestamp_geo_json.query_range(start_timestamp=100)["timestamp"].tolist(), [100, 110])
+        self.assertEqual(timestamp_geo_json.query_range(end_timestamp=10, columns=["timestamp", "km"]).values.tolist(),
+                         [[0, 0], [10, 1]])
+        self.assertEqual(timestamp_geo_json.query_range(columns=["timestamp; DROP TABLE trip_data"]), None)
+        self.assertEqual(timestamp_geo_json.query_step(1)["timestamp"].tolist(), [40, 50, 60, 70])
+        self.assertEqual(len(timestamp_geo_json.query_steps(1, 2)), 8)
+        self.assertEqual(timestamp_geo_json.query_step(3).empty, True)
+        timestamp_geo_json.close_database()
+
+        # Remove test.db generated if exists
+        if os.path.exists(db_filepath):
+            os.remove(db_filepath)
+
+    def test_partitioned_storage(self):
+        db_filepath = os.path.join(self.unit_test_data_folder, "create_partitioned.db")
+        insert_stmt = ("INSERT INTO trip_data (timestamp, latitude, longitude, altitude, speed, km, current_country, "
+                       "current_step) VALUES (?, ?, ?, ?, ?, ?, ?, ?)")
+        # 2021-05-31 23:00, 2021-06-01 01:00, 2021-06-15, 2021-07-01 00:00 UTC
+        timestamps = [1622502000, 1622509200, 1623715200, 1625097600]
+        timestamp_geo_json = OverviewDatabase()
+        timestamp_geo_json.connect_to_database(db_filepath, True)
+        timestamp_geo_json.execute_query(insert_stmt, "multiple", data=[
+            (timestamp, 49.0, 2.0, 10, 30, i, "France", i) for i, timestamp in enumerate(timestamps[:3])])
+
+        # A failed split is rolled back: the partition of June can not be indexed
+        timestamp_geo_json.execute_query("CREATE TABLE trip_data_2021_06 (timestamp INTEGER)", "single")
+        self.assertEqual(timestamp_geo_json.split_into_partitions(), False)
+        self.assertEqual(timestamp_geo_json.partitioned, False)
+        self.assertEqual(timestamp_geo_json._table_names().count("trip_data_2021_05"), 0)
+        self.assertEqual(len(timestamp_geo_json.query_range()), 3)
+        timestamp_geo_json.execute_query("DROP TABLE trip_data_2021_06", "single")
+
+        # Split the existing database
+        self.assertEqual(timestamp_geo_json.split_into_partitions(), True)
+        self.assertEqual(list(timestamp_geo_json.partitions), ["2021_05", "2021_06"])
+        timestamp_geo_json.commit_position(timestamps[3], 49.1, 2.0, 10, 30, 3, 3)
+        self.assertEqual(list(timestamp_geo_json.partitions), ["2021_05", "2021_06", "2021_07"])
+        self.assertEqual(timestamp_geo_json.query_range()["timestamp"].tolist(), timestamps)
+        self.assertEqual(timestamp_geo_json._partition_source(timestamps[1], timestamps[2]),
+                         "SELECT " + ", ".join(trip_data_columns) + " FROM main.trip_data_2021_06")
+        self.assertEqual(timestamp_geo_json.query_range(timestamps[1], timestamps[2])["timestamp"].tolist(),
+                         timestamps[1:3])
+        self.assertEqual(timestamp_geo_json.get_last_step(), 3)
+        timestamp_geo_json.close_database()
+
+        # The partitioned mode is detected, the old months can be archived
+        timestamp_geo_json = OverviewDatabase()
+        timestamp_geo_json.connect_to_database(db_filepath, True)
+        self.assertEqual(timestamp_geo_json.partitioned, True)
+        self.assertEqual(timestamp_geo_json.archive_partition("2021_07"), False)
+        self.assertEqual(timestamp_geo_json.archive_partition("2021_05"), True)
+        self.assertEqual(timestamp_geo_json.partitions["2021_05"], "archive_2021.trip_data_2021_05")
+        timestamp_geo_json.close_database()
+        timestamp_geo_json = OverviewDatabase()
+        timestamp_geo_json.connect_to_database(db_filepath)
+        timestamp_geo_json.query_raw_database()
+        self.assertEqual(timestamp_geo_json.raw_data["timestamp"].tolist(), timestamps)
+        self.assertEqual(timestamp_geo_json.query_step(0)["timestamp"].tolist(), timestamps[:1])
+        timestamp_geo_json.close_database()
+
+        # Remove test.db generated if exists
+        for filepath in [db_filepath, timestamp_geo_json.archive_filepath(2021)]:
+            if os.path.exists(filepath):
+                os.remove(filepath)
+
+    def test_trip_summary(self):
+        db_filepath = os.path.join(self.unit_test_data_folder, "create_summary.db")
+        timestamp_geo_json = OverviewDatabase()
+        timestamp_geo_json.connect_to_database(db_filepath, True)
+        self.assertEqual(timestamp_geo_json.get_trip_summary(), None)
+        self.assertEqual(timestamp_geo_json.describe_trip()[:3], (0, 0, 0))
+        # Positions committed out of order, in two countries and two steps
+        timestamp_geo_json.commit_dataframe(pd.DataFrame({"timestamp": [200000, 100],
+                                                          "latitude": [40.4167, 48.8566],
+                                                          "longitude": [-3.70325, 2.3522],
+                                                          "altitude": [650, 35],
+                                                          "speed": [0, 0],
+                                                          "km": [1100, 0],
+                                                          "current_step": [1, 0]}))
+        timestamp_geo_json.commit_dataframe(pd.DataFrame({"timestamp": [50, 100000], "latitude": [48.85, 43.3],
+                                                          "longitude": [2.35, -1.2], "altitude": [35, 100],
+                                                          "speed": [0, 90], "km": [0, 800], "current_step": [0, 1]}))
+        timestamp_geo_json.commit_position(1000000, 40.4168, -3.70325, 650, 0, 0, 1)
+        summary = timestamp_geo_json.get_trip_summary()
+        self.assertEqual(summary, {"first_timestamp": 50, "last_timestamp": 1000000, "total_km": 1100.01,
+                                   "positions": 5, "countries": {"France": 50, "Spain": 200000}})
+        steps = timestamp_geo_json.get_step_summaries()
+        self.assertEqual(steps["first_timestamp"].tolist(), [50, 100000])
+        self.assertEqual(steps["last_km"].tolist(), [0, 1100.01])
+        self.assertEqual(steps["positions"].tolist(), [2, 3])
+        self.assertEqual(timestamp_geo_json.describe_trip(), (
+            11, 2, 1100.01, "The current trip lasted 11 days, 2 country traveled for a total of 1100.01 km"))
+
+        # The rebuild gives the same summary
+        self.assertEqual(timestamp_geo_json.rebuild_summary(), True)
+        self.assertEqual(timestamp_geo_json.get_trip_summary(), summary)
+        self.assertEqual(timestamp_geo_json.get_step_summaries().equals(steps), True)
+        timestamp_geo_json.close_database()
+
+        # Remove test.db generated if exists
+        if os.path.exists(db_filepath):
+            os.remove(db_filepath)
+
+    def test_sleeping_locations(self):
+        db_filepath = os.path.join(self.unit_test_data_folder, "create_sleeping.db")
+        timestamp_geo_json = OverviewDatabase()
+        timestamp_geo_json.connect_to_database(db_filepath, True)
+        self.assertEqual(timestamp_geo_json.query_sleeping_locations().empty, True)
+        # 3 days: drive then park for the night, every 10 minutes
+        day = 86400
+        timestamps = np.arange(0, 3 * day, 600)
+        driving = (timestamps % day) < 8 * 3600
+        latitudes = 45.0 + np.cumsum(driving) * 0.005
+        positions = pd.DataFrame({"timestamp": timestamps, "latitude": latitudes, "longitude": 5.0,
+                                  "altitude": 100.0, "speed": np.where(driving, 50.0, 0.0),
+                                  "km": np.arange(len(timestamps)), "current_step": timestamps // day})
+        # Committed in 3 parts, the stay detection is updated by each commit
+        for part in [positions.iloc[:100], positions.iloc[100:300], positions.iloc[300:]]:
+            timestamp_geo_json.commit_dataframe(part.copy())
+        sleeping_locations = timestamp_geo_json.query_sleeping_locations()
+        self.assertEqual(sleeping_locations["arrival"].tolist(), [8 * 3600, day + 8 * 3600, 2 * day + 8 * 3600])
+        self.assertEqual(sleeping_locations["departure"].tolist(), [day - 600, 2 * day - 600, 3 * day - 600])
+        self.assertEqual(sleeping_locations["current_step"].tolist(), [0, 1, 2])
+        # The queries only read
+        changes = timestamp_geo_json.database.total_changes
+        timestamp_geo_json.query_sleeping_locations()
+        timestamp_geo_json.query_bbox(40.0, 0.0, 50.0, 10.0, table="sleeping_locations")
+        self.assertEqual(timestamp_geo_json.database.total_changes, changes)
+        # Same stays as the full detection
+        self.assertEqual(timestamp_geo_json.update_sleeping_locations(full=True), 3)
+        self.assertEqual(timestamp_geo_json.query_sleeping_locations().equals(sleeping_locations), True)
+
+        # Thresholds can be changed with a full detection, they are kept for the next updates
+        self.assertEqual(timestamp_geo_json.update_sleeping_locations(full=True, min_dwell=20 * 3600), 0)
+        self.assertEqual(timestamp_geo_json.update_sleeping_locations(full=True, min_dwell=4 * 3600), 3)
+
+        # A moving position inserted in a past stay splits it
+        timestamp_geo_json.commit_position(day // 2 + 1, 47.0, 5.0, 100, 50, 0, 0)
+        sleeping_locations = timestamp_geo_json.query_sleeping_locations()
+        self.assertEqual(sleeping_locations["arrival"].tolist(), [8 * 3600, day // 2 + 600, day + 8 * 3600,
+                                                                  2 * day + 8 * 3600])
+        self.assertEqual(timestamp_geo_json.update_sleeping_locations(full=True), 4)
+        self.assertEqual(timestamp_geo_json.query_sleeping_locations().equals(sleeping_locations), True)
+        timestamp_geo_json.close_database()
+
+        # Remove test.db generated if exists
+        if os.path.exists(db_filepath):
+            os.remove(db_filepath)
+
+    def test_compact_storage(self):
+        db_filepath = os.path.join(self.unit_test_data_folder, "create_compact.db")
+        converted_filepath = os.path.join(self.unit_test_data_folder, "create_converted.db")
+        positions = pd.DataFrame({"timestamp": [100, 200, 300],
+                                  "latitude": [48.8566123, 48.9, 40.4167],
+                                  "longitude": [2.3522219, 2.4, -3.70325],
+                                  "altitude": [35.26, -2.0, 650.0],
+                                  "speed": [0.0, 87.654, -1.0],
+                                  "km": [0.0, 10.123, 1100.0],
+                                  "current_step": [0, 0, 1]})
+        timestamp_geo_json = OverviewDatabase(compact=True)
+        timestamp_geo_json.connect_to_database(db_filepath, True)
+        self.assertEqual(timestamp_geo_json.compact, True)
+        timestamp_geo_json.commit_dataframe(positions.copy())
+        # Decoded to the same shape, at the resolution of the fixed-point encoding
+        result = timestamp_geo_json.query_range()
+        self.assertEqual(result.columns.tolist(), trip_data_columns)
+        self.assertEqual(result["latitude"].tolist(), [48.856612, 48.9, 40.4167])
+        self.assertEqual(result["altitude"].tolist(), [35.5, -2.0, 650.0])
+        self.assertEqual(result["speed"].tolist(), [0.0, 87.65, -1.0])
+        self.assertEqual(result["km"].tolist(), [0.0, 10.12, 1100.0])
+        self.assertEqual(result["current_country"].astype(str).tolist(), ["France", "France", "Spain"])
+        self.assertEqual(result["timestamp"].dtype, np.int64)
+        # The trip_data view gives the same values
+        view = pd.read_sql_query("SELECT * FROM trip_data ORDER BY timestamp", timestamp_geo_json.database)
+        self.assertEqual(view.equals(result.astype({"current_country": object})), True)
+        self.assertEqual(timestamp_geo_json.get_trip_summary()["total_km"], 1100.0)
+        self.assertEqual(timestamp_geo_json.query_step(1, ["timestamp", "current_country"]).values.tolist(),
+                         [[300, "Spain"]])
+        # A failed insert does not keep its new country
+        timestamp_geo_json.commit_position(300, 52.37, 4.90, 0, 0, 0, 1)
+        self.assertEqual(timestamp_geo_json.country_ids, {"France": 1, "Spain": 2})
+        timestamp_geo_json.commit_position(400, 52.37, 4.90, 40000, 0, 0, 1)
+        self.assertEqual(len(timestamp_geo_json.query_range()), 3)
+        timestamp_geo_json.close_database()
+
+        # Conversion of an existing database
+        timestamp_geo_json = OverviewDatabase()
+        timestamp_geo_json.connect_to_database(converted_filepath, True)
+        timestamp_geo_json.commit_dataframe(positions.copy())
+        self.assertEqual(timestamp_geo_json.convert_to_compact(), True)
+        self.assertEqual(timestamp_geo_json.query_range().equals(result), True)
+        self.assertEqual(timestamp_geo_json.get_trip_summary()["positions"], 3)
+        timestamp_geo_json.close_database()
+        timestamp_geo_json = OverviewDatabase()
+        timestamp_geo_json.connect_to_database(converted_filepath, True)
+        self.assertEqual(timestamp_geo_json.compact, True)
+        self.assertEqual(timestamp_geo_json.migrate_schema(), 5)
+        timestamp_geo_json.query_raw_database()
+        self.assertEqual(timestamp_geo_json.raw_data.equals(result), True)
+        self.assertEqual(timestamp_geo_json.convert_to_compact(), False)
+        timestamp_geo_json.close_database()
+
+        # Remove test.db generated if exists
+        for filepath in [db_filepath, converted_filepath]:
+            if os.path.exists(filepath):
+                os.remove(filepath)
+
+    def test_spatial_index(self):
+        db_filepath = os.path.join(self.unit_test_data_folder, "create_spatial.db")
+        rng = np.random.default_rng(0)
+        positions = pd.DataFrame({"timestamp": np.arange(1622505600, 1622505600 + 3000 * 60, 60),
+                                  "latitude": 45.0 + np.cumsum(rng.normal(0.0, 0.002, 3000)),
+                                  "longitude": 5.0 + np.cumsum(rng.normal(0.0, 0.002, 3000)),
+                                  "altitude": 200.0, "speed": 50.0, "km": 0.0, "current_step": 0})
+        for compact in [None, True]:
+            timestamp_geo_json = OverviewDatabase(compact=compact)
+            timestamp_geo_json.connect_to_database(db_filepath, True)
+            self.assertEqual(timestamp_geo_json.spatial_indexes, {"trip_data", "sleeping_locations"})
+            timestamp_geo_json.commit_dataframe(positions.iloc[:2000].copy())
+            for row in positions.iloc[2000:].itertuples():
+                timestamp_geo_json.commit_position(row.timestamp, row.latitude, row.longitude, row.altitude,
+                                                   row.speed, row.km, row.current_step)
+            stored = timestamp_geo_json.query_range()
+            # Same positions as a scan, the boxes of the index are rounded to 32-bit floats
+            for center, time_range in [(0, None), (100, (1622505600 + 6000, None)),
+                                       (2500, (None, 1622505600 + 2500 * 60 + 3600))]:
+                latitude, longitude = stored["latitude"].iloc[center], stored["longitude"].iloc[center]
+                result = timestamp_geo_json.query_bbox(latitude - 0.01, longitude - 0.01, latitude + 0.01,
+                                                       longitude + 0.01, time_range)
+                expected = stored[stored["latitude"].between(latitude - 0.01, latitude + 0.01)
+                                  & stored["longitude"].between(longitude - 0.01, longitude + 0.01)]
+                if time_range is not None:
+                    expected = expected[expected["timestamp"].between(time_range[0] or 0, time_range[1] or 2 ** 40)]
+                self.assertGreater(len(result), 0)
+                self.assertEqual(result.values.tolist(), expected.values.tolist())
+            result = timestamp_geo_json.query_nearby(45.01, 5.01, 1.5, columns=["timestamp"])
+            self.assertEqual(result.columns.tolist(), ["timestamp", "distance"])
+            distances = np.degrees(np.arccos(np.clip(
+                np.sin(np.radians(45.01)) * np.sin(np.radians(stored["latitude"])) + np.cos(np.radians(45.01))
+                * np.cos(np.radians(stored["latitude"])) * np.cos(np.radians(stored["longitude"] - 5.01)), -1, 1)))
+            self.assertEqual(result["timestamp"].tolist(),
+                             stored.loc[np.radians(distances) * 6371.0 <= 1.5, "timestamp"].tolist())
+            # Sleeping locations
+            timestamp_geo_json.commit_position(1622505600 + 3000 * 60, 45.3, 5.3, 200.0, 0.0, 0.0, 0)
+            timestamp_geo_json.commit_position(1622505600 + 3000 * 60 + 86400, 45.3, 5.3, 200.0, 0.0, 0.0, 0)
+            self.assertEqual(timestamp_geo_json.query_nearby(45.3, 5.31, 1.0, table="sleeping_locations")[
+                "arrival"].tolist(), [1622505600 + 3000 * 60])
+            self.assertEqual(len(timestamp_geo_json.query_bbox(40.0, 10.0, 50.0, 20.0, table="sleeping_locations")), 0)
+            self.assertEqual(timestamp_geo_json.rebuild_spatial_index(), True)
+            self.assertEqual(len(timestamp_geo_json.query_bbox(40.0, 170.0, 50.0, 5.05)),
+                             int((stored["longitude"] <= 5.05).sum()))
+            self.assertIsNone(timestamp_geo_json.query_bbox(40.0, 0.0, 50.0, 10.0, table="planned_route"))
+            # Empty batches
+            self.assertEqual(timestamp_geo_json.insert_positions([]), True)
+            timestamp_geo_json.commit_dataframe(positions.iloc[:0].copy())
+            self.assertEqual(timestamp_geo_json.get_trip_summary()["positions"], len(stored) + 2)
+            timestamp_geo_json.close_database()
+            os.remove(db_filepath)
+
     def test_gps_trace(self):
         timestamp_geo_json = OverviewDatabase()
-        timestamp_geo_json.connect_to_database(os.path.join(self.unit_test_data_folder, "gps_trace.db"), True)
+        timestamp_geo_json.connect_to_database(self.copy_fixture("gps_trace.db"), True)
         trace = timestamp_geo_json.get_road_trip_gps_trace(speed_resampling=10)
         timestamp_geo_json.close_database()
-        self.assertEqual(trace.loc[0]["lat"].values[0] == 46.58568968857452, True)
-        self.assertEqual(trace.loc[0]["lat"].values[1] == -53.46602430039604, True)
-        self.assertEqual(trace.loc[3]["lat"].values[0] == 59.45381512533035, True)
-        self.assertEqual(trace["lat"].values[4] == 59.45381512533035, True)
+        self.assertEqual(trace.loc[0]["latitude"].values[0] == 46.58568968857452, True)
+        self.assertEqual(trace.loc[0]["latitude"].values[1] == -53.46602430039604, True)
+        self.assertEqual(trace.loc[3]["latitude"].values[0] == 59.45381512533035, True)
+        self.assertEqual(trace["latitude"].values[6] == 59.45381512533035, True)
 
 
 if __name__ == '__main__':
@@ -0,0 +1,81 @@
+import os
+import shutil
+import unittest
+import tempfile
+from unittest import TestCase
+from OverviewDatabase import OverviewDatabase
+from routes import read_route
+
+gpx_route = """<?xml version="1.0" encoding="UTF-8"?>
+<gpx version="1.1" creator="test" xmlns="http://www.topografix.com/GPX/1/1">
+  <wpt lat="45.5" lon="5.5"><name>Camp</name></wpt>
+  <trk><name>Alps</name>
+    <trkseg>
+      <trkpt lat="45.0" lon="5.0"><ele>200.5</ele><time>2021-06-01T10:00:00Z</time></trkpt>
+      <trkpt lat="45.1" lon="5.0"><ele>210</ele></trkpt>
+    </trkseg>
+    <trkseg>
+      <trkpt lat="46.0" lon="6.0"></trkpt>
+    </trkseg>
+  </trk>
+</gpx>
+"""
+
+kml_route = """<?xml version="1.0" encoding="UTF-8"?>
+<kml xmlns="http://www.opengis.net/kml/2.2" xmlns:gx="http://www.google.com/kml/ext/2.2">
+  <Document>
+    <Placemark><Point><coordinates>5.5,45.5,0</coordinates></Point></Placemark>
+    <Placemark><LineString><coordinates>
+      5.0,45.0,200 5.0,45.1,210
+    </coordinates></LineString></Placemark>
+    <Placemark><gx:Track><when>2021-06-01T10:00:00Z</when><gx:coord>6.0 46.0 300</gx:coord></gx:Track></Placemark>
+  </Document>
+</kml>
+"""
+
+
+class TestRoutes(TestCase):
+    def setUp(self):
+        self.folder = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.folder)
+
+    def write(self, filename, content):
+        filepath = os.path.join(self.folder, filename)
+        with open(filepath, "w") as file:
+            file.write(content)
+        return filepath
+
+    def test_read_route(self):
+        self.assertEqual(list(read_route(self.write("route.gpx", gpx_route))),
+                         [(0, 45.0, 5.0, 200.5), (0, 45.1, 5.0, 210.0), (1, 46.0, 6.0, None)])
+        self.assertEqual(list(read_route(self.write("route.kml", kml_route))),
+                         [(0, 45.0, 5.0, 200.0), (0, 45.1, 5.0, 210.0), (1, 46.0, 6.0, 300.0)])
+        self.assertRaises(ValueError, list, read_route(self.write("route.xml", "<html></html>")))
+
+    def test_import_route(self):
+        trip_data = OverviewDatabase()
+        trip_data.connect_to_database(os.path.join(self.folder, "trip.db"), True)
+        self.assertEqual(trip_data.import_route("alps", read_route(self.write("route.gpx", gpx_route)),
+                                                batch_size=2), 3)
+        # Replaced by a new import of the same name
+        self.assertEqual(trip_data.import_route("alps", read_route(self.write("route.kml", kml_route))), 3)
+        # A failed import keeps the previous route
+        self.assertIsNone(trip_data.import_route("alps", read_route(self.write("broken.gpx", gpx_route[:300]))))
+        route = trip_data.query_planned_route("alps")
+        self.assertEqual(route["altitude"].tolist(), [200.0, 210.0, 300.0])
+        self.assertEqual(route["segment"].tolist(), [0, 0, 1])
+
+        trip_data.commit_position(1622541600, 45.05, 5.0, 200.0, 50.0)
+        trip_data.commit_position(1622541660, 45.05, 5.01, 200.0, 50.0)
+        deviation = trip_data.get_route_deviation("alps")
+        self.assertEqual(deviation["timestamp"].tolist(), [1622541600, 1622541660])
+        self.assertLess(deviation["deviation"].iloc[0], 1.0)
+        self.assertAlmostEqual(deviation["deviation"].iloc[1], 787.0, delta=5.0)
+        self.assertIsNone(trip_data.get_route_deviation("unknown"))
+        trip_data.close_database()
+
+
+if __name__ == '__main__':
+    unittest.main()
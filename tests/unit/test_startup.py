@@ -0,0 +1,16 @@
+import unittest
+from unittest import TestCase
+from benchmark import measure_startup
+
+
+class TestStartup(TestCase):
+    def test_noop_run(self):
+        # The site was just updated: generate_site.py exits without importing the pipeline modules
+        startup = measure_startup(runs=1)
+        self.assertEqual(startup["heavy_modules"], [])
+        # Generous budget, the no-op run only imports yaml and the standard library
+        self.assertLess(startup["seconds"], 5.0)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,67 @@
+import os
+import shutil
+import unittest
+import tempfile
+import numpy as np
+from datetime import timedelta
+from unittest import TestCase
+from OverviewDatabase import OverviewDatabase
+from methods import retrieve_influxdb_data, stream_influxdb_positions
+from synthetic_trip import generate_trip, write_trip_database, SyntheticDataFrameClient
+from benchmark import compare_results
+
+
+class TestSyntheticTrip(TestCase):
+    def test_generate_trip(self):
+        positions = generate_trip(days=10, interval=60, seed=1, gap_probability=0.5)
+        self.assertEqual(positions.equals(generate_trip(days=10, interval=60, seed=1, gap_probability=0.5)), True)
+        self.assertEqual(positions.equals(generate_trip(days=10, interval=60, seed=2, gap_probability=0.5)), False)
+        # Some nights are not logged
+        self.assertEqual(len(positions) < 10 * 24 * 60, True)
+        self.assertEqual((np.diff(positions["timestamp"].values) > 3600).any(), True)
+        self.assertEqual((np.diff(positions["km"].values) >= 0).all(), True)
+        self.assertEqual(positions["current_step"].iloc[-1], 3)
+
+    def test_write_trip_database(self):
+        folder = tempfile.mkdtemp()
+        positions = generate_trip(days=1, interval=60, rest_probability=0.0, drive_hours=4)
+        self.assertEqual(write_trip_database(os.path.join(folder, "trip.db"), positions), len(positions))
+        trip_data = OverviewDatabase()
+        trip_data.connect_to_database(os.path.join(folder, "trip.db"))
+        summary = trip_data.get_trip_summary()
+        self.assertEqual(summary["positions"], len(positions))
+        # Paris -> Brussels
+        self.assertEqual(list(summary["countries"]), ["France", "Belgium"])
+        trip_data.close_database()
+        shutil.rmtree(folder)
+
+    def test_synthetic_client(self):
+        positions = generate_trip(days=2)
+        client = SyntheticDataFrameClient(positions)
+        results = retrieve_influxdb_data(["2021-06-01T09:00:00", "2021-06-01T10:00:00"], client, "5s")
+        self.assertEqual(client.queries, 1)
+        self.assertEqual(len(results), 721)
+        self.assertEqual(results["latitude"].iloc[0], positions.set_index("timestamp")["latitude"][1622538000])
+
+    def test_stream_positions(self):
+        # The windows are cleaned as the whole range: the parked nights and the km carry over the windows
+        client = SyntheticDataFrameClient(generate_trip(days=2))
+        timestamps = ["2021-06-01T00:00:00", "2021-06-03T00:00:00"]
+        frames = list(stream_influxdb_positions(timestamps, client, "5s"))
+        results = retrieve_influxdb_data(timestamps, client, "5s", window=timedelta(days=3))
+        self.assertEqual(len(frames), 5)
+        self.assertEqual(sum(len(frame) for frame in frames), len(results))
+        self.assertEqual(np.concatenate([frame["timestamp"].values for frame in frames]).tolist(),
+                         results["timestamp"].tolist())
+        self.assertLess(np.abs(np.concatenate([frame["km"].values for frame in frames]) - results["km"].values).max(),
+                        1e-9)
+
+    def test_compare_results(self):
+        previous = {"results": {"describe_trip": {"seconds": 1.0}, "create_site": {"seconds": 1.0}}}
+        current = {"results": {"describe_trip": {"seconds": 1.1}, "create_site": {"seconds": 1.5},
+                               "commit_position": {"seconds": 1.0}}}
+        self.assertEqual(compare_results(previous, current), [("create_site", 1.0, 1.5)])
+
+
+if __name__ == '__main__':
+    unittest.main()
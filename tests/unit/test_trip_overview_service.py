@@ -0,0 +1,163 @@
+import os
+import math
+import time
+import signal
+import shutil
+import unittest
+import tempfile
+import threading
+from unittest import TestCase
+from datetime import datetime, timedelta
+from OverviewDatabase import OverviewDatabase
+from TripOverviewService import TripOverviewService
+from site_update import write_last_update
+from synthetic_trip import generate_trip, SyntheticDataFrameClient
+
+
+class FailingDataFrameClient(SyntheticDataFrameClient):
+    """ SyntheticDataFrameClient failing from a given query """
+    def __init__(self, positions, failing_query=None):
+        super().__init__(positions)
+        self.failing_query = failing_query
+
+    def query(self, query, chunked=False, chunk_size=0):
+        if self.failing_query is not None and self.queries >= self.failing_query:
+            raise ConnectionError("InfluxDB is not reachable")
+        return super().query(query, chunked, chunk_size)
+
+
+class TestTripOverviewService(TestCase):
+    def setUp(self):
+        self.folder = tempfile.mkdtemp()
+        self.conf = {"database_filepath": os.path.join(self.folder, "trip.db"),
+                     "last_update_filepath": os.path.join(self.folder, "last_site_update.txt"),
+                     "daemon": {"ingest_interval": 3600, "render_interval": 43200},
+                     "backfill": {"chunk_hours": 24, "workers": 2,
+                                  "checkpoint_filepath": os.path.join(self.folder, "backfill_checkpoint.txt")}}
+        # Two days ending at midnight (UTC)
+        start = (datetime.utcnow() - timedelta(days=2)).strftime("%Y-%m-%d")
+        self.positions = generate_trip(days=2, interval=30, start=start)
+        self.client = SyntheticDataFrameClient(self.positions)
+
+    def tearDown(self):
+        shutil.rmtree(self.folder)
+
+    def test_ingest(self):
+        service = TripOverviewService(self.conf, self.client)
+        middle = datetime.utcfromtimestamp(int(self.positions["timestamp"].iloc[len(self.positions) // 2]))
+        ingested = [service.ingest(end=middle), service.ingest(), service.ingest()]
+        self.assertGreater(ingested[0], 0)
+        self.assertGreater(ingested[1], 0)
+        # The next ingestions start from the last committed position, without committing it twice
+        self.assertEqual(service.ingest(), 0)
+        summary = service.trip_data.get_trip_summary()
+        self.assertEqual(summary["positions"], sum(ingested))
+        self.assertGreater(summary["last_timestamp"], self.positions["timestamp"].iloc[-1] - 86400)
+        service.close()
+
+    def test_ingest_km(self):
+        self.conf["backfill"].update(chunk_hours=48)
+        start = datetime.utcfromtimestamp(int(self.positions["timestamp"].iloc[0]))
+        end = datetime.utcfromtimestamp(int(self.positions["timestamp"].iloc[-1]) + 1)
+
+        # Single ingestion of the whole range, in another database
+        conf = dict(self.conf, database_filepath=os.path.join(self.folder, "reference.db"))
+        service = TripOverviewService(conf, SyntheticDataFrameClient(self.positions))
+        service.ingest(start, end)
+        expected = service.trip_data.query_range()
+        service.close()
+
+        # Ingestion every 5 hours: the km continue from the last committed position
+        service = TripOverviewService(self.conf, self.client)
+        service.ingest(start, start + timedelta(hours=5))
+        for hours in range(10, 50, 5):
+            service.ingest(end=min(start + timedelta(hours=hours), end))
+        positions = service.trip_data.query_range()
+        service.close()
+        self.assertGreater(positions["km"].iloc[-1], 100)
+        self.assertAlmostEqual(positions["km"].iloc[-1], expected["km"].iloc[-1], delta=0.1)
+
+    def test_backfill(self):
+        self.conf["backfill"].update(chunk_hours=6, workers=3)
+        start = datetime.utcfromtimestamp(int(self.positions["timestamp"].iloc[0]))
+        end = datetime.utcfromtimestamp(int(self.positions["timestamp"].iloc[-1]) + 1)
+
+        # Uninterrupted backfill of the whole range, in another database
+        conf = dict(self.conf, database_filepath=os.path.join(self.folder, "reference.db"))
+        service = TripOverviewService(conf, SyntheticDataFrameClient(self.positions))
+        stats = service.ingest(start, end)
+        expected = service.trip_data.query_range()
+        service.close()
+        self.assertEqual(len(expected), stats)
+        self.assertFalse(os.path.exists(self.conf["backfill"]["checkpoint_filepath"]))
+        # The chunks are committed in time order and their km continue from the previous chunk
+        conf = dict(conf, database_filepath=os.path.join(self.folder, "single.db"), backfill=dict(conf["backfill"], chunk_hours=48))
+        service = TripOverviewService(conf, SyntheticDataFrameClient(self.positions))
+        service.ingest(start, end)
+        single = service.trip_data.query_range()
+        service.close()
+        self.assertEqual((expected["km"].diff().dropna() >= 0).all(), True)
+        self.assertAlmostEqual(expected["km"].iloc[-1], single["km"].iloc[-1], delta=0.1)
+
+        # The InfluxDB connection fails during the backfill: the committed chunks are kept
+        client = FailingDataFrameClient(self.positions, failing_query=10)
+        service = TripOverviewService(self.conf, client)
+        self.assertRaises(ConnectionError, service.backfill, start, end)
+        checkpoint = service.read_checkpoint()
+        self.assertIsNotNone(checkpoint)
+        self.assertLessEqual(service.trip_data.get_trip_summary()["last_timestamp"], checkpoint.timestamp())
+
+        # The next backfill resumes from the checkpoint
+        client.failing_query = None
+        stats = service.backfill(start, end)
+        self.assertEqual(stats["resumed_from"], checkpoint.isoformat())
+        self.assertLess(stats["chunks"], math.ceil((end - start) / timedelta(hours=6)))
+        self.assertFalse(os.path.exists(self.conf["backfill"]["checkpoint_filepath"]))
+        positions = service.trip_data.query_range()
+        service.close()
+        self.assertEqual(positions["timestamp"].tolist(), expected["timestamp"].tolist())
+
+    def test_last_update(self):
+        service = TripOverviewService(self.conf, self.client)
+        self.assertIsNone(service.last_update())
+        write_last_update(self.conf["last_update_filepath"], datetime(2021, 6, 1, 12))
+        with open(self.conf["last_update_filepath"], "r") as f:
+            self.assertEqual(f.read(), "2021-06-01T12:00:00+00:00")
+        self.assertEqual(service.last_update(), datetime(2021, 6, 1, 12))
+        # The files of the former versions are in the local time
+        previous_tz = os.environ.get("TZ")
+        os.environ["TZ"] = "Europe/Paris"
+        time.tzset()
+        try:
+            with open(self.conf["last_update_filepath"], "w") as f:
+                f.write("2021-06-01T14:00:00")
+            self.assertEqual(service.last_update(), datetime(2021, 6, 1, 12))
+        finally:
+            if previous_tz is None:
+                del os.environ["TZ"]
+            else:
+                os.environ["TZ"] = previous_tz
+            time.tzset()
+        service.close()
+
+    def test_run(self):
+        # The site was just rendered: only the ingestion runs, then the service waits for the next cycle
+        write_last_update(self.conf["last_update_filepath"], datetime.utcnow())
+        service = TripOverviewService(self.conf, self.client)
+        previous_handler = signal.getsignal(signal.SIGTERM)
+        timer = threading.Timer(1.0, os.kill, (os.getpid(), signal.SIGTERM))
+        timer.start()
+        start_time = time.monotonic()
+        service.run()
+        timer.join()
+        self.assertLess(time.monotonic() - start_time, 60)
+        self.assertEqual(service.cycles, {"ingest": 1, "render": 0, "failed": 0})
+        self.assertIs(signal.getsignal(signal.SIGTERM), previous_handler)
+        trip_data = OverviewDatabase()
+        trip_data.connect_to_database(self.conf["database_filepath"])
+        self.assertGreater(trip_data.get_trip_summary()["positions"], 0)
+        trip_data.close_database()
+
+
+if __name__ == '__main__':
+    unittest.main()